@@ -225,14 +225,17 @@ class Pets():
         # V0_idx = np.array([2*Nmax]*3)
         # Fhkl[tuple(V0_idx)] = 0
         print('...getting all hkls...')
+        #### only the g-h couplings of the reflections are needed (|q|<2*qmax)
+        N = 2*b0.Nmax
+        hkl_all = np.array([i.flatten() for i in np.meshgrid(*[np.arange(-N,N+1)]*3,indexing='ij')]).T
+        qmax = np.linalg.norm(self.HKL_dyn[['h','k','l']].values.dot(b0.lat_vec),axis=1).max()
+        hkl_all = hkl_all[np.linalg.norm(hkl_all.dot(b0.lat_vec),axis=1)<=2*qmax]
         hkls = pd.DataFrame(columns=['h','k','l','A','B','F','I','sig'],
-            index=[ str(tuple(hkl)) for hkl in np.vstack([ i.flatten() for i in b0.hklF]).T],
+            index=[ str(tuple(hkl)) for hkl in hkl_all],
             )
 
-        Fhkl = b0.Fhkl.flatten()
-        # Fhkl = np.array([ Fhkl[tuple(hkl_G+V0_idx)]
-        #     for hkl_G in hkls[['h','k','l']].values ])
-        hkls[['h','k','l']] = np.vstack([ i.flatten() for i in b0.hklF]).T
+        Fhkl = b0.get_Fhkl(hkl_all)
+        hkls[['h','k','l']] = hkl_all
         hkls['A'] = np.array(Fhkl.real,dtype=float)
         hkls['B'] = np.array(Fhkl.imag,dtype=float)
         hkls['F'] = 6
@@ -1,17 +1,19 @@
 import importlib as imp
-import tifffile,os,glob,pickle5,subprocess
+import tifffile,os,glob,pickle5,subprocess,collections,concurrent.futures
 import numpy as np,pandas as pd
 from typing import TYPE_CHECKING, Dict, Iterable, Optional, Sequence, Union
 from utils import displayStandards as dsp   #;imp.reload(dsp)
 from utils import glob_colors as colors     #;imp.reload(colors)
 from utils import handler3D as h3D          #;imp.reload(h3D)
-from scipy.integrate import trapz
 from . import utilities as ut               #;imp.reload(ut)
 
 class Rocking:
+    cache_mem = 2**30   #memory budget of the loaded simulations cache (bytes)
+    _index_cols = ['Sw','Swa','Vga','I']  #df_G columns kept in df_frames
+
     def __init__(self,Simu:object,
             uvw:list,tag:str,path:str,
-            Sargs:dict):
+            Sargs:dict,sweep:bool=False,nproc:int=1,resume:bool=False):
         """ simulate rocking curve
 
         Parameters
@@ -24,40 +26,94 @@ class Rocking:
             a tag identifying the sweep
         Sargs
             Simulator constructor arguments
+        sweep
+            solve all orientations with a single simulator reusing the Ug block (see :func:`~EDutils.utilities.sweep_var`)
+        nproc
+            number of worker processes (also used by :meth:`~Rocking.do` and :meth:`~Rocking.map`)
+        resume
+            skip the orientations already solved by an interrupted run with the same settings
         """
         self.path = path
         self.tag  = tag
         self.uvw  = uvw
         self.Sargs = Sargs
-        self.df = ut.sweep_var(Simu,params='u',vals=uvw,tag=tag,path=path,**Sargs)
+        self.nproc = nproc
+        self.store = RockStore(path,tag)
+        self.store.reset()
+        dfs = {}
+        def add_frame(i,sim_obj):
+            self.store.append(i,sim_obj)
+            dfs[i] = sim_obj.df_G
+        self.df = ut.sweep_var(Simu,params='u',vals=uvw,tag=tag,path=path,sweep=sweep,
+            callback=add_frame,nproc=nproc,resume=resume,**Sargs)
         self.n_simus=uvw.shape[0]
         ts            = np.arange(self.n_simus)
         self.ts       = ts
         self.df['ts'] = ts
         self.Iz_dyn = {}
         self.Iz_kin = {}
-        self._build_index()
+        self._build_index([dfs[i] for i in range(self.n_simus)])
         self.save(v=1)
 
     ###########################################################################
     #### compute
     ###########################################################################
-    def _build_index(self):
-        frames = [ i for i,name in enumerate(self.df.index)]
-        beams = np.unique(np.hstack([self.load(i).df_G.index.values for i,name in enumerate(self.df.index)]))
-        self.nbeams = beams.size
+    def _build_index(self,dfs:Optional[Sequence[pd.DataFrame]]=None):
+        """Builds the sparse frame x beam table df_frames
+
+        df_frames holds one row per beam of each frame (frame,beam id,row iG in df_G and columns of df_G)
+        sorted by beam then frame so that the rows of beam h are
+        df_frames[beams.i0[h]:beams.i0[h]+beams.n[h]] (see :meth:`~Rocking._get_beam_frames`).
+
+        Parameters
+        ----------
+        dfs
+            the df_G of all the simus (loaded if not provided)
+        """
+        if not dfs:dfs = [self.load(i).df_G for i in range(self.df.shape[0])]
         print('...building index...')
-        self.beams = pd.DataFrame(index=beams,columns=['Frame','Sw'])
-        for h in beams:
-            self.beams.loc[h,'Frame']=[]
-            self.beams.loc[h,'Sw']=[]
-        for i,f in enumerate(self.df.index):
-            for h,c in self.load(i).df_G.iterrows():
-                self.beams.loc[h,'Frame'].append(i)
-                self.beams.loc[h,'Sw'   ].append(c.Sw.real)
-        self.df['nbeams']=[self.load(i).df_G.index.shape[0] for i,f in enumerate(self.df.index)]
+        nG    = np.array([df_G.shape[0] for df_G in dfs])
+        frame = np.repeat(np.arange(nG.size),nG)
+        iG    = np.hstack([np.arange(n) for n in nG])
+        hkl   = np.hstack([df_G.index.values for df_G in dfs])
+        beams,beam = np.unique(hkl,return_inverse=True)
+        order = np.lexsort((frame,beam))
+        d = {'frame':frame,'beam':beam,'iG':iG}
+        for c in Rocking._index_cols:
+            if all([c in df_G.columns for df_G in dfs]):
+                d[c] = np.hstack([df_G[c].values for df_G in dfs]).real
+        self.df_frames = pd.DataFrame({k:v[order] for k,v in d.items()})
+        n = np.bincount(beam,minlength=beams.size)
+        self.beams = pd.DataFrame({'i0':np.hstack([0,np.cumsum(n)[:-1]]),'n':n},index=beams)
+        self.nbeams = beams.size
+        self.df['nbeams'] = nG
         self.save(v=1)
 
+    def _get_beam_frames(self,h:str):
+        """rows of df_frames for beam h"""
+        if not 'df_frames' in self.__dict__:self._build_index()
+        i0,n = self.beams.loc[h,['i0','n']]
+        return self.df_frames.iloc[i0:i0+n]
+
+    def _get_rows(self,refl=[],cond=''):
+        """rows of df_frames of beams refl (all if empty) satisfying cond
+
+        Returns None if cond cannot be evaluated from df_frames (callable or other columns of df_G)
+        """
+        if not 'df_frames' in self.__dict__:self._build_index()
+        df = self.df_frames
+        if len(refl):
+            refl = [h for h in refl if h in self.beams.index]
+            rows = np.hstack([[]]+[np.arange(i0,i0+n) for i0,n in self.beams.loc[refl,['i0','n']].values])
+            df = df.iloc[np.array(rows,dtype=int)]
+        if cond:
+            if not isinstance(cond,str):return
+            try:
+                df = df.loc[df.eval(cond)]
+            except NameError:
+                return
+        return df
+
     def reset_int(self):
         self.Iz_dyn,self.Iz_kin = {},{}
 
@@ -67,37 +123,56 @@ class Rocking:
             nbs=len(refl)
             refl  = [h for h in refl if not h in self.Iz_dyn.keys()] #;print(hkl)
 
-        hkl = [eval(h) for h in refl]
-        z,nzs = self._get_z()
-        nbs,nts = len(hkl),self.ts.size
-        if nbs:
-            Iz_dyns  = dict(zip(refl, [np.zeros((nts,nzs)) for h in refl] ))
-            Iz_kins  = dict(zip(refl, [np.zeros((nts,nzs)) for h in refl] ))
-            for i in range(nts):
-                sim_obj = self.load(i)
-                idx = sim_obj.get_beam(refl=refl,cond='',index=True)
-                if idx:
-                    hkl0 = sim_obj.df_G.iloc[idx].index #[str(tuple(h)) for h in sim_obj.get_hkl()[idx]]
-                    for idB,hkl_0 in zip(idx,hkl0):
-                        Iz_dyns[hkl_0][i,:] = sim_obj.Iz[idB,:]
-                        Iz_kins[hkl_0][i,:] = sim_obj.Iz_kin[idB,:]
-
-            Iz_dyn  = dict()
-            Iz_kin  = dict()
-            for h in refl:
-                df_b = self.beams.loc[h]
-                if len(df_b.Sw)>1:
-                    s = np.sign(df_b.Sw[1]-df_b.Sw[0])
-                    Iz_dyn[h]=[s*trapz(Iz_dyns[h][df_b.Frame,iz],df_b.Sw) for iz in range(nzs)]
-                    Iz_kin[h]=[s*trapz(Iz_kins[h][df_b.Frame,iz],df_b.Sw) for iz in range(nzs)]
-                else:
-                    Iz_dyn[h] = [Iz_dyns[h][df_b.Frame,iz] for iz in range(nzs)]
-                    Iz_kin[h] = [Iz_kins[h][df_b.Frame,iz] for iz in range(nzs)]
-            self.Iz_dyn.update(Iz_dyn)
-            self.Iz_kin.update(Iz_kin)
+        if len(refl):
+            Iz_dyn,refl = self.integrate_rocking(refl)
+            Iz_kin,refl = self.integrate_rocking(refl,kin=True)
+            self.Iz_dyn.update(dict(zip(refl,[list(I) for I in Iz_dyn])))
+            self.Iz_kin.update(dict(zip(refl,[list(I) for I in Iz_kin])))
             self.save()
             print(colors.green+'rock.Iz updated'+colors.black)
 
+    def integrate_rocking(self,refl:Sequence[str]=[],iZs=slice(None),kin:bool=False,chunk:int=2**16):
+        """Integrated rocking curves of beams refl over the excitation error at all thicknesses
+
+        Parameters
+        ----------
+        refl
+            beams to integrate (default all)
+        iZs
+            thicknesses
+        kin
+            integrate the kinematic intensities
+        chunk
+            max number of frame x beam rows loaded at a time
+
+        Returns
+        -------
+        np.ndarray
+            I (nbeams x nzs) integrated intensities
+        np.ndarray
+            refl the hkl index of I (see :func:`integrate_rocking`)
+        """
+        if not len(refl):refl = self.beams.index.values
+        refl = np.array(refl)
+        nzs  = self._get_z()[0][iZs].size
+        I = np.zeros((refl.size,nzs))
+        for ib,rows in self._iter_beam_rows(refl,chunk):
+            I[ib[0]:ib[-1]+1] = integrate_rocking(self._get_Iz(rows,iZs,kin),
+                rows.Sw.values,ib-ib[0],ib[-1]-ib[0]+1)
+        return I,refl
+
+    def _iter_beam_rows(self,refl,chunk:int=2**16):
+        """yields the rows of df_frames of consecutive groups of beams in refl
+        with their number in refl (roughly chunk rows at a time)"""
+        if not 'df_frames' in self.__dict__:self._build_index()
+        i0,n = self.beams.loc[refl,['i0','n']].values.T.astype(int)
+        groups = np.cumsum(n)//max(chunk,1)
+        for g in np.unique(groups):
+            ib  = np.where(groups==g)[0]
+            nb  = n[ib]
+            idx = np.arange(nb.sum())+np.repeat(i0[ib]-(np.cumsum(nb)-nb),nb)
+            yield np.repeat(ib,nb),self.df_frames.iloc[idx]
+
     def get_rocking(self,iZs:Optional[slice]=-1,
         zs:Optional[Iterable[float]]=None,
         refl:Sequence[tuple]=[],cond:str='',opts:str='',n=0):
@@ -122,7 +197,7 @@ class Rocking:
                 z,{beam:I(z)}
         """
         iZs,nzs  = self._get_iZs(iZs,zs)        #;print(iZs)
-        z0 = self.load(0).z.copy()[iZs][-1]
+        z0 = self._get_z()[0][iZs][-1]
         if not self.load(0).thick==z0:
             print('setting thickness to %dA' %z0)
             self.do('_set_I',v=0,iZ=iZs[-1])
@@ -134,22 +209,17 @@ class Rocking:
         for h in refl : I[str(h)]=np.zeros((nts,nzs))
 
         print("gathering the intensities")
-        for i in range(nts):
-            # print(colors.red,i,colors.black)
-            sim_obj = self.load(i)
-            hkl0  = sim_obj.get_beam(refl=refl,index=False)
-            if hkl0:
-                idx  = sim_obj.get_beam(refl=refl,index=True)
-                # hkl0 = [str(tuple(h)) for h in sim_obj.get_hkl()[idx]]
-                for idB,hkl_0 in zip(idx,hkl0):
-                    I[hkl_0][i,:] = np.array(sim_obj.Iz[idB,iZs])
+        for h in refl:
+            if h in self.beams.index:
+                rows = self._get_beam_frames(h)
+                I[h][rows.frame.values,:] = self._get_Iz(rows,iZs)
         if n and nbs>n:
             print('keeping only %d strongest beams' %n)
             df_Imax = pd.DataFrame.from_dict({h:Ib[:,0].max() for h,Ib in I.items()},orient='index',columns=['I'])
             hkls = df_Imax.sort_values('I',ascending=False)[:n].index
             I = {h:I[h] for h in hkls}
 
-        z = self.load(0).z.copy()[iZs]
+        z = self._get_z()[0][iZs]
         return z,I
 
     def integrate(self,thick=None):
@@ -162,22 +232,22 @@ class Rocking:
         b0 = self.load(0)
         if not b0.thick==thick:
             self.do('set_thickness',thick=thick)
-        df_int = pd.DataFrame(0,index=self.beams.index,columns=['I'])
-        for i in range(self.n_simus):
-            b0 = self.load(i)
-            df_int.loc[b0.df_G.index,'I'] += b0.df_G.I
+        df = self._get_rows()
+        I = np.bincount(df.beam,weights=df.I,minlength=self.nbeams)
+        df_int = pd.DataFrame(I,index=self.beams.index,columns=['I'])
         # self.save()
         return df_int
 
-    def _integrate_all(self):
-        b0 = self.load(0)
-        thicks=['%.1fA' %z for z in b0.z ]
-        self.z=b0.z
-        self.df_int = pd.DataFrame(0,index=self.beams.index,columns=thicks)
-
-        for i in range(self.n_simus):
-            b0 = self.load(i)
-            self.df_int.loc[b0.df_G.index] += b0.Iz
+    def _integrate_all(self,chunk:int=2**16):
+        z,nzs = self._get_z()
+        thicks=['%.1fA' %zi for zi in z ]
+        self.z=z
+        refl = self.beams.index.values
+        I = np.zeros((self.nbeams,nzs))
+        for ib,rows in self._iter_beam_rows(refl,chunk):
+            start = np.hstack([True,ib[1:]!=ib[:-1]])
+            I[ib[start]] = np.add.reduceat(self._get_Iz(rows),np.where(start)[0],axis=0)
+        self.df_int = pd.DataFrame(I,index=self.beams.index,columns=thicks)
         self.save()
         # print(self.z.shape,self.df_int.values.shape)
     ###########################################################################
@@ -215,7 +285,7 @@ class Rocking:
         """
         self._integrate_rocking(refl=refl,new=new)
         nbs = len(refl)
-        z = self.load(0).z
+        z = self._get_z()[0]
         Iz = np.array([self.Iz_dyn[h] for i,h in enumerate(refl)])
 
         cs = dsp.getCs(cm,nbs)
@@ -251,8 +321,8 @@ class Rocking:
             for iz,zi in enumerate(z):
                 legElt.update({'$z=%d A$' %(zi):['k',ms[iz]+'-']})
                 for i,refl0 in enumerate(refl):
-                    df_b=self.beams.loc[refl0]
-                    plts += [[df_b.Sw,I[refl0][df_b.Frame,iz],[cs[i],ms[iz]+'-'],'']]
+                    df_b=self._get_beam_frames(refl0)
+                    plts += [[df_b.Sw,I[refl0][df_b.frame,iz],[cs[i],ms[iz]+'-'],'']]
         else:
             # rocking for different thicknesses
             cs,ms = dsp.getCs(cmap,nzs),  dsp.markers
@@ -260,8 +330,8 @@ class Rocking:
             # self.get_frames(hkl,iTs=slice(0,None))
             for i,refl0 in enumerate(refl):
                 for iz,zi in enumerate(z):
-                    df_b=self.beams.loc[refl0]
-                    plts += [[df_b.Sw,I[refl0][df_b.Frame,iz],[cs[iz],ms[i]+'-'],'']]
+                    df_b=self._get_beam_frames(refl0)
+                    plts += [[df_b.Sw,I[refl0][df_b.frame,iz],[cs[iz],ms[i]+'-'],'']]
             legElt.update({'$z=%d A$' %(zi):[cs[iz],'-'] for iz,zi in enumerate(z) })
 
         # print('displaying')
@@ -303,12 +373,26 @@ class Rocking:
 
         Sw = pd.DataFrame(np.ones((nts,nbs)),columns=[str(h) for h in refl])
         if Iopt:I  = pd.DataFrame(np.zeros((nts,nbs)),columns=[str(h) for h in refl])
-        for i,name in enumerate(self.df.index[iTs]):
-            b = self.load(i) #;print(i)
-            hkl0 = b.get_beam(refl=refl,cond=cond,opt=0)
-            # hkl0 = [str(tuple(h)) for h in b.get_hkl()[idx]]
-            Sw.loc[i,hkl0] = b.df_G.loc[hkl0,'Sw'].values
-            if Iopt:I.loc[i,hkl0] = b.df_G.loc[hkl0,'I'].values
+        rows   = self._get_rows(refl,cond)
+        frames = np.arange(self.df.shape[0])[iTs]
+        if isinstance(rows,pd.DataFrame):
+            rows = rows.loc[np.isin(rows.frame,frames)]
+            i  = np.searchsorted(frames,rows.frame.values)
+            iB = Sw.columns.get_indexer(self.beams.index.values[rows.beam.values])
+            Sw0 = Sw.values.copy()
+            Sw0[i,iB] = rows.Sw.values
+            Sw = pd.DataFrame(Sw0,columns=Sw.columns)
+            if Iopt:
+                I0 = I.values.copy()
+                I0[i,iB] = rows.I.values
+                I = pd.DataFrame(I0,columns=I.columns)
+        else:
+            for i,f in enumerate(frames):
+                b = self.load(f) #;print(i)
+                hkl0 = b.get_beam(refl=refl,cond=cond,index=False)
+                # hkl0 = [str(tuple(h)) for h in b.get_hkl()[idx]]
+                Sw.loc[i,hkl0] = b.df_G.loc[hkl0,'Sw'].values
+                if Iopt:I.loc[i,hkl0] = b.df_G.loc[hkl0,'I'].values
 
         #locate minimum excitation errors
         iSmin = np.argmin(abs(Sw).values.T,axis=1) #locate minimums
@@ -361,11 +445,13 @@ class Rocking:
         -------
         DataFrame with info for that reflection
         """
-        frames = [ i for i,name in enumerate(self.df.index)
-            if hkl in self.load(i).df_G.index]
+        df_b = self._get_beam_frames(hkl)
+        if all([c in df_b.columns for c in cols]):
+            return df_b[['frame']+list(cols)].reset_index(drop=True)
 
+        frames = df_b.frame.values
         df = pd.DataFrame(frames,columns=['frame'])
-        df[cols]=0
+        df[cols]=0.0
 
         for i,f in enumerate(frames):
             vals = self.load(f).df_G.loc[hkl,cols].values #;print(f,vals)#df.iloc[i,cols])
@@ -374,10 +460,14 @@ class Rocking:
 
     def get_beams(self,cond='',refl=[],opts='',n=None):
         if cond:
-            refl = []
-            for i,name in enumerate(self.df.index):
-                b = self.load(i)
-                refl += b.get_beam(cond=cond,index=False)
+            rows = self._get_rows(cond=cond)
+            if isinstance(rows,pd.DataFrame):
+                refl = list(self.beams.index.values[np.unique(rows.beam)])
+            else:
+                refl = []
+                for i,name in enumerate(self.df.index):
+                    b = self.load(i)
+                    refl += b.get_beam(cond=cond,index=False)
         refl = np.unique(refl)           #;print(refl)
         if not isinstance(refl[0],str):
             refl=[str(tuple(h)) for h in refl]
@@ -403,7 +493,7 @@ class Rocking:
         return iTs,nts
 
     def _get_iZs(self,iZs,zs):
-        z = self.load(0).z
+        z = self._get_z()[0]
         if isinstance(zs,float) or isinstance(zs,int):zs = [zs]
         if isinstance(zs,list) or isinstance(zs,np.ndarray):
             iZs = [np.argmin(abs(z-z0)) for z0 in zs]
@@ -412,10 +502,26 @@ class Rocking:
         return iZs,nzs
 
     def _get_z(self):
-        z = self.load(0).z
+        z = self._get_store().z
         nzs = z.size
         return z,nzs
 
+    def _get_store(self):
+        """the rocking curve store (built from the simus if missing)"""
+        if not 'store' in self.__dict__:self.store = RockStore(self.path,self.tag)
+        if not self.store.exists():
+            print('...building rocking store...')
+            self.store.reset()
+            for i in range(self.df.shape[0]):
+                self.store.append(i,self.load(i))
+        return self.store
+
+    def _get_Iz(self,rows:pd.DataFrame,iZs=slice(None),kin:bool=False):
+        """I(z) of the rows (frame,iG) of df_frames from the store"""
+        store = self._get_store()
+        idx = store.get_offsets(rows.frame.values)+rows.iG.values
+        return store.get_Iz(idx,iZs,kin)
+
     def _get_ts(self,i,ts):
         if type(ts) in [float,int]:i=np.argmin(abs(self.ts-ts))
         return i,self.ts[i]
@@ -428,9 +534,10 @@ class Rocking:
         pad   = int(np.ceil(np.log10(nts)))
         names = [ '%s_%s%s' %(tag,'u',str(i).zfill(pad)) for i in range(nts)]
         self.df.index = names
-        cmd ="cd %s; rename 's/%s/%s/' %s*.pkl df_%s.pkl rock_%s.pkl" %(self.path,self.tag,tag,self.tag,self.tag,self.tag)
+        cmd ="cd %s; rename 's/%s/%s/' %s*.pkl df_%s.pkl rock_%s.pkl rock_%s_*" %(self.path,self.tag,tag,self.tag,self.tag,self.tag,self.tag)
         p = subprocess.Popen(cmd,shell=True);p.wait()
         self.tag = tag
+        self.store = RockStore(self.path,tag)
         for i,name in enumerate(names):
             sim_obj = load_pkl(os.path.join(self.path,name+'.pkl'))
             sim_obj.set_name(name=name,path=self.path)
@@ -457,21 +564,535 @@ class Rocking:
             index of the simu
         ts
             value
+
+        .. note::
+            The simus are kept in a LRU cache (see :meth:`~Rocking.set_cache`)
+            so the returned object is shared and should not be modified
+            other than through :meth:`~Rocking.do`.
         """
         i,ts = self._get_ts(i,ts)
-        file = self.df.iloc[i].pkl
-        # file = os.path.join(self.path,os.path.basename(self.df.iloc[i].pkl))
-        sim_obj = ut.load_pkl(file)
+        i = int(i)
+        cache = self._get_cache()
+        if i in cache:
+            cache.move_to_end(i)
+            sim_obj,size = cache[i]
+            #### lazily loaded arrays may have been loaded since
+            new_size = _sizeof(sim_obj)
+            cache[i] = (sim_obj,new_size)
+            self._cache_size += new_size-size
+        else:
+            file = self.df.iloc[i].pkl
+            # file = os.path.join(self.path,os.path.basename(self.df.iloc[i].pkl))
+            sim_obj = ut.load_pkl(file)
+            size = _sizeof(sim_obj)
+            cache[i] = (sim_obj,size)
+            self._cache_size += size
+        while self._cache_size>self.cache_mem and len(cache)>1:
+            j,(obj,size) = cache.popitem(last=False)
+            self._cache_size -= size
         return sim_obj
 
-    def do(self,f,v=True,**args):
-        """ apply function to all simus
+    def set_cache(self,mem:float=2**30):
+        """set the memory budget (bytes) of the cache of loaded simus (0 only keeps the last one)"""
+        self.cache_mem = mem
+        self.clear_cache()
+
+    def clear_cache(self):
+        """clear the cache of loaded simus"""
+        self._cache = collections.OrderedDict()
+        self._cache_size = 0
+
+    def _get_cache(self):
+        if not '_cache' in self.__dict__:self.clear_cache()
+        return self._cache
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_cache',None)
+        state.pop('_cache_size',None)
+        return state
+
+    def do(self,f:str,v=True,nproc:Optional[int]=None,**args):
+        """ apply method f to all simus and save them
+
+        Parameters
+        ----------
+        f
+            name of the method of the simus
+        v
+            verbose
+        nproc
+            number of worker processes (default self.nproc)
+        args
+            passed to f
+
+        .. note::
+            The cache is invalidated and then only holds the updated simus (if nproc=1).
+        """
+        self.clear_cache()
+        store = self.__dict__.get('store')
+        if store:store.reset()
+        nproc = self._get_nproc(nproc)
+        nsimus = self.df.shape[0]
+        dfs = [None]*nsimus
+        def add_frame(i,frame):
+            if store:store.append_frame(i,*frame[1:])
+            dfs[i] = frame[0]
+        try:
+            if nproc<=1:
+                for i in range(nsimus):
+                    obj = self.load(i)
+                    obj.__getattribute__(f)(**args)
+                    obj.save(v=v)
+                    add_frame(i,_get_frame(obj))
+            else:
+                pkls = self.df.pkl.values
+                with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as pool:
+                    futures = {pool.submit(_do_frame,pkls[i],f,args,v):i for i in range(nsimus)}
+                    for future in concurrent.futures.as_completed(futures):
+                        add_frame(futures[future],future.result())
+        except:
+            self.clear_cache()
+            if store:store.reset()
+            raise
+        if 'df_frames' in self.__dict__:self._build_index(dfs)
+
+    def map(self,f,frames:Optional[Sequence[int]]=None,nproc:Optional[int]=None,**args):
+        """ evaluate f on the simus without modifying or saving them
+
+        Parameters
+        ----------
+        f
+            name of a method of the simus or function called as f(sim_obj,**args)
+            (defined at module level if nproc>1)
+        frames
+            the simus to evaluate (default all)
+        nproc
+            number of worker processes (default self.nproc)
+        args
+            passed to f
+
+        Returns
+        -------
+        list
+            the results of f for each frame
+
+        Example
+        -------
+        intensities at new thicknesses without updating the simus::
+
+            Sz = rock.map('_get_Sz',z=np.arange(0,500,10))
+            Iz = [np.abs(S)**2 for S in Sz]
+        """
+        if frames is None:frames = range(self.df.shape[0])
+        frames = [int(i) for i in frames]
+        nproc  = self._get_nproc(nproc)
+        if nproc<=1:
+            return [_apply(self.load(i),f,args) for i in frames]
+        pkls = self.df.pkl.values
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as pool:
+            return list(pool.map(_map_frame,[pkls[i] for i in frames],[f]*len(frames),[args]*len(frames)))
+
+    def _get_nproc(self,nproc=None):
+        if nproc is None:nproc = self.__dict__.get('nproc',1)
+        return nproc
+
+    ###########################################################################
+    #### adaptive sampling
+    ###########################################################################
+    def refine(self,tol:float=1e-2,Imin:float=1e-3,cond:str='',
+        nmax:int=500,nit:int=10,dmin:float=1e-5,iZ:int=-1):
+        """Adaptive refinement of the orientations around the Bragg crossings
+
+        The intervals between consecutive frames where a strong beam crosses the Ewald sphere
+        or where the estimated error of its integrated intensity is above tol are bisected
+        until the integrated intensities of the strong beams converge.
+        Only the new orientations are solved.
+
+        Parameters
+        ----------
+        tol
+            relative tolerance on the integrated intensities of the strong beams
+        Imin
+            strong beams have a maximum intensity above Imin
+        cond
+            additional condition on the strong beams (see :meth:`~Rocking.get_beams`)
+        nmax
+            maximum number of frames
+        nit
+            maximum number of refinements
+        dmin
+            intervals smaller than dmin (rad) are not refined
+        iZ
+            index of the thickness used
+
+        Returns
+        -------
+        float
+            last relative change of the integrated intensities (0 if nothing was refined)
+
+        .. note::
+            The frames are expected to be ordered along a rotation path (see :func:`~EDutils.utilities.get_uvw_rock`).
+            The frames are renumbered along the path so that previously saved results referring to frame numbers
+            (Iz_dyn,df_int) are reset.
+        """
+        Simu = self.load(0).__class__
+        I0,refl0 = self._get_strong_integrated(Imin,cond,iZ)
+        err = 0
+        for it in range(nit):
+            j = self._get_refine_intervals(refl0,I0,tol,Imin,iZ,dmin)[:max(nmax-self.n_simus,0)]
+            if not j.size:break
+            u = self.uvw[j]+self.uvw[j+1]
+            u = (u.T/np.linalg.norm(u,axis=1)).T
+            print(colors.blue+'...refine %d : solving %d new frames...' %(it,j.size)+colors.black)
+            self._insert_frames(Simu,u,j,tag='%s_r%d' %(self.tag,self.__dict__.get('nrefine',0)))
+            self.nrefine = self.__dict__.get('nrefine',0)+1
+
+            I1,refl1 = self._get_strong_integrated(Imin,cond,iZ)
+            common,i0,i1 = np.intersect1d(refl0,refl1,return_indices=True)
+            err = np.inf
+            if common.size:
+                err = (abs(I1[i1]-I0[i0])/np.maximum(abs(I0[i0]),1e-30)).max()
+            print(colors.green+'refine %d : nframes=%d, nbeams=%d, err=%.2E' %(it,self.n_simus,refl1.size,err)+colors.black)
+            I0,refl0 = I1,refl1
+            if err<tol:break
+        self.save()
+        return err
+
+    def _get_strong_integrated(self,Imin,cond,iZ):
+        """integrated intensities and hkl of the strong beams"""
+        df = self.df_frames
+        I  = self._get_Iz(df,[iZ])[:,0]
+        Imax = np.zeros(self.nbeams)
+        np.maximum.at(Imax,df.beam.values,I)
+        #### the central beam has no rocking curve
+        strong = (Imax>=Imin) & ~(self.beams.index.values==str((0,0,0)))
+        if cond:
+            rows = self._get_rows(cond=cond)
+            strong &= np.isin(np.arange(self.nbeams),rows.beam.values)
+        refl = self.beams.index.values[strong]
+        I,refl = self.integrate_rocking(refl,iZs=[iZ])
+        return I[:,0],refl
+
+    def _get_refine_intervals(self,refl,Iint,tol,Imin,iZ,dmin):
+        """frames j such that the integrals of the rocking curves of beams refl
+        over [j,j+1] are not accurate enough or the beams cross the Ewald sphere
+
+        The error of the trapeze rule h^3/12*I'' is estimated from the neighbouring frames.
+        The intervals where a beam enters or leaves the excited beams are also refined if its intensity is significant
+        (always if it is excited at a single frame).
         """
-        for i in range(self.df.shape[0]):
-            obj = self.load(i)
-            obj.__getattribute__(f)(**args)
-            obj.save(v=v)
+        df = self.df_frames
+        b,f,Sw = df.beam.values,df.frame.values,df.Sw.values
+        I  = self._get_Iz(df,[iZ])[:,0]
+        ib = self.beams.index.get_indexer(refl)
+        Ib = np.zeros(self.nbeams)
+        Ib[ib] = abs(Iint)
+        pair = (b[1:]==b[:-1]) & (f[1:]==f[:-1]+1) & np.isin(b,ib)[:-1]
+        h = Sw[1:]-Sw[:-1]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            dI  = (I[1:]-I[:-1])/h
+            d2I = np.nan_to_num(abs(2*(dI[1:]-dI[:-1])/(h[1:]+h[:-1])))*(pair[1:] & pair[:-1])
+        d2 = np.zeros(h.size)
+        d2[1:]  = d2I
+        d2[:-1] = np.maximum(d2[:-1],d2I)
+        err   = abs(h)**3/12*d2
+        j = f[:-1][pair & (err>tol*Ib[b[:-1]])]
+        #### where the beams enter and leave the excitation error range |Sw|<Smax
+        single = np.hstack([True,~pair]) & np.hstack([~pair,True])
+        first  = np.hstack([True,~pair]) & np.isin(b,ib) & (f>0)
+        last   = np.hstack([~pair,True]) & np.isin(b,ib) & (f<self.n_simus-1)
+        Smax   = getattr(self.load(0),'Smax',abs(Sw).max())
+        edge   = (I*np.maximum(Smax-abs(Sw),0)>tol*Ib[b]) | single
+        j = np.unique(np.hstack([j,f[first & edge]-1,f[last & edge],self._get_crossings(Imin,iZ)]))
+        u = self.uvw
+        dt = np.arccos(np.clip((u[j]*u[j+1]).sum(axis=1),-1,1))
+        return j[dt>dmin]
+
+    def _get_crossings(self,Imin,iZ):
+        """frames j such that a strong beam crosses the Ewald sphere between frames j and j+1
+        with a central peak not resolved (kinematic prediction so that beams not excited at j or j+1 are included)"""
+        b0 = self.load(0)
+        if not all([hasattr(b0,k) for k in ['lat_vec','k0','Nmax']]):
+            return np.array([],dtype=int)
+        lat_vec,k0,Nmax = b0.lat_vec,b0.k0,b0.Nmax
+        z = self._get_z()[0][iZ]
+        #### |dSw/dtheta|<=|q|
+        qmax = Nmax*np.linalg.norm(lat_vec,axis=1).sum()
+        u,j = self.uvw,[]
+        for i in range(self.n_simus-1):
+            dt = np.arccos(np.clip(u[i].dot(u[i+1]),-1,1))
+            um = (u[i]+u[i+1])/np.linalg.norm(u[i]+u[i+1])
+            hkl,q = ut.get_shell_lattice(k0*um,lat_vec,qmax*dt,Nmax)
+            q = np.array(q).T
+            Sw0 = (k0**2-((k0*u[i]  +q)**2).sum(axis=1))/(2*k0)
+            Sw1 = (k0**2-((k0*u[i+1]+q)**2).sum(axis=1))/(2*k0)
+            #### the central peak of width ~1/z is sampled at least every 1/(4z)
+            cross = (Sw0*Sw1<0) & (abs(Sw1-Sw0)*z>0.25)
+            if cross.any() and hasattr(b0,'get_Ug'):
+                #### kinematic intensity at the Bragg condition
+                Ug = b0.get_Ug(np.array(hkl).T[cross])
+                cross = (np.pi/k0*abs(Ug)*z)**2>=Imin
+            if cross.any():j.append(i)
+        return np.array(j,dtype=int)
+
+    def _insert_frames(self,Simu,uvw,j,tag):
+        """solves orientations uvw and inserts them after frames j"""
+        n0 = self.n_simus
+        dfs = dict(enumerate(self._get_frame_dfs()))
+        store = self._get_store()
+        def add_frame(i,sim_obj):
+            store.append(n0+i,sim_obj)
+            dfs[n0+i] = sim_obj.df_G
+        df = ut.sweep_var(Simu,params='u',vals=uvw,tag=tag,path=self.path,
+            callback=add_frame,nproc=self._get_nproc(),**self.Sargs)
+
+        #### renumber the frames along the path
+        order = np.argsort(np.hstack([np.arange(n0),j+0.5]),kind='stable')
+        frames = np.zeros(order.size,dtype=int)
+        frames[order] = np.arange(order.size)
+        store.renumber(frames)
+        self.df  = pd.concat([self.df,df]).iloc[order]
+        self.uvw = np.vstack([self.uvw,uvw])[order]
+        self.n_simus  = order.size
+        self.ts       = np.arange(self.n_simus)
+        self.df['ts'] = self.ts
+        self.Iz_dyn,self.Iz_kin = {},{}
+        self.__dict__.pop('df_int',None)
+        self.clear_cache()
+        self._build_index([dfs[i] for i in order])
+
+    def _get_frame_dfs(self):
+        """the df_G columns kept in df_frames for each frame"""
+        if not 'df_frames' in self.__dict__:self._build_index()
+        df = self.df_frames
+        df = df.iloc[np.lexsort((df.iG.values,df.frame.values))]
+        df.index = self.beams.index.values[df.beam.values]
+        df = df[[c for c in Rocking._index_cols if c in df.columns]]
+        n  = np.bincount(self.df_frames.frame.values,minlength=self.df.shape[0])
+        i0 = np.hstack([0,np.cumsum(n)[:-1]])
+        return [df.iloc[i:i+m] for i,m in zip(i0,n)]
+
+
+class RockStore:
+    """Consolidated on-disk store of the rocking curves
+
+    The beams of each frame are appended as the frames are done into :
+
+    - rock_<tag>_rows.bin   : frame, row iG in df_G, h,k,l, Sw of each beam
+    - rock_<tag>_Iz.bin     : I(z) of each beam (float64, one row per beam)
+    - rock_<tag>_Iz_kin.bin : kinematic I(z) of each beam
+    - rock_<tag>_z.npy      : thicknesses
+
+    The intensities are memory mapped for reading.
+    If a frame is appended several times the last one is used.
+
+    Parameters
+    ----------
+    path
+        simulation folder
+    tag
+        tag of the rocking curve
+    """
+    rows_dtype = np.dtype([('frame','<i4'),('iG','<i4'),('h','<i4'),('k','<i4'),('l','<i4'),('Sw','<f8')])
+
+    def __init__(self,path:str,tag:str):
+        self.path = path
+        self.tag  = tag
+
+    def _file(self,name):
+        ext = {'z':'.npy'}.get(name,'.bin')
+        return os.path.join(self.path,'rock_%s_%s%s' %(self.tag,name,ext))
+
+    def exists(self):
+        return all([os.path.exists(self._file(f)) for f in ['rows','Iz','Iz_kin','z']])
+
+    def reset(self):
+        """remove the store"""
+        for f in ['rows','Iz','Iz_kin','z']:
+            if os.path.exists(self._file(f)):os.remove(self._file(f))
+        self.__dict__.pop('_rows',None)
+
+    def append(self,i:int,sim_obj):
+        """append the beams of simulation sim_obj as frame i"""
+        self.append_frame(i,*_get_frame(sim_obj)[1:])
+
+    def append_frame(self,i:int,hkl:np.ndarray,Sw:np.ndarray,Iz:np.ndarray,Iz_kin:np.ndarray,z:np.ndarray):
+        """append frame i (see :func:`_get_frame`)"""
+        if os.path.exists(self._file('z')):
+            if not np.array_equal(np.load(self._file('z')),z):
+                raise Exception('frame %d has different thicknesses than the store' %i)
+        else:
+            np.save(self._file('z'),z)
+
+        rows = np.zeros(hkl.shape[0],dtype=RockStore.rows_dtype)
+        rows['frame'],rows['iG'] = i,np.arange(hkl.shape[0])
+        rows['h'],rows['k'],rows['l'] = hkl.T
+        rows['Sw'] = Sw
+        #### intensities first so that the rows always refer to written intensities
+        for name,I in zip(['Iz','Iz_kin'],[Iz,Iz_kin]):
+            with open(self._file(name),'ab') as f:
+                f.write(np.ascontiguousarray(I,dtype='<f8').tobytes())
+        with open(self._file('rows'),'ab') as f:
+            f.write(rows.tobytes())
+
+    @property
+    def z(self):
+        return np.load(self._file('z'))
+
+    def get_rows(self):
+        """the rows (frame,iG,h,k,l,Sw) of all the beams"""
+        size = os.path.getsize(self._file('rows'))
+        rows = self.__dict__.get('_rows')
+        if not rows or not rows[0]==size:
+            self._rows = (size,np.fromfile(self._file('rows'),dtype=RockStore.rows_dtype))
+        return self._rows[1]
+
+    def _get_appends(self):
+        """index of the append of each row and last append of each frame"""
+        rows  = self.get_rows()
+        frame = rows['frame']
+        start = np.hstack([True,(frame[1:]!=frame[:-1]) | (rows['iG'][1:]==0)])
+        run   = np.cumsum(start)-1
+        last  = -np.ones(frame.max()+1,dtype=int)
+        np.maximum.at(last,frame,run)
+        return start,run,last
+
+    def get_offsets(self,frames:Optional[Sequence[int]]=None):
+        """index of the first row of each frame (of its last append)
+
+        Parameters
+        ----------
+        frames
+            frames requested (KeyError if one of them is not in the store).
+            If None the offsets of frames 0..max are returned with -1 for the absent frames.
+        """
+        frame = self.get_rows()['frame']
+        start,run,last = self._get_appends()
+        start &= run==last[frame]
+        offsets = -np.ones(frame.max()+1,dtype=int)
+        offsets[frame[start]] = np.where(start)[0]
+        if frames is None:return offsets
+        frames = np.asarray(frames,dtype=int)
+        absent = (frames<0) | (frames>=offsets.size)
+        absent[~absent] = offsets[frames[~absent]]<0
+        if absent.any():
+            raise KeyError('frames not in the store : %s' %str(np.unique(frames[absent])))
+        return offsets[frames]
+
+    def renumber(self,frames:np.ndarray,chunk:int=2**16):
+        """renumbers frame i as frames[i]
+        (the rows are reordered by frame and only the last append of each frame is kept)"""
+        rows  = self.get_rows()
+        start,run,last = self._get_appends()
+        keep  = np.where(run==last[rows['frame']])[0]
+        new   = np.asarray(frames)[rows['frame'][keep]]
+        order = keep[np.argsort(new,kind='stable')]
+        new   = np.sort(new,kind='stable')
+        nzs   = self.z.size
+        for name in ['Iz','Iz_kin']:
+            I   = np.memmap(self._file(name),dtype='<f8',mode='r',shape=(rows.size,nzs))
+            tmp = self._file(name)+'.tmp'
+            with open(tmp,'wb') as f:
+                for i in range(0,order.size,chunk):
+                    f.write(np.ascontiguousarray(I[order[i:i+chunk]]).tobytes())
+            del I
+            os.replace(tmp,self._file(name))
+        rows = rows[order]
+        rows['frame'] = new
+        tmp = self._file('rows')+'.tmp'
+        rows.tofile(tmp)
+        os.replace(tmp,self._file('rows'))
+        self.__dict__.pop('_rows',None)
+
+    def get_Iz(self,idx,iZs=slice(None),kin:bool=False):
+        """I(z) of rows idx (at thicknesses iZs)"""
+        nrows,nzs = self.get_rows().size,self.z.size
+        Iz = np.memmap(self._file(['Iz','Iz_kin'][kin]),dtype='<f8',mode='r',shape=(nrows,nzs))
+        return np.array(Iz[idx][:,iZs])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_rows',None)
+        return state
+
+def integrate_rocking(I:np.ndarray,Sw:np.ndarray,beam:np.ndarray,nbeams:Optional[int]=None):
+    """Integrates the rocking curves of all beams over the excitation error
+
+    The integral over Sw of the intensity is the Lorentz corrected integrated intensity.
+
+    Parameters
+    ----------
+    I
+        (nrows x nzs) intensities of the beams at each frame
+        with the rows of each beam contiguous and ordered by frame (as in :attr:`Rocking.df_frames`)
+    Sw
+        (nrows) excitation errors
+    beam
+        (nrows) beam number of each row
+    nbeams
+        number of beams (default beam.max()+1)
+
+    Returns
+    -------
+    np.ndarray
+        (nbeams x nzs) integrated intensities (the intensity itself for beams seen in a single frame).
+        The sign is such that the integrals are positive for Sw monotonous.
+    """
+    I = np.atleast_2d(I.T).T
+    if nbeams is None:nbeams = beam.max()+1
+    Iint = np.zeros((nbeams,)+I.shape[1:])
+    #### trapezes between consecutive frames of the same beam
+    same = beam[1:]==beam[:-1]
+    ipairs = np.where(same)[0]
+    single = np.hstack([True,~same]) & np.hstack([~same,True])
+    Iint[beam[single]] = I[single]
+    if ipairs.size:
+        b   = beam[ipairs]
+        dSw = Sw[ipairs+1]-Sw[ipairs]
+        start = np.hstack([True,b[1:]!=b[:-1]])
+        sums  = np.add.reduceat(0.5*(I[ipairs]+I[ipairs+1])*dSw[:,None],np.where(start)[0],axis=0)
+        Iint[b[start]] = np.sign(dSw[start])[:,None]*sums
+    return Iint
+
+def _get_frame(sim_obj):
+    """what the rocking curve keeps from a simulation :
+    df_G (index columns only),hkl,Sw,Iz,Iz_kin,z
+    """
+    df_G = sim_obj.df_G
+    Iz,Iz_kin = getattr(sim_obj,'Iz',None),getattr(sim_obj,'Iz_kin',None)
+    if isinstance(Iz,np.ndarray):
+        z = np.array(sim_obj.z,dtype=float)
+    else:
+        z  = np.array([sim_obj.thick],dtype=float)
+        Iz = df_G[['I']].values
+    if not isinstance(Iz_kin,np.ndarray) or not Iz_kin.shape==Iz.shape:
+        Iz_kin = np.zeros(Iz.shape)
+    cols = [c for c in Rocking._index_cols if c in df_G.columns]
+    return df_G[cols],df_G[['h','k','l']].values,df_G.Sw.values.real,Iz,Iz_kin,z
+
+def _apply(sim_obj,f,args):
+    if isinstance(f,str):return sim_obj.__getattribute__(f)(**args)
+    return f(sim_obj,**args)
+
+def _do_frame(pkl,f,args,v):
+    """worker of :meth:`~Rocking.do`"""
+    sim_obj = ut.load_pkl(pkl)
+    sim_obj.__getattribute__(f)(**args)
+    sim_obj.save(v=v)
+    return _get_frame(sim_obj)
+
+def _map_frame(pkl,f,args):
+    """worker of :meth:`~Rocking.map`"""
+    return _apply(ut.load_pkl(pkl),f,args)
 
+def _sizeof(obj):
+    """approximate memory (bytes) held by the arrays and dataframes of obj"""
+    size = 0
+    for v in obj.__dict__.values():
+        if isinstance(v,np.ndarray):size+=v.nbytes
+        elif isinstance(v,pd.DataFrame):size+=v.memory_usage(index=False).sum()
+    return size
 
 def rock_name(path,tag):
     return os.path.join(path,'rock_%s.pkl' %(tag))
@@ -0,0 +1,102 @@
+"""Persistent cache of parsed crystals and structure factors
+
+Entries are keyed by the content hash of the structure file and the
+parameters of the computation. They are kept in memory (LRU) and on disk
+in `cache_dir` (environment variable ED_CACHE, default ~/.cache/ccp4ED).
+"""
+import os,hashlib,pickle5,collections
+import numpy as np
+from utils import glob_colors as colors
+from scattering import structure_factor as sf
+from . import utilities as ut
+
+cache_dir = os.environ.get('ED_CACHE',os.path.join(os.path.expanduser('~'),'.cache','ccp4ED'))
+maxsize   = 16      #number of entries kept in memory
+enabled   = True
+_lru      = collections.OrderedDict()
+
+def content_hash(file:str):
+    """sha1 of the content of file (or of its name for builtin structures)"""
+    h = hashlib.sha1()
+    if os.path.isfile(file):
+        with open(file,'rb') as f:
+            for chunk in iter(lambda:f.read(1<<20),b''):h.update(chunk)
+    else:
+        h.update(file.encode())
+    return h.hexdigest()
+
+def get_key(file:str,f:str,**params):
+    """key for computation f with parameters params on structure file"""
+    params_str = repr([(k,hashlib.sha1(v.tobytes()).hexdigest() if isinstance(v,np.ndarray) else v)
+        for k,v in sorted(params.items())])
+    return hashlib.sha1((content_hash(file)+f+params_str).encode()).hexdigest()
+
+def cached(key:str,f,*args,disk:bool=True,**kwargs):
+    """returns f(*args,**kwargs) from the memory cache, the disk cache or computes it
+
+    .. note::
+        cached values are shared so they should not be modified in place
+        (unless disk=False in which case the value only lives in memory)
+    """
+    if not enabled:return f(*args,**kwargs)
+    if key in _lru:
+        _lru.move_to_end(key)
+        return _lru[key]
+
+    file = os.path.join(cache_dir,key+'.pkl')
+    if not disk:
+        val = f(*args,**kwargs)
+    elif os.path.exists(file):
+        with open(file,'rb') as fp:val = pickle5.load(fp)
+    else:
+        val = f(*args,**kwargs)
+        if not os.path.exists(cache_dir):os.makedirs(cache_dir,exist_ok=True)
+        tmp = '%s.%d' %(file,os.getpid())
+        with open(tmp,'wb') as fp:
+            pickle5.dump(val,fp,pickle5.HIGHEST_PROTOCOL)
+        os.replace(tmp,file)
+
+    _lru[key] = val
+    while len(_lru)>maxsize:_lru.popitem(last=False)
+    return val
+
+def clear(disk:bool=False):
+    """clear the memory cache (and the disk cache if disk)"""
+    _lru.clear()
+    if disk and os.path.exists(cache_dir):
+        for f in os.listdir(cache_dir):
+            if f.endswith('.pkl'):os.remove(os.path.join(cache_dir,f))
+        print(colors.green+'cache cleared : '+colors.yellow+cache_dir+colors.black)
+
+################################################################################
+#### cached functions
+################################################################################
+def import_crys(file:str):
+    """cached :func:`~EDutils.utilities.import_crys`"""
+    return cached(get_key(file,'import_crys'),ut.import_crys,file)
+
+def structure_factor3D(file:str,pattern,lat_vec,**sf_args):
+    """cached :func:`~scattering.structure_factor.structure_factor3D`
+
+    Parameters
+    ----------
+    file
+        structure file from which pattern and lat_vec are derived
+    pattern,lat_vec,sf_args
+        passed to structure_factor3D
+    """
+    key = get_key(file,'structure_factor3D',pattern=np.asarray(pattern),lat_vec=np.asarray(lat_vec),**sf_args)
+    return cached(key,sf.structure_factor3D,pattern,lat_vec,**sf_args)
+
+def Fhkl_store(file:str,pattern,lat_vec,hklMax:int):
+    """:class:`~scattering.structure_factor.Fhkl_store` shared in memory
+
+    The store is filled on demand so it is only kept in memory
+    and every object using the same structure benefits from the already computed reflections.
+    """
+    key = get_key(file,'Fhkl_store',hklMax=hklMax,pattern=pattern,lat_vec=np.array(lat_vec))
+    return cached(key,sf.Fhkl_store,pattern,lat_vec,hklMax,disk=False)
+
+def gemmi_sf(pdb_file:str,dmin:float=2):
+    """cached :func:`~EDutils.utilities.gemmi_sf`"""
+    return cached(get_key(pdb_file,'gemmi_sf',dmin=dmin),ut.gemmi_sf,pdb_file,dmin)
@@ -1,17 +1,19 @@
 import importlib as imp
-import tifffile,os,glob,pickle5,subprocess,crystals
+import tifffile,os,glob,pickle5,subprocess,crystals,hashlib,concurrent.futures,collections
 import numpy as np,pandas as pd
 from typing import TYPE_CHECKING, Dict, Iterable, Optional, Sequence, Union
 from crystals import Crystal
 from utils import displayStandards as dsp   #;imp.reload(dsp)
 from utils import glob_colors as colors     #;imp.reload(colors)
+from scattering import structure_factor as sf
 # from utils import handler3D as h3D          #;imp.reload(h3D)
 # from . import rotate_exp as exp ;imp.reload(exp)
 import gemmi
 
 def sweep_var(Simu:object,
         params:Sequence[str],vals:Sequence[Sequence],
-        tag:str='',path:str='',
+        tag:str='',path:str='',sweep:bool=False,
+        callback=None,nproc:int=1,resume:bool=False,
         **kwargs,
     ):
     """runs a set of similar simulations Simu with a varying parameter
@@ -28,13 +30,28 @@ def sweep_var(Simu:object,
         Name prefix of simulations
     path
         path to the simulations folder
+    sweep
+        solve all orientations with a single simulator (params='u' with Simu=Bloch only, see :meth:`~blochwave.bloch.Bloch.solve_sweep`)
+    callback
+        function called as callback(i,sim_obj) once simulation i is done
+        (in the main process, frames may come in any order if nproc>1)
+    nproc
+        number of worker processes (with sweep=True each worker sweeps a block of orientations).
+        Consider limiting the BLAS threads of each worker (OMP_NUM_THREADS)
+    resume
+        skip the simulations already done according to the manifest path/df_<tag>.manifest
     kwargs
-        arguments passed to Simu
+        arguments passed to Simu (with sweep, order and tol are passed to solve_sweep)
 
     Returns
     -------
         pd.DataFrame
             info about the set of simulations with params pkl
+
+    .. note::
+        Each simulation is recorded in the manifest as soon as it is saved
+        so an interrupted sweep can be restarted with resume=True.
+        Simu must save its simulations (and be picklable if nproc>1).
     """
     if not os.path.exists(path):
         print('creating directory:',path)
@@ -51,25 +68,110 @@ def sweep_var(Simu:object,
 
     if not len(params)==len(vals[0]):
         raise Exception('len(params)=%d but it must equal len(vals[0])=%d' %(len(params),len(vals[0])))
+    if sweep and not params==['u']:
+        raise Exception('sweep mode only available for params=u but params=%s' %str(params))
 
     cols = params+['pkl']
     df = pd.DataFrame(columns=cols)#+pp.info_cols)
 
     nsimus = len(vals)
     pad = int(np.ceil(np.log10(nsimus)))
-    for i,val in enumerate(vals):
-        kwargs.update(dict(zip(params,val)))
-        name = '%s_%s%s' %('-'.join(params),tag,str(i).zfill(pad))
-        sim_obj = Simu(path=path,name=name,**kwargs)
+    names = ['%s_%s%s' %('-'.join(params),tag,str(i).zfill(pad)) for i in range(nsimus)]
+
+    #### manifest
+    manifest = os.path.join(path,'df_%s.manifest' %tag)
+    key  = _sweep_key(Simu,params,vals,sweep,kwargs)
+    pkls = _read_manifest(manifest,key) if resume else {}
+    if pkls:
+        print(colors.blue+'resuming sweep %s : %d/%d done' %(tag,len(pkls),nsimus)+colors.black)
+    with open(manifest,'w') as f:
+        f.write(''.join(['#%s\n' %key]+['%d %s\n' %(i,pkl) for i,pkl in sorted(pkls.items())]))
+    if callback:
+        for i in sorted(pkls):callback(i,load_pkl(pkls[i]))
+    todo = [i for i in range(nsimus) if not i in pkls]
+
+    #### run
+    args_i = lambda i:dict(kwargs,**dict(zip(params,vals[i])))
+    if sweep:
+        blocks = [b for b in np.array_split(todo,max(min(nproc,len(todo)),1)) if b.size]
+        run = lambda b,cb:(_run_sweep,Simu,path,[names[i] for i in b],[vals[i][0] for i in b],
+            kwargs,manifest,b,cb)
+    else:
+        blocks = [[i] for i in todo]
+        run = lambda b,cb:(_run_simu,Simu,path,names[b[0]],args_i(b[0]),manifest,b[0],cb)
+
+    if nproc<=1:
+        for b in blocks:
+            f,*args = run(b,callback)
+            pkls.update(zip(b,f(*args)))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as pool:
+            futures = {}
+            for b in blocks:
+                f,*args = run(b,None)
+                futures[pool.submit(f,*args)] = b
+            for future in concurrent.futures.as_completed(futures):
+                b = futures[future]
+                pkls.update(zip(b,future.result()))
+                if callback:
+                    for i in b:callback(i,load_pkl(pkls[i]))
+
+    for i,(name,val) in enumerate(zip(names,vals)):
         df.loc[name,cols] = ''
-        # df.loc[name,cols] = list(val)+[sim_obj._get_pkl()]
         df.loc[name,params] = list(val)
-        df.loc[name,'pkl']  = sim_obj._get_pkl()
+        df.loc[name,'pkl']  = pkls[i]
     df_file = os.path.join(path,'df_%s.pkl' %tag)
     df.to_pickle(df_file)
     print(colors.green+'Dataframe saved : '+colors.yellow+df_file+colors.black)
     return df
 
+def _run_simu(Simu,path,name,kwargs,manifest,i,callback=None):
+    """runs simulation i of sweep_var"""
+    sim_obj = Simu(path=path,name=name,**kwargs)
+    pkl = sim_obj._get_pkl()
+    _add_to_manifest(manifest,i,pkl)
+    if callback:callback(i,sim_obj)
+    return [pkl]
+
+def _run_sweep(Simu,path,names,uvw,kwargs,manifest,idx,callback=None):
+    """solves the orientations uvw (simulations idx of sweep_var) with a single simulator"""
+    sweep_args = {k:kwargs[k] for k in ['Smax','thick','thicks','order','tol'] if k in kwargs}
+    sim_args = {k:v for k,v in kwargs.items() if not k in ['order','tol']}
+    sim_args.update({'u':uvw[0],'solve':False})
+    sim_obj = Simu(path=path,name=names[0],**sim_args)
+    sweep_args['opts'] = kwargs.get('opts','')+'s'
+    def done(j,obj):
+        _add_to_manifest(manifest,idx[j],obj._get_pkl())
+        if callback:callback(idx[j],obj)
+    return sim_obj.solve_sweep(uvw=uvw,names=names,callback=done,**sweep_args)
+
+def _sweep_key(Simu,params,vals,sweep,kwargs):
+    """identifies a sweep so that a manifest is not resumed with different settings"""
+    h = hashlib.sha1(repr([Simu.__name__,params,sweep]).encode())
+    try:
+        h.update(pickle5.dumps([vals,sorted(kwargs.items())],protocol=pickle5.HIGHEST_PROTOCOL))
+    except Exception:
+        h.update(repr([vals,sorted(kwargs.items())]).encode())
+    return h.hexdigest()
+
+def _add_to_manifest(manifest,i,pkl):
+    # single small appends so that workers can write concurrently
+    with open(manifest,'a') as f:f.write('%d %s\n' %(i,pkl))
+
+def _read_manifest(manifest,key):
+    """simulations done {i:pkl} according to the manifest (empty if it belongs to another sweep)"""
+    if not os.path.exists(manifest):return {}
+    with open(manifest,'r') as f:lines = f.read().split('\n')
+    if not lines[0]=='#%s' %key:
+        print(colors.red+'warning : manifest %s belongs to another sweep, starting over' %manifest+colors.black)
+        return {}
+    done = {}
+    for line in lines[1:]:
+        if ' ' in line:
+            i,pkl = line.split(' ',1)
+            if os.path.exists(pkl):done[int(i)] = pkl
+    return done
+
 def get_pkl(file=None,path='',name='unkown.pkl'):
     if not file:
         file=os.path.join(path,name+'.pkl')
@@ -431,6 +533,47 @@ def import_crys(file:str=''):
     print(colors.green+'imported file : '+colors.yellow+file+colors.black)
     return crys
 
+def sliding_sum(ims:Iterable,n:int,nframes:int,frames:Sequence[int]=None):
+    """Streaming sum of images by windows of n frames
+
+    The window of summed frame i covers the frames i*n-n//2 to i*n+n//2.
+    A running sum is kept so that each image is added once when it comes in
+    and subtracted once when it leaves the window.
+
+    Parameters
+    ----------
+    ims
+        iterable of (j,im) in increasing frame order j (can be a generator
+        reading or rendering the images on the fly)
+    n
+        number of frames per summed frame
+    nframes
+        total number of frames
+    frames
+        (i_init,i_end) range of summed frames (inclusive)
+
+    Yields
+    ------
+    i,im
+        summed frame index and summed image (divided by n)
+    """
+    n2 = n//2
+    i_max = (nframes-1+n2)//n
+    if not frames:frames=(0,i_max)
+    i,i_end = max(0,frames[0]),min(frames[1],i_max)
+    window,im_sum = collections.deque(),None
+    for j,im in ims:
+        if i>i_end:break
+        if j<i*n-n2:continue
+        if im_sum is None:im_sum = np.zeros(im.shape)
+        window.append((j,im))
+        im_sum += im
+        while i<=i_end and j>=min(nframes-1,i*n+n2):
+            while window[0][0]<i*n-n2:
+                im_sum -= window.popleft()[1]
+            yield i,im_sum/n
+            i+=1
+
 def convert2tiff(tiff_file,im0,n0=0,rot=0,n=256,Imax=5e4):
     '''
     used to rotate a multislice image to a standard pets tiff file image
@@ -484,6 +627,65 @@ def get_lattice2D(lat_vec,Nmax=5):
     qz = h*a1[1]+k*b1[1]
     return (h,k),(qx,qz)
 
+def get_ewald_shell(K,lat_vec,Smax=0.02,Nmax=5,dmin=None,chunk=2**20):
+    '''Generates by chunks the lattice points close to the Ewald sphere :
+    - K       : reciprocal space beam vector (sphere of radius |K| centred at -K)
+    - lat_vec : reciprocal lattice vectors
+    - Smax    : half thickness of the shell abs(|K+q|-|K|)<=Smax
+    - Nmax    : max order in each direction
+    - dmin    : resolution limit |q|<=1/dmin
+    - chunk   : approximate max number of points per chunk
+    yields (h,k,l),(qx,qy,qz) in the same order as get_lattice
+
+    For each column (h,k) the range of l intersecting the shell is obtained
+    from the 2 spheres bounding the shell so that only the points
+    within the shell are ever generated.
+    '''
+    K = np.array(K,dtype=float)
+    K0 = np.linalg.norm(K)
+    a1,b1,c1 = np.array(lat_vec,dtype=float)
+    N = np.arange(-Nmax,Nmax+1)
+    h,k = [i.flatten() for i in np.meshgrid(N,N)]
+    P = K+np.outer(h,a1)+np.outer(k,b1)
+    c2,Pc,P2 = c1.dot(c1),P.dot(c1),(P**2).sum(axis=1)
+    def l_range(r):
+        sD = np.sqrt(np.maximum(Pc**2-c2*(P2-r**2),0))
+        return (-Pc-sD)/c2,(-Pc+sD)/c2
+    eps = 1e-9*K0
+    lo1,hi1 = l_range(K0+Smax+eps)
+    lo2,hi2 = l_range(max(K0-Smax-eps,0))
+    #### the 2 segments of each column on both sides of the inner sphere
+    l0  = np.stack([np.ceil(lo1),np.maximum(np.ceil(hi2),np.floor(lo2)+1)],axis=1)
+    l1  = np.stack([np.floor(lo2),np.floor(hi1)],axis=1)
+    l0,l1 = np.maximum(l0,-Nmax).flatten(),np.minimum(l1,Nmax).flatten()
+    nl  = np.maximum(l1-l0+1,0).astype(int)
+    col = np.repeat(np.arange(h.size),2)
+    cum = np.hstack([0,np.cumsum(nl)])
+    i0  = 0
+    while i0<nl.size:
+        i1 = max(np.searchsorted(cum,cum[i0]+chunk,side='right')-1,i0+1)
+        n  = nl[i0:i1]
+        ci = np.repeat(col[i0:i1],n)
+        l  = np.repeat(l0[i0:i1],n)+np.arange(n.sum())-np.repeat(cum[i0:i1]-cum[i0],n)
+        hi,ki,li = h[ci],k[ci],l.astype(int)
+        qx,qy,qz = np.outer(hi,a1).T+np.outer(ki,b1).T+np.outer(li,c1).T
+        if dmin:
+            idx = qx**2+qy**2+qz**2<=1/dmin**2
+            hi,ki,li,qx,qy,qz = hi[idx],ki[idx],li[idx],qx[idx],qy[idx],qz[idx]
+        i0 = i1
+        if hi.size:
+            yield (hi,ki,li),(qx,qy,qz)
+
+def get_shell_lattice(K,lat_vec,Smax=0.02,Nmax=5,dmin=None):
+    '''All the lattice points of the Ewald shell (see get_ewald_shell)
+    returns (h,k,l),(qx,qy,qz) as get_lattice
+    '''
+    hkl,q = [np.zeros((3,0),dtype=int)],[np.zeros((3,0))]
+    for hkl_i,q_i in get_ewald_shell(K,lat_vec,Smax,Nmax,dmin):
+        hkl+=[np.array(hkl_i)]
+        q+=[np.array(q_i)]
+    return tuple(np.hstack(hkl)),tuple(np.hstack(q))
+
 def get_ewald(K,nts=100,nps=200):
     ''' Get ewald sphere coordinates
     - K : reciprocal space beam vector
@@ -506,7 +708,10 @@ def get_excitation_errors(K,lat_vec,Nmax=5,Smax=0.02):
     K0 = np.linalg.norm(K)
     Kx,Ky,Kz = K
 
-    (h,k,l),(qx,qy,qz) = get_lattice(lat_vec,Nmax)
+    if Smax:
+        (h,k,l),(qx,qy,qz) = get_shell_lattice(K,lat_vec,Smax,Nmax)
+    else:
+        (h,k,l),(qx,qy,qz) = get_lattice(lat_vec,Nmax)
 
     # Sw = np.abs(np.sqrt((Kx-qx)**2+(Ky-qy)**2+(Kz-qz)**2) - K0)
     Sw = np.abs(np.sqrt((Kx+qx)**2+(Ky+qy)**2+(Kz+qz)**2) - K0)
@@ -528,7 +733,7 @@ def get_structure_factor(cif_file,dfout=0,**sf_args):
     crys = import_crys(cif_file)
     pattern = np.array([np.hstack([a.coords_fractional,a.atomic_number]) for a in crys.atoms] )
     lat_vec = np.array(crys.reciprocal_vectors)
-    (h,k,l),Fhkl = structure_factor3D(pattern, lat_vec, **sf_args)
+    (h,k,l),Fhkl = sf.structure_factor3D(pattern, lat_vec, **sf_args)
     qx = h/crys.lattice_parameters[0]
     qy = k/crys.lattice_parameters[1]
     qz = l/crys.lattice_parameters[2]
@@ -541,18 +746,10 @@ def get_structure_factor(cif_file,dfout=0,**sf_args):
 
 def get_excited_beams(cif_file,K,lat_vec,Nmax,Smax):
     df_Sw   = get_excitation_errors(K,lat_vec,Nmax,Smax)
-    df_Fhkl = get_structure_factor(cif_file,dfout=1,hklMax=Nmax+1)
-
-    hkl0 = df_Sw[['h','k','l']].values
-    hklF = df_Fhkl[['h','k','l']].values
-    ridx = []
-    for r in hkl0:
-        idx = np.where(np.linalg.norm(r-hklF,axis=1)==0)[0]
-        if idx.size:
-            ridx+=[idx[0]]
-
-    Fhkl_0 = df_Fhkl.iloc[ridx]['Fhkl'].values #;print(df_Fhkl.iloc[ridx]);#print(ridx);print(df_Fhkl.shape)
-    df_Sw['Fhkl'] = Fhkl_0
+    crys    = import_crys(cif_file)
+    pattern = np.array([np.hstack([a.coords_fractional,a.atomic_number]) for a in crys.atoms] )
+    df_Sw['Fhkl'] = sf.structure_factor_hkl(pattern,np.array(crys.reciprocal_vectors),
+        df_Sw[['h','k','l']].values)
     return df_Sw
 
 def get_kinematic_intensities(cif_file,K,thick,Nmax=5,Smax=None):
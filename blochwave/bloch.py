@@ -12,6 +12,7 @@ from scattering import structure_factor as sf       #;imp.reload(sf)
 from scattering import scattering_factors as scatf  #;imp.reload(scatf)
 from EDutils import viewers                         #;imp.reload(viewers)
 from EDutils import utilities as ut                 #;imp.reload(ut)
+from EDutils import sf_cache                        #;imp.reload(sf_cache)
 from EDutils import pets as pt                      ;imp.reload(pt)
 from EDutils import display as EDdisp               ;imp.reload(EDdisp)
 from . import util as bloch_util                    ;imp.reload(bloch_util)
@@ -45,9 +46,16 @@ class Bloch:
         Use felix solver
     nbeams
         Number of beams to use (using felix only)
+    save
+        save the object once constructed (also removes 's' from opts)
+    store
+        dictionary passed to :meth:`~Bloch.set_store`
     kwargs
         arguments to be passed to :meth:`~Bloch.solve`
     """
+    _arrays_keys    = ['H','CjG','invCjG','Sz','Iz','Iz_kin']
+    _arrays_version = 1
+
     def __init__(self,
         cif_file:str,name:str='',path:str='',
         beam:Optional[dict]={},keV:float=200,u:Sequence[float]=[0,0,1],
@@ -56,6 +64,7 @@ class Bloch:
         solve:bool=True,
         felix:bool=False,nbeams:int=200,
         eps:float=1,
+        save:bool=True,store:dict={},
         **kwargs,
     ):
         self.solved = False
@@ -63,6 +72,7 @@ class Bloch:
         self.thick  = 100
         self.thicks = self._set_thicks((0,1000,1000))
         self.eps=eps
+        self.set_store(**store)
 
         self._set_structure(cif_file)
         beam_args={'keV':keV,'u':u}
@@ -72,6 +82,7 @@ class Bloch:
         self.nbeams=nbeams
 
         if solve :
+            if not save:kwargs['opts']=kwargs.get('opts','sv0').replace('s','')
             self.solve(Smax=Smax,Nmax=Nmax,dmin=dmin,**kwargs)
         else:
             if not felix:
@@ -81,7 +92,7 @@ class Bloch:
                 self._set_excitation_errors(Smax)
                 print(colors.blue+'...Vg... '+colors.black)
                 self._set_Vg()
-        self.save()
+        if save:self.save()
 
         # if show_thicks or 't' in opts:
         #     self.show_beams_vs_thickness(strong=['I'])
@@ -127,7 +138,7 @@ class Bloch:
         """
 
         if dmin and self.pdb_file:
-            self.hklF,self.Fhkl = ut.gemmi_sf(self.pdb_file,dmin)
+            self.hklF,self.Fhkl = sf_cache.gemmi_sf(self.pdb_file,dmin)
             self.Nmax=np.array(self.Fhkl.shape[0])//4#.min()
             print('Nmax:',self.Nmax)
             # gemmi='/home/tarik/Documents/git/github/gemmi/gemmi'
@@ -149,10 +160,9 @@ class Bloch:
                     self.Nmax=Nmax
                     idx = [i for i,x in enumerate(self.pattern[:,:3]) if all(x<0.99)]
                     self.pattern=self.pattern[idx,:]
-                    self.hklF,self.Fhkl = sf.structure_factor3D(self.pattern,
-                        2*np.pi*self.lat_vec,hklMax=2*self.Nmax)
-        (h,k,l),(qx,qy,qz) = ut.get_lattice(self.lat_vec,self.Nmax)
-        self.lattice = [(h,k,l),(qx,qy,qz)]
+                    self.hklF = None
+                    self.Fhkl = sf_cache.Fhkl_store(self.cif_file,
+                        self.pattern,2*np.pi*self.lat_vec,hklMax=2*self.Nmax)
 
     def set_beam(self,
         keV:float=200,
@@ -221,6 +231,7 @@ class Bloch:
         opts:str='sv0',
         felix:bool=False,
         nbeams:int=None,
+        bethe:Optional[dict]=None,
     ):
         """ Diagonalize the Blochwave matrix
 
@@ -246,6 +257,10 @@ class Bloch:
             use felix solver
         nbeams
             Number of beams when using felix solver
+        bethe
+            dict passed to :meth:`~Bloch._set_bethe`. If not empty, only strong beams are
+            included in the Bloch matrix and weak beams are included as Bethe potentials.
+            Use an empty dict to revert to the full solve.
 
         .. note ::
 
@@ -260,9 +275,13 @@ class Bloch:
         else:
             if Nmax or dmin :self.update_Nmax(Nmax,dmin)
             if beam : self.set_beam(**beam)
+            if isinstance(bethe,dict):
+                self.bethe = bethe
+                if not (Smax or isinstance(hkl,np.ndarray)):Smax=self.Smax
             if Smax or isinstance(hkl,np.ndarray):
                 self._set_excitation_errors(Smax,hkl)
                 self._set_Vg()
+                if self.__dict__.get('bethe'):self._set_bethe(**self.bethe)
             self._solve_Bloch(show_H='H' in opts,Vopt0='0' in opts,v='v' in opts,
                 dyngo_args=dyngo_args)
         ##### postprocess
@@ -283,6 +302,228 @@ class Bloch:
             self._set_Vg()
         self.save()
 
+    def solve_sweep(self,
+        uvw:Sequence[Sequence[float]],
+        names:Sequence[str],
+        Smax:Optional[float]=None,
+        thick:float=None,thicks:Sequence[float]=None,
+        opts:str='s',
+        v:bool=False,
+        callback=None,
+        order:int=0,tol:float=1e-2,
+    ):
+        """Solve a series of orientations reusing the Ug(g-h) block
+
+        The beams excited (abs(Sw)<Smax) in any of the orientations are
+        gathered once into a superset for which the Ug(g-h) block is
+        computed only once. For each frame only the excitation errors
+        are updated and the active sub-block is diagonalized.
+
+        Parameters
+        ----------
+        uvw
+            beam orientations (nframes x 3)
+        names
+            names of each frame (the simulations are saved as path+name+'.pkl')
+        Smax
+            maximum excitation error of the active beams in each frame
+        thick
+            thickness of crystal
+        thicks
+            range of thickness [z_min,z_max,z_step]
+        opts
+            s(save) t(set thickness) z(beams vs thickness)
+        v
+            verbose
+        callback
+            function called as callback(i,self) once frame i is solved
+        order
+            if >0, frames are obtained as perturbative updates of order `order`
+            of the last full solve (see :meth:`~Bloch.solve_perturbative`).
+            All the beams of the superset are then kept in each frame.
+        tol
+            error estimate above which a full solve is performed (order>0 only)
+
+        Returns
+        -------
+        list
+            pkl files of the frames
+        """
+        if Smax:self.Smax=Smax
+        self._set_sweep(uvw,self.Smax)
+        if not type(thicks)==type(None):self._set_thicks(thicks)
+        hkl = self._sweep['hkl']
+        self.__dict__.pop('_pert',None)
+        pkls = []
+        for i,(u,name) in enumerate(zip(uvw,names)):
+            self.name = name
+            if order:
+                self.solve_perturbative(u,order=order,tol=tol,hkl=hkl,v=v)
+            else:
+                self.set_beam(keV=self.keV,u=u)
+                self._set_excitation_errors(self.Smax,hkl=hkl)
+                self._set_Vg()
+                self._solve_Bloch(v=v)
+            if thick or 't' in opts:
+                self.set_thickness(thick)
+            if 'z' in opts:
+                self._set_beams_vs_thickness()
+            if 's' in opts:
+                self.save(v=v)
+            if callback:callback(i,self)
+            pkls.append(self._get_pkl())
+        return pkls
+
+    def solve_perturbative(self,
+        u:Sequence[float],
+        order:int=2,tol:float=1e-2,
+        hkl:Optional[np.ndarray]=None,
+        thick:float=None,
+        v:bool=False,
+    ):
+        """Solve orientation u as a perturbation of a reference solve
+
+        Between nearby orientations with the same beams, the Bloch matrix only
+        changes by the diagonal term 2*pi*dSw. The eigen decomposition
+        of the reference (last full solve) is updated to first or second order
+        so only matrix products are needed instead of a diagonalization.
+        If the estimated error is larger than tol, the full problem is solved
+        and becomes the new reference.
+
+        Parameters
+        ----------
+        u
+            beam orientation
+        order
+            1(update eigen values only) 2(also update eigen vectors)
+        tol
+            tolerance on the error estimate before a full solve is triggered
+        hkl
+            beams (default to the beams of the reference).
+            A new reference is solved if they differ from the reference beams.
+        thick
+            thickness of crystal
+        v
+            verbose
+
+        Returns
+        -------
+        err
+            error estimate (0 if a full solve was performed)
+
+        .. note ::
+
+            Smax is not taken into account so the beams are fixed between updates.
+        """
+        ref = self.__dict__.get('_pert')
+        if not isinstance(hkl,np.ndarray):hkl = ref['hkl'] if ref else self.get_hkl()
+        Smax = self.Smax
+        self.set_beam(keV=self.keV,u=u)
+        self._set_excitation_errors(None,hkl=hkl)
+        self._set_Vg()
+        self.Smax = Smax
+        err = np.inf
+        if ref and np.array_equal(hkl,ref['hkl']) and self.keV==ref['keV']:
+            dSw = 2*np.pi*(self.df_G.Sw.values-ref['Sw'])
+            gammaj,CjG,err = bloch_util.perturb_eigh(ref['gammaj'],ref['CjG'],dSw,
+                c0=ref['c0'],order=order)
+            if v and err>tol:
+                print(colors.blue+'...error estimate %.1E>%.1E : full solve...' %(err,tol)+colors.black)
+        if err>tol:
+            self._solve_Bloch(v=v)
+            self._set_pert()
+            err = 0
+        else:
+            self.H = ref['H'].copy()
+            self.H[np.diag_indices_from(self.H)] += dSw
+            self.gammaj,self.CjG = gammaj,CjG
+            self.solved = True
+        if thick:self.set_thickness(thick)
+        return err
+
+    def solve_batch(self,
+        uvw:Sequence[Sequence[float]],
+        Smax:Optional[float]=None,
+    ):
+        """Solve a batch of orientations at once with a shared set of beams
+
+        All orientations share the superset of beams excited in any of them
+        (see :meth:`~Bloch.solve_sweep`) so that the stack of Bloch matrices
+        is diagonalized in a single batched call.
+
+        Parameters
+        ----------
+        uvw
+            beam orientations (nframes x 3)
+        Smax
+            maximum excitation error for a beam to be included
+
+        Returns
+        -------
+        hkl
+            shared beams (nbeams x 3)
+        gammaj
+            eigen values (nframes x nbeams)
+        CjG
+            eigen vectors (nframes x nbeams x nbeams)
+        """
+        if Smax:self.Smax=Smax
+        self._set_sweep(uvw,self.Smax)
+        hkl = self._sweep['hkl']
+        (qx,qy,qz) = hkl.dot(self.lat_vec).T
+
+        K = self.k0*(np.array(uvw).T/np.linalg.norm(uvw,axis=1)).T
+        Kx,Ky,Kz = [Ki[:,None] for Ki in K.T]
+        Sw = (self.k0**2-((Kx+qx)**2+(Ky+qy)**2+(Kz+qz)**2))/(2*self.k0)
+
+        U = self._sweep['Fg']*self._get_Ug_scale()
+        np.fill_diagonal(U,0)
+        H = np.repeat((U/(2*self.k0))[None,:,:],Sw.shape[0],axis=0)
+        iG = np.arange(hkl.shape[0])
+        H[:,iG,iG] += Sw
+        H *= 2*np.pi #to get same as felix
+        print(colors.blue+'...diagonalization of %d %dx%d matrices...' %((Sw.shape[0],)+hkl.shape[:1]*2)+colors.black)
+        gammaj,CjG = np.linalg.eigh(H)
+        return hkl,gammaj,CjG
+
+    def _set_pert(self):
+        """reference solve used by :meth:`~Bloch.solve_perturbative`"""
+        id0 = self._get_central_beam()
+        self._pert = {
+            'hkl'   :self.df_G[['h','k','l']].values,
+            'keV'   :self.keV,
+            'Sw'    :self.df_G.Sw.values.copy(),
+            'H'     :np.array(self.H),
+            'gammaj':self.gammaj,
+            'CjG'   :self.CjG,
+            'c0'    :self._get_invC0(id0),
+        }
+        return self._pert
+
+    def _set_sweep(self,uvw,Smax):
+        """superset of beams such that abs(Sw)<Smax in any orientation uvw
+        and corresponding fixed Fhkl(g-h) block
+        """
+        n = 2*self.Nmax+1
+        keys = [np.array([],dtype=int)]
+        for u in uvw:
+            (h,k,l),q = self._get_excited(self.k0*np.array(u)/np.linalg.norm(u),Smax)
+            keys += [np.ravel_multi_index((k+self.Nmax,h+self.Nmax,l+self.Nmax),(n,)*3)]
+        #### union of the beams in the order of get_lattice
+        k,h,l = np.unravel_index(np.unique(np.hstack(keys)),(n,)*3)
+        hkl  = np.array([h,k,l],dtype=int).T-self.Nmax
+        keys = self._hkl_keys(hkl)
+        order = np.argsort(keys)
+        self._sweep = {
+            'hkl'  :hkl,
+            'keys' :keys[order],
+            'order':order,
+            'shape':self.Fhkl.shape,
+            'Fg'   :self._take_Fhkl(self._get_H_plan(hkl)),
+        }
+        self.__dict__.pop('_H_plan')
+        print(colors.blue+'...sweep superset : %d beams...' %hkl.shape[0]+colors.black)
+
     ################################################################################
     #### private
     ################################################################################
@@ -357,37 +598,27 @@ class Bloch:
             sqrtkg=np.sqrt(1+gn/Knorm)  #dyngo implementation
             Sg*=2*self.k0/sqrtkg
 
-        pre = 1/np.sqrt(1-cst.keV2v(self.keV)**2)
-        Ug = pre*self.Fhkl/(self.crys.volume*np.pi)*self.eps #/3
-
         #####################
-        # setting average potential to 0
-        # Ug[U0_idx] = U0
-        # and Ug(iG,jG) are obtained from Ug[h,k,l] where h,k,l = hlk_iG-hkl_jG
+        # Ug(iG,jG) are obtained from Ug[h,k,l] where h,k,l = hlk_iG-hkl_jG
+        # gathered in one go (see _get_Fg)
+        # setting average potential to 0 : Ug[U0_idx] = 0 (the diagonal)
         #####################
-        U0_idx = [2*self.Nmax]*3
-        Ug[tuple(U0_idx)] = 0
-        # if Vopt0 :Ug[tuple(U0_idx)] = 0   #setting average potential to 0
+        U = self._get_Fg(hkl)*self._get_Ug_scale() #/3
+        np.fill_diagonal(U,0)
 
-        print(Ug.shape)
         if v:print(colors.blue+'...assembling %dx%d matrix...' %((Sg.shape[0],)*2)+colors.black)
-        H = np.diag(Sg+0J)
-        for iG,hkl_G in enumerate(hkl) :
-            U_iG = np.array([Ug[tuple(hkl_J+U0_idx)] for hkl_J in hkl_G-hkl]) #;print(V_iG.shape)
-            # print('G : ',hkl_G)
-            # print('U_G:',Ug[tuple(U0_idx+hkl_G)])
-            # print('idx iG:',[tuple(hkl_J+U0_idx) for hkl_J in hkl_G-hkl])
-            # print(U_iG)
-            if self.dyngo:
-                # qh = np.linalg.norm(self.lat_vec.T.dot((hkl_G-hkl).T),axis=0)
-                qh = Rmat.dot((hkl_G-hkl).T).T.dot(surf_norm)
-                sqrtkh = np.sqrt(1+qh/Knorm)
-                H[iG,:] += U_iG/(sqrtkg[iG]*sqrtkh)  #so dyngo implementation
-            else:
-                H[iG,:] += U_iG/(2*self.k0)  #off diagonal terms as potential
-
         if self.dyngo:
+            # qh = Rmat.dot((hkl_G-hkl).T).T.dot(surf_norm)
+            p_n = hkl.dot(Rmat.T.dot(surf_norm))
+            sqrtkh = np.sqrt(1+np.subtract.outer(p_n,p_n)/Knorm)
+            H = U/(sqrtkg[:,None]*sqrtkh)  #so dyngo implementation
+            H[np.diag_indices_from(H)] += Sg
             H/=(2*self.k0)
+        else:
+            H = U/(2*self.k0)  #off diagonal terms as potential
+            H[np.diag_indices_from(H)] += Sg
+            if isinstance(self.__dict__.get('df_W'),pd.DataFrame):
+                H -= self._get_bethe_potentials(hkl)
 
         H *= 2*np.pi #to get same as felix
         self.H=H
@@ -395,9 +626,119 @@ class Bloch:
 
         if v:print(colors.blue+'...diagonalization...'+colors.black)
         self.gammaj,self.CjG = np.linalg.eigh(self.H) #;print(red+'Ek',lk,black);print(wk)
-        self.invCjG = np.linalg.inv(self.CjG)
+        # CjG is unitary so invCjG=CjG^H is never formed (see _get_invC0)
+        self.__dict__.pop('invCjG',None)
+        if self.__dict__.get('_arrays'):
+            self._arrays['keys'] = [k for k in self._arrays['keys'] if not k=='invCjG']
         self.solved = True
 
+    def _set_bethe(self,strong:float=2e-3,weak:float=1e-5,nstrong:int=0):
+        """Split the beams into strong beams (df_G) and weak beams (df_W)
+
+        Parameters
+        ----------
+        strong
+            beams with perturbation strength w_g=abs(Ug)/(2*k0*abs(Sg)) above strong are strong beams
+        weak
+            beams with w_g below weak are ignored
+        nstrong
+            minimum number of strong beams (the strongest weak beams are promoted if needed)
+
+        .. note::
+
+            The central beam is always a strong beam.
+        """
+        Ug  = self.df_G.Vga.values*self._get_Ug_scale()
+        with np.errstate(divide='ignore',invalid='ignore'):
+            w = Ug/(2*self.k0*self.df_G.Swa.values)
+        w[self.df_G.index==str((0,0,0))] = np.inf
+        order = np.argsort(-w)
+        ns = max((w>=strong).sum(),min(nstrong,w.size))
+        iS,iW = np.sort(order[:ns]),order[ns:]
+        iW = np.sort(iW[w[iW]>=weak])
+
+        self.df_W = self.df_G.iloc[iW].copy()
+        self.df_G = self.df_G.iloc[iS].copy()
+        self.nbeams = self.df_G.shape[0]
+        print(colors.blue+'...Bethe : %d strong beams, %d weak beams...' %(self.nbeams,self.df_W.shape[0])+colors.black)
+
+    def _get_bethe_potentials(self,hkl):
+        """second order Bethe potentials of the weak beams on the strong beams hkl
+        sum_w Ug-w Uw-h/(2k0)^2 /Sw
+        """
+        hkl_W = self.df_W[['h','k','l']].values
+        Sw = self.df_W.Sw.values
+        B = self._take_Fhkl(self._get_Fhkl_idx(hkl,hkl_W))
+        B *= self._get_Ug_scale()/(2*self.k0)
+        return (B/Sw).dot(np.conj(B.T))
+
+    def _get_Fg(self,hkl):
+        """Fhkl(hkl_G-hkl_H) block for beams hkl
+
+        Uses the fixed block of the sweep superset if all beams belong to it
+        otherwise gathers it from Fhkl with the assembly plan
+        """
+        sweep = self.__dict__.get('_sweep')
+        if sweep and sweep['shape']==self.Fhkl.shape:
+            keys = self._hkl_keys(hkl)
+            if not isinstance(keys,type(None)):
+                pos = np.minimum(np.searchsorted(sweep['keys'],keys),sweep['keys'].size-1)
+                if np.array_equal(sweep['keys'][pos],keys):
+                    pos = sweep['order'][pos]
+                    return sweep['Fg'][np.ix_(pos,pos)]
+        idx = self._get_H_plan(hkl)
+        return self._take_Fhkl(idx)
+
+    def _take_Fhkl(self,idx):
+        """Fhkl at flat indices idx from the sparse store or the dense grid (gemmi)"""
+        if isinstance(self.Fhkl,np.ndarray):
+            return self.Fhkl.ravel()[idx]
+        return self.Fhkl.take(idx)
+
+    def get_Fhkl(self,hkl):
+        """structure factor at Miller indices hkl (nx3)"""
+        return self._take_Fhkl(self._get_Fhkl_idx(hkl,np.zeros((1,3)))[:,0])
+
+    def get_Ug(self,hkl):
+        """potential Fourier components at Miller indices hkl (nx3) as used in the Bloch matrix"""
+        return self.get_Fhkl(hkl)*self._get_Ug_scale()
+
+    def _get_Ug_scale(self):
+        pre = 1/np.sqrt(1-cst.keV2v(self.keV)**2)
+        return pre/(self.crys.volume*np.pi)*self.eps
+
+    def _hkl_keys(self,hkl):
+        """flat index of the beams hkl in the (2Nmax+1)^3 lattice (None if outside)"""
+        hkl = np.array(hkl,dtype=int)
+        if abs(hkl).max()>self.Nmax:return
+        return np.ravel_multi_index((hkl+self.Nmax).T,(2*self.Nmax+1,)*3)
+
+    def _get_H_plan(self,hkl):
+        """flat indices into Fhkl of all the differences hkl_G-hkl_H of the beams
+
+        The plan is kept until the beam set or the Fhkl grid changes
+        so that subsequent solves only need to redo the gather.
+        """
+        plan = self.__dict__.get('_H_plan')
+        if plan :
+            hkl0,shape0,idx = plan
+            if shape0==self.Fhkl.shape and np.array_equal(hkl0,hkl):
+                return idx
+        idx = self._get_Fhkl_idx(hkl,hkl)
+        self._H_plan = (np.array(hkl).copy(),self.Fhkl.shape,idx)
+        return idx
+
+    def _get_Fhkl_idx(self,hkl_G,hkl_H):
+        """flat indices into Fhkl of hkl_G[i]-hkl_H[j]"""
+        n0,n1,n2 = self.Fhkl.shape
+        N0 = 2*self.Nmax
+        (hG,kG,lG),(hH,kH,lH) = np.array(hkl_G,dtype=int).T,np.array(hkl_H,dtype=int).T
+        idx  = (np.subtract.outer(hG,hH)+N0)*n1
+        idx += np.subtract.outer(kG,kH)+N0
+        idx *= n2
+        idx += np.subtract.outer(lG,lH)+N0
+        return idx
+
     def _set_structure(self,cif_file):
         pdb_file = ''
         if cif_file[-3:]=='pdb':
@@ -406,7 +747,7 @@ class Bloch:
 
         self.cif_file = cif_file
         self.pdb_file = pdb_file
-        self.crys     = ut.import_crys(self.cif_file)
+        self.crys     = sf_cache.import_crys(self.cif_file)
         self.lat_vec0 = np.array(self.crys.lattice_vectors)
         self.lat_vec  = np.array(self.crys.reciprocal_vectors)/(2*np.pi)
         self.pattern  = np.array([np.hstack([a.coords_fractional,a.atomic_number]) for a in self.crys.atoms] )
@@ -422,8 +763,10 @@ class Bloch:
             hkl = np.array(hkl)
             h,k,l = hkl.T
             qx,qy,qz = hkl.dot(self.lat_vec).T
+        elif Smax:
+            (h,k,l),(qx,qy,qz) = self._get_excited(K,Smax)
         else:
-            (h,k,l),(qx,qy,qz) = self.lattice
+            (h,k,l),(qx,qy,qz) = self.get_lattice()
 
         Kx,Ky,Kz = K
         # Sw = K0-np.sqrt((Kx+qx)**2+(Ky+qy)**2+(Kz+qz)**2)
@@ -449,6 +792,7 @@ class Bloch:
 
         self.Smax = Smax
         self.nbeams = Sw.size
+        self.__dict__.pop('df_W',None)
         self.df_G = pd.DataFrame.from_dict(d)
         self.df_G.index = [str(tuple(h)) for h in self.df_G[['h','k','l']].values]
         self.solved = False
@@ -457,6 +801,19 @@ class Bloch:
         # print(self.df_G['I'].shape)
 
 
+    def _get_excited(self,K,Smax):
+        """lattice points such that abs(Sw)<Smax streamed from the Ewald shell"""
+        K0 = np.linalg.norm(K)
+        Kx,Ky,Kz = K
+        hkl,q = [np.zeros((3,0),dtype=int)],[np.zeros((3,0))]
+        #### abs(Sw)<Smax => abs(|K+q|-K0)<2*Smax
+        for (h,k,l),(qx,qy,qz) in ut.get_ewald_shell(K,self.lat_vec,2*Smax,self.Nmax):
+            Sw  = (K0**2-((Kx+qx)**2+(Ky+qy)**2+(Kz+qz)**2))/(2*K0)
+            idx = abs(Sw)<Smax
+            hkl += [np.array([h[idx],k[idx],l[idx]])]
+            q   += [np.array([qx[idx],qy[idx],qz[idx]])]
+        return tuple(np.hstack(hkl)),tuple(np.hstack(q))
+
     def _set_Vg(self,felix=0):
         ##### opt was used for testing against FELIX
         if felix:
@@ -472,10 +829,8 @@ class Bloch:
             # print(self.crys,xi)
         else:
             hkl  = self.df_G[['h','k','l']].values
-            Fhkl = self.Fhkl.copy()
-            V0_idx = np.array([2*self.Nmax]*3)
-            Fhkl[tuple(V0_idx)] = 0
-            Fhkl = np.array([ Fhkl[tuple(hkl_G+V0_idx)] for hkl_G in hkl])
+            Fhkl = self.get_Fhkl(hkl)
+            Fhkl[~hkl.any(axis=1)] = 0
 
         self.pre = 1/np.sqrt(1-cst.keV2v(self.keV)**2)
         Vg_G = Fhkl/(self.crys.volume*np.pi)*self.pre*self.eps
@@ -504,19 +859,36 @@ class Bloch:
 
     def _set_intensities(self):
         """get beam intensities at thickness"""
-        id0 = self._get_central_beam()
-        gammaj,CjG = self.gammaj,self.CjG
-        if self.dyngo:
-            S = CjG.dot(np.diag(np.exp(1J*gammaj*self.thick*self.k0/self.Knorm))).dot(self.invCjG)
-        else:
-            S = CjG.dot(np.diag(np.exp(1J*gammaj*self.thick))).dot(self.invCjG)
-        # S = S[:,id0]
-        S = S[id0,:]
+        thick = self.thick
+        if self.__dict__.get('dyngo'):thick*=self.k0/self.Knorm
+        S = self._get_Sz(thick)[:,0]
         self.df_G['S'] = S
         self.df_G['I'] = np.abs(S)**2
-        if self.dyngo:
+        if self.__dict__.get('dyngo'):
             self.df_G['I']*=self.scale**2
 
+    def _get_invC0(self,id0):
+        """central beam column of the inverse of the eigen vector matrix"""
+        if isinstance(self.__dict__.get('invCjG'),np.ndarray):
+            return self.invCjG[:,id0]
+        return np.conj(self.CjG[id0,:])
+
+    def _get_Sz(self,z,idx=slice(0,None,1),nz:int=None):
+        """Scattered amplitudes S[idx,z] for an incident central beam
+
+        Only the central beam column of the scattering matrix is evaluated
+        and the thicknesses are processed by chunks of nz
+        """
+        z   = np.atleast_1d(z)
+        id0 = self._get_central_beam()
+        C   = self.CjG[idx,:]
+        invC0 = self._get_invC0(id0)[:,None]
+        if not nz:nz = max(1,2**22//self.gammaj.size)
+        Sz = np.zeros((C.shape[0],z.size),dtype=complex)
+        for i in range(0,z.size,nz):
+            Sz[:,i:i+nz] = C.dot(np.exp(1J*np.outer(self.gammaj,z[i:i+nz]))*invC0)
+        return Sz
+
     def _set_I(self,iZ=-1):
         idx=self.get_beam(refl=self.df_G.index)
         self.thick=self.z[iZ]
@@ -531,37 +903,27 @@ class Bloch:
         self.df_G['Sg'] = Sg
         self.df_G['Ig'] = np.abs(Sg)**2
 
-    def _set_beams_vs_thickness(self,thicks=None):
+    def _set_beams_vs_thickness(self,thicks=None,idx=None,nz:int=None):
         """ get Scattering matrix as function of thickness for all beams
         - thicks : tuple(ti,tf,step) or list or np.ndarray thicknesses
+        - idx : only compute those beams (the other beams are set to 0)
+        - nz : number of thicknesses processed at a time (see _get_Sz)
         """
         print(colors.blue+'... beam vs thickness ...'+colors.black)
         if not type(thicks)==type(None):
             self._set_thicks(thicks)
 
-        id0 = self.get_beam(refl=[(0,0,0)],index=True)[0]#;print(id0)
-        gammaj,CjG,invCjG = self.gammaj,self.CjG,self.invCjG
-
-        # import time
-        # t0  = time.time()
-        #### fast efficient
-        # M = np.exp(2J*np.pi*np.outer(gammaj,self.z))*(invCjG[:,id0][:,None])
-        M = np.exp(1J*np.outer(gammaj,self.z))*(invCjG[:,id0][:,None])
-        St = CjG.dot(M)
-
-        #### slower
-        # St = np.zeros((self.df_G.shape[0],self.z.size),dtype=complex)
-        # for iT,thick in enumerate(self.z):
-        #     S = CjG.dot(np.diag(np.exp(2J*np.pi*gammaj*thick))).dot(invCjG)
-        #     # S=CjG.T.dot(np.diag(np.exp(2J*np.pi*gammaj*T))).dot(CjG)
-        #     # St[:,iT]=CjG.dot(np.diag(np.exp(2J*np.pi*gammaj*T))).dot(CjG.T)[0,:]
-        #     St[:,iT] = S[:,id0]
-        # print('done %.2f' %(time.time()-t0))
+        #### only the central column S[:,id0] is computed
+        if type(idx)==type(None):
+            St = self._get_Sz(self.z,nz=nz)
+        else:
+            St = np.zeros((self.df_G.shape[0],self.z.size),dtype=complex)
+            St[idx,:] = self._get_Sz(self.z,idx=idx,nz=nz)
 
         self.Sz = St
         self.Iz = np.abs(self.Sz)**2
         Sw,Ug = self.df_G[['Sw','Vg']].values.T
-        Sz_kin = np.array([np.pi/self.k0*Ug*t*np.sinc(Sw*t) for t in self.z]).T
+        Sz_kin = np.pi/self.k0*Ug[:,None]*self.z*np.sinc(Sw[:,None]*self.z)
         self.Iz_kin = np.abs(Sz_kin)**2
 
     def _set_thicks(self,thicks):
@@ -624,7 +986,7 @@ class Bloch:
             if isinstance(cond,dict):
                 cond_args=cond.copy()
                 if not 'I' in self.df_G.columns:
-                    if not 'Iz' in self.__dict__:
+                    if not self._has('Iz'):
                         self._set_beams_vs_thickness(thicks=(0,1000,3))
                     self.df_G.I=self.Iz[:,-1]
 
@@ -667,7 +1029,7 @@ class Bloch:
         dict or np.ndarray
             beams as function of thickness
         """
-        if 'Iz' not in self.__dict__:
+        if not self._has('Iz'):
             self.thicks=(0,1000,1000)
             print('warning : computing Iz for thickness ', self.thicks)
             self._set_beams_vs_thickness()
@@ -683,6 +1045,7 @@ class Bloch:
     def get_kin(self):return self.df_G[['h','k','l','Sw','Vg','Sg','Ig']]
     def get_zones(self):return self.df_G[['h','k','l','zone']].values
     def get_G(self):return self.df_G[['qx','qy','qz']].values
+    def get_lattice(self):return ut.get_lattice(self.lat_vec,self.Nmax)
     def get_Xig(self,tol=1e4):
         self.df_G['Xi_g'] = self.k0/abs(self.df_G.Vg)
         xig = self.df_G.loc[self.df_G.Xi_g<tol,['h','k','l','Sw','Vg','Xi_g']]
@@ -776,7 +1139,7 @@ class Bloch:
         hkl
             beams to include
         """
-        if thicks or not 'Iz' in self.__dict__:self._set_beams_vs_thickness(thicks)
+        if thicks or not self._has('Iz'):self._set_beams_vs_thickness(thicks)
         if isinstance(iZs,int):iZs=slice(0,None,iZs)
         # iB = self.get_Istrong(out=1)[0]#;print(iB,self.Iz[    iB,iZs],)
         # iB = np.argsort(np.sum(self.Iz,axis=1))[-2]
@@ -804,15 +1167,18 @@ class Bloch:
         fz,fz_str = bloch_util.get_fz(opts)
         s,s_str = self._get_slice(s)
         tle = 'Structure factor($\AA$), showing %s in %s'  %(fz_str,s_str)
-        Fhkl  = self.Fhkl #.copy()
+        if isinstance(self.Fhkl,np.ndarray):
+            hklF,Fhkl = self.hklF,self.Fhkl
+        else:
+            hklF,Fhkl = self.Fhkl.dense()
         if isinstance(s,tuple):
             Fhkl   = Fhkl[s]
             nx,ny  = np.array((np.array(Fhkl.shape)-1)/2,dtype=int)
             i,j    = np.meshgrid(np.arange(-nx,nx+1),np.arange(-ny,ny+1))
             fig,ax = dsp.stddisp(scat=[i,j,fz(Fhkl)],title=tle,**kwargs)
         else:
-            h,k,l = self.hklF
-            fig,ax = dsp.stddisp(scat=[h,k,l,fz(self.Fhkl)],title=tle,rc='3d',**kwargs)
+            h,k,l = hklF
+            fig,ax = dsp.stddisp(scat=[h,k,l,fz(Fhkl)],title=tle,rc='3d',**kwargs)
             if h3D:h3d.handler_3d(fig,persp=False)
 
     def show_H(self,**kwargs):
@@ -823,13 +1189,109 @@ class Bloch:
     #### misc
     ################################################################################
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_H_plan',None)
+        state.pop('_sweep',None)
+        state.pop('_pert',None)
+        state.pop('_loaded',None)
+        return state
+
+    def set_store(self,arrays:bool=True,dtype:Optional[str]=None,compress:bool=False):
+        """Set how the object is saved
+
+        Parameters
+        ----------
+        arrays
+            save the large arrays (H,CjG,Sz,Iz...) in a separate .npz next to the .pkl.
+            They are loaded only when accessed (otherwise everything is pickled)
+        dtype
+            dtype of the saved intensities Iz,Iz_kin (ex 'float32')
+        compress
+            compress the .npz
+        """
+        self.store = dict(arrays=arrays,dtype=dtype,compress=compress)
+
     def save(self,file=None,v=1):
-        """save this object"""
+        """save this object (see :meth:`~Bloch.set_store`)"""
         file = self._get_pkl(file)
+        obj  = self
+        if self.__dict__.get('store',{'arrays':True})['arrays']:
+            obj = self._save_arrays(file)
         with open(file,'wb') as out :
-            pickle5.dump(self, out, pickle5.HIGHEST_PROTOCOL)
+            pickle5.dump(obj, out, pickle5.HIGHEST_PROTOCOL)
         if v:print(colors.green+"object saved\n"+colors.yellow+file+colors.black)
 
+    def _save_arrays(self,file):
+        """saves the large arrays into the .npz of file
+        and returns a copy of this object without them
+
+        The .npz is not rewritten if it already holds the current arrays.
+        """
+        store = dict(dtype=None,compress=False)
+        store.update(self.store)
+        npz_file = os.path.splitext(file)[0]+'.npz'
+        if self._is_npz_current(npz_file,store):
+            keys = self._arrays['keys']
+        else:
+            arrays = {'version':np.array(Bloch._arrays_version)}
+            for k in Bloch._arrays_keys:
+                if self._has(k) and isinstance(getattr(self,k),np.ndarray):
+                    arrays[k] = getattr(self,k)
+                    if k in ['Iz','Iz_kin'] and store['dtype']:
+                        arrays[k] = arrays[k].astype(store['dtype'])
+            tmp = '%s.%d' %(npz_file,os.getpid())
+            with open(tmp,'wb') as f:
+                if store['compress']:np.savez_compressed(f,**arrays)
+                else:np.savez(f,**arrays)
+            os.replace(tmp,npz_file)
+            keys = [k for k in arrays if not k=='version']
+
+        obj = Bloch.__new__(Bloch)
+        obj.__dict__.update({k:v for k,v in self.__getstate__().items() if k not in keys+['_arrays']})
+        obj._arrays = {'version':Bloch._arrays_version,'file':npz_file,'keys':keys,'store':store}
+        return obj
+
+    def _is_npz_current(self,npz_file,store):
+        """whether npz_file holds the arrays of this object
+        (none of them has been set since they were loaded from it)
+        """
+        arrays = self.__dict__.get('_arrays')
+        if not arrays or not arrays.get('store')==store:return False
+        if not os.path.exists(npz_file):return False
+        if not os.path.abspath(self._get_npz())==os.path.abspath(npz_file):return False
+        loaded = self.__dict__.get('_loaded',{})
+        for k in Bloch._arrays_keys:
+            if k in self.__dict__:
+                if not (k in arrays['keys'] and loaded.get(k) is self.__dict__[k]):return False
+        return True
+
+    def _get_npz(self):
+        """the .npz of the saved arrays (looked for in self.path first in case the simulation folder was moved)"""
+        npz_file = self._arrays['file']
+        local = os.path.join(self.path,os.path.basename(npz_file))
+        if os.path.exists(local):return local
+        return npz_file
+
+    def _has(self,name):
+        """whether attribute name is set or available from the saved arrays"""
+        return name in self.__dict__ or name in self.__dict__.get('_arrays',{}).get('keys',[])
+
+    def __getattr__(self,name):
+        #### lazy loading of the saved arrays
+        arrays = self.__dict__.get('_arrays')
+        if arrays and name in arrays['keys']:
+            if arrays['version']>Bloch._arrays_version:
+                raise Exception('unsupported array store version %d' %arrays['version'])
+            with np.load(self._get_npz()) as f:
+                val = f[name]
+            #### read only so that the .npz is known to be up to date (see _save_arrays)
+            val.flags.writeable = False
+            self.__dict__.setdefault('_loaded',{})[name] = val
+            self.__dict__[name] = val
+            return val
+        raise AttributeError("'Bloch' object has no attribute '%s'" %name)
+
     def _make_img(self,
             exp:str=None,
             pred:bool=False,
@@ -873,8 +1335,8 @@ class Bloch:
         kwargs
             args to be passed to the tiff viewer
         '''
-        thick = self.thick
         if thick:self.set_thickness(thick)
+        thick = self.thick
         #dials info
         if isinstance(exp,str):exp = pt.Dials(exp)
         if exp:
@@ -946,15 +1408,16 @@ class Bloch:
     def convert2img(self,filename,template=None,**kwargs):
         im0 = self._make_img(**kwargs)#Nmax,fbroad,gs3,nX,rmax,thick,iz,rot)
         # print(im0.mean())
-        fmt = template.split('.')[-1]
         if not filename:
-            filename = os.path.join(self.figpath,self.name+'_%dA.%s' %(self.thick,fmt))
-        if template:
-            out = check_output("cp %s %s" %(template,filename),shell=True).decode()
-            if out:print(out)
-        bloch_util.imwrite(filename,im0)
+            fmt = template.split('.')[-1] if template else 'tiff'
+            filename = os.path.join(self.path,self.name+'_%dA.%s' %(self.thick,fmt))
+        bloch_util.imwrite(filename,im0,template)
+
 
 
+    def _make_tiff_img(self,Imax:int=3e4,**kwargs):
+        """uint16 image as written by :meth:`~Bloch.convert2tiff` (kwargs passed to :meth:`~Bloch._make_img`)"""
+        return np.array(self._make_img(Imax=Imax,**kwargs),dtype='uint16').T
 
     def convert2tiff(self,tiff_file:str=None,
         Imax:int=3e4,
@@ -1004,17 +1467,16 @@ class Bloch:
             If aperpixel is not specified, it is automatically so it contains the image
             will contain all reflections.
         """
-        im0 = _make_img(Nmax,fbroad,gs3,nX,rmax,thick,iz,rot)
-
+        I = self._make_tiff_img(Imax=Imax,Nmax=Nmax,aperpixel=aperpixel,fbroad=fbroad,
+            gs3=gs3,nX=nX,rmax=rmax,thick=thick,iz=iz,rot=rot)
         if not tiff_file:
-            tiff_file = os.path.join(self.path,self.name+'_%dA' %thick+'.tiff')
-        I = np.array(im0*Imax,dtype='uint16')
+            tiff_file = os.path.join(self.path,self.name+'_%dA' %self.thick+'.tiff')
 
         # ix,iy = np.meshgrid(range(2*Nmax),range(2*Nmax))
         # dsp.stddisp(im=[ix,iy,I],plots=[j,i,'bo'],xylims=[0,512,0,512],
         #     cmap='gray',caxis=[0,10],imOpt='tX',pargs={'fillstyle':'none'})
 
-        tifffile.imwrite(tiff_file,I.T,**tif_writer_args)
+        tifffile.imwrite(tiff_file,I,**tif_writer_args)
         print(colors.yellow+tiff_file+colors.green+' saved'+colors.black)
         if show:
             # v=viewers.Base_Viewer(self.path,frame=1,thick=self.thick,**kwargs)
@@ -1032,7 +1494,8 @@ class Bloch:
         Smax:Iterable[float],
         z=(0,100,100),
         hkl=None,
-        opts:str='Ss'
+        opts:str='Ss',
+        bethe:dict={},
     ):
         """creates a convergence test for a range of Nmax and Smax
         and displays it as funtion of thickness for beams hkl
@@ -1040,22 +1503,35 @@ class Bloch:
         Parameters
         ----------
         opt:  S(solve) s(save) p(plot)
+        bethe
+            Bethe thresholds (see :meth:`~Bloch._set_bethe`).
+            If provided, the Bethe solution is compared against the full solve
+            and the number of strong beams and max intensity error are reported
         """
         solve,save,show = 'S' in opts,'s' in opts,'p' in opts
         Nmax,Smax=[a.flatten() for a in np.meshgrid(Nmax,Smax)]
         z=np.array(z)
-        df=pd.DataFrame(columns=['Nmax','Smax','nbeams','Iz'])
+        cols = ['Nmax','Smax','nbeams','Iz']
+        if bethe:cols+=['nstrong','err_bethe']
+        df=pd.DataFrame(columns=cols)
         # simulate
         self.update_Nmax(Nmax[0])
         self._set_excitation_errors(Smax=Smax[0])
         hkl0 = self.df_G.index
         if solve:
             for i,(Nm,Sm) in enumerate(zip(Nmax,Smax)):
-                 self.solve(Nmax=Nm,Smax=Sm,thicks=z,opts='v0')
+                 self.solve(Nmax=Nm,Smax=Sm,thicks=z,opts='v0z',bethe={})
                  idx='(%d,%.3f)'%(Nm,Sm)
                  idx_b = self.get_beam(refl=hkl0)
                  df.loc[idx,['Nmax','Smax','nbeams']]=[Nm,Sm,self.nbeams]
                  df.loc[idx,'Iz']=self.Iz[idx_b,:].copy()
+                 if bethe:
+                     Iz = pd.DataFrame(self.Iz,index=self.df_G.index)
+                     self.solve(Smax=Sm,thicks=z,opts='v0z',bethe=bethe)
+                     err = abs(self.Iz-Iz.loc[self.df_G.index].values).max()
+                     df.loc[idx,['nstrong','err_bethe']]=[self.nbeams,err]
+                     print(colors.blue+'Bethe : %d/%d beams, max error=%.2E' %(self.nbeams,df.loc[idx,'nbeams'],err)+colors.black)
+            if bethe:self.solve(Smax=Smax[-1],thicks=z,opts='v0z',bethe={})
             self.df=df
             if save:
                 df.to_pickle(self.path+self.name+'_cv.pkl')
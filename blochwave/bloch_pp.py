@@ -1,6 +1,6 @@
 """Bloch contiuous rotation experiment"""
 import importlib as imp
-import os,glob,numpy as np
+import os,glob,tifffile,concurrent.futures,numpy as np
 from subprocess import Popen,check_output
 from typing import TYPE_CHECKING, Dict, Iterable, Optional, Sequence, Union
 from utils import displayStandards as dsp#;imp.reload(dsp)
@@ -38,6 +38,9 @@ class Bloch_cont(rotate_exp.Rocking):
         ''' Sums images found in figpath by chuncks of n images
         and puts them into directory "figpath/sum"
 
+        The images are streamed through a running window sum
+        (see :func:`~EDutils.utilities.sliding_sum`) so each image is read only once.
+
         Parameters
         ----------
         n
@@ -48,46 +51,37 @@ class Bloch_cont(rotate_exp.Rocking):
             The range of frames consider in (f_init,f_end)
         '''
         #handle output style
+        if not figpath:figpath=self.figpath
         if not fmt:fmt = glob.glob(os.path.join(figpath,'*'))[0].split('.')[-1]
         sum_path=os.path.join(figpath,'sum')
-        pad_n = int(np.ceil(np.log10(np.ceil(self.df.shape[0]/n))))
-        if not os.path.exists(sum_path):
-            Popen('mkdir %s' %sum_path,shell=True)
-
-        # handles min and max frames
         nmax = self.df.shape[0]
-        n_max = int(np.ceil(nmax/n))
-        if not len(frames)==2:frames=(0,n_max+1)
-        n_init,n_end = frames
-        n_init,n_end=max(0,n_init),min(n_end,n_max)
-        n2 = n//2 #int(np.ceil(n/2))
+        n2 = n//2
+        if not len(frames)==2:frames=(0,int(np.ceil(nmax/n)))
 
         ## check images exists
         nbounds=lambda n0:max(0,min(nmax-1,n0))
-        ni,nf = nbounds(n*n_init-n2),nbounds(n*n_end+n2+1)
-        filenames = np.array([figpath+'/%s.%s' %(self.load(i).name,fmt)
-            for i in [ni,nf]])
-        miss = [not os.path.exists(f) for f in filenames]
+        ni,nf = nbounds(n*frames[0]-n2),nbounds(n*frames[1]+n2)
+        filenames = np.array([os.path.join(figpath,'%s.%s' %(name,fmt)) for name in self.df.index])
+        miss = [not os.path.exists(f) for f in filenames[ni:nf+1]]
         if any(miss):
             print(colors.red+'Missing images : \n'+colors.black)
-            print('\n'.join(filenames[miss]))
+            print('\n'.join(filenames[ni:nf+1][miss]))
             return
-        #get the size of the images
-        nxy = bu.imread(filenames[0]).shape
-        for i in np.arange(n_init,n_end+1):
-            im = np.zeros(nxy)
-            subframes = np.arange(max(0,i*n-n2),min(nmax,i*n+n2+1))
-            print(colors.red,i,subframes,colors.black)
-            for j in subframes:
-                b = self.load(j)
-                img_file=os.path.join(figpath,'%s.%s' %(b.name,fmt))
-                im+=bu.imread(img_file)/n
-            frame_str = str(i).zfill(pad_n)
-            new_file = os.path.join(sum_path,'%s.%s' %(frame_str,fmt))
-            out = check_output("cp %s %s" %(filenames[0],new_file),shell=True).decode()
+        #### each image is read once
+        ims = ((j,bu.imread(filenames[j])) for j in range(ni,nf+1))
+        self._write_sum(ims,n,sum_path,fmt,template=filenames[ni],frames=frames,
+            f=lambda im:im.T)
+
+    def _write_sum(self,ims,n,sum_path,fmt,template=None,frames=None,f=None):
+        """write the streamed sums of the images ims (see :func:`~EDutils.utilities.sliding_sum`)"""
+        if not os.path.exists(sum_path):
+            out=check_output('mkdir -p %s' %sum_path,shell=True).decode()
             if out:print(out)
-            bu.imwrite(new_file,im.T)#np.fliplr(np.flipud(im)))
-            # print(colors.yellow+new_file+colors.green+' saved'+colors.black)
+        nmax  = self.df.shape[0]
+        pad_n = int(np.ceil(np.log10(np.ceil(nmax/n))))
+        for i,im in ut.sliding_sum(ims,n,nmax,frames):
+            new_file = os.path.join(sum_path,'%s.%s' %(str(i).zfill(pad_n),fmt))
+            bu.imwrite(new_file,f(im) if f else im,template)
 
     def make_img(self,template=None,figpath=None,fmt='',frames=None,**kwargs):
         if not figpath:figpath=self.figpath
@@ -103,7 +97,65 @@ class Bloch_cont(rotate_exp.Rocking):
             b0.convert2img(filename,template,**kwargs)
 
 
-    def convert2tiff(self,figpath=None,n=0,nmax=0,**kwargs):
+    def make_stack(self,filename:str=None,frames:Optional[Sequence[int]]=None,
+            template:str=None,dtype:str='uint16',nproc:Optional[int]=None,**kwargs):
+        '''Render the frames directly into a single memory mapped stack
+
+        The stack is allocated once on disk with its header and
+        the frames are rendered in place by blocks of frames in each worker.
+
+        Parameters
+        ----------
+        filename
+            .mrc (image stack) or .tif/.tiff (multi-page tiff) file (default path/<tag>.tiff)
+        frames
+            frames to render (default all)
+        template
+            mrc file whose header and dtype are used for a mrc stack
+        dtype
+            data type of the stack (the intensities are clipped to the range of integer types)
+        nproc
+            number of worker processes (default self.nproc)
+        kwargs
+            passed to :meth:`~blochwave.bloch.Bloch._make_img`
+
+        Returns
+        -------
+        str
+            filename
+
+        .. note ::
+            The frames are oriented as in :meth:`~blochwave.bloch.Bloch.convert2img` for mrc
+            and as in :meth:`~blochwave.bloch.Bloch.convert2tiff` for tiff.
+        '''
+        if not filename:filename=os.path.join(self.path,'%s.tiff' %self.tag)
+        if frames is None:frames=np.arange(self.df.shape[0])
+        frames = np.array(frames,dtype=int)
+        nproc  = self._get_nproc(nproc)
+        T = not bu.stack_fmts[filename.split('.')[-1]]=='mrc'
+
+        #### the first frame gives the size of the images
+        im0 = self.load(frames[0])._make_img(**kwargs)
+        bu.new_stack(filename,(frames.size,)+im0.shape,dtype,template)
+        stack = bu.StackMmap(filename)
+        try:
+            stack.data[0] = _stack_img(im0,stack.data.dtype,T)
+            if nproc<=1:
+                for k,i in enumerate(frames[1:],1):
+                    im = self.load(i)._make_img(**kwargs)
+                    stack.data[k] = _stack_img(im,stack.data.dtype,T)
+            else:
+                pkls = self.df.pkl.values[frames]
+                blocks = [b for b in np.array_split(np.arange(1,frames.size),nproc) if b.size]
+                with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as pool:
+                    futures = [pool.submit(_render_stack,pkls[b],b,filename,T,kwargs) for b in blocks]
+                    for future in concurrent.futures.as_completed(futures):future.result()
+        finally:
+            stack.close(stats=True)
+        print(colors.yellow+filename+colors.green+' saved'+colors.black)
+        return filename
+
+    def convert2tiff(self,figpath=None,n=0,nmax=0,render=False,save_frames=True,**kwargs):
         ''' Generate tiff files
         Parameters
         ------------
@@ -112,34 +164,35 @@ class Bloch_cont(rotate_exp.Rocking):
             kwargs
                 passed to Bloch.convert2tiff
             n
-                if n> 1 sum n images at a time
+                if n> 1 sum n images at a time into figpath/sum (see :meth:`~Bloch_cont.sum_images`)
             nmax
                 number of frames to consider
+            render
+                with n>1, render the frames in memory and sum them as they come
+                instead of reading the tiff files of the frames
+            save_frames
+                with render, also write the tiff file of each frame
         '''
-        import tifffile
         if not figpath:figpath=self.figpath
         if not nmax:nmax=self.df.shape[0]
         if n>1:
-            b0=self.load(0)
-            tiff_file=figpath+'/%s.tiff' %b0.name
-            im=tifffile.imread(tiff_file)
-            sum_path=os.path.join(figpath,'sum')
-            # self.sum_path=sum_path
-            pad_n = int(np.ceil(np.log10(np.ceil(self.df.shape[0]/n))))
-            if not os.path.exists(sum_path):
-                Popen('mkdir %s' %sum_path,shell=True)
-
-            for i in range(0,nmax,n):
-                im = np.zeros(im.shape)
-                new_tiff_file = os.path.join(sum_path,'%s.tiff' %(str(i//n).zfill(pad_n)))
-                # for j in range(n):
-                for j in range(max(0,i+n-5),min(nmax-1,i+n+5)):
+            frames = (0,(nmax-1)//n)
+            nf = min(self.df.shape[0],frames[1]*n+n//2+1)
+            tif_args = {k:kwargs.pop(k) for k in ['show','tif_writer_args','tiff_file'] if k in kwargs}
+            def read_frames():
+                for j,name in enumerate(self.df.index[:nf]):
+                    yield j,tifffile.imread(figpath+'/%s.tiff' %name)
+            def render_frames():
+                for j in range(nf):
                     b = self.load(j)
-                    tiff_file=figpath+'/%s.tiff' %b.name
-                    im+=tifffile.imread(tiff_file)/n
-                tifffile.imwrite(new_tiff_file,im)
-                print(colors.yellow+new_tiff_file+colors.green+' saved'+colors.black)
-
+                    I = b._make_tiff_img(**kwargs)
+                    if save_frames:
+                        tiff_file=figpath+'/%s.tiff' %b.name
+                        tifffile.imwrite(tiff_file,I,**tif_args.get('tif_writer_args',{}))
+                        b.save()
+                    yield j,I
+            ims = render_frames() if render else read_frames()
+            self._write_sum(ims,n,os.path.join(figpath,'sum'),'tiff',frames=frames)
         else:
             for i in range(nmax):
                 b = self.load(i)
@@ -157,7 +210,7 @@ class Bloch_cont(rotate_exp.Rocking):
                 opt='sc',name=tiff_file.replace('.tiff','.png'),figsize='im',**kwargs)
 
     def show_tiff(self,sum_opt=False,**kwargs):
-        # figpath=self.figpath
+        figpath=self.figpath
         sum_path=os.path.join(self.figpath,'sum')
         if sum_opt:figpath=sum_path
         return vw.Base_Viewer(figpath,**kwargs)
@@ -166,6 +219,22 @@ class Bloch_cont(rotate_exp.Rocking):
         if not any(refl) and not cond:cond=strong_beams
         return super().plot_rocking(cond=cond,refl=refl,**kwargs)
 
+def _stack_img(im,dtype,T):
+    """frame of a stack from an image of :meth:`~blochwave.bloch.Bloch._make_img`"""
+    if T:im=im.T
+    if np.issubdtype(dtype,np.integer):im = np.clip(im,0,np.iinfo(dtype).max)
+    return np.array(im,dtype=dtype)
+
+def _render_stack(pkls,idx,filename,T,kwargs):
+    """worker of :meth:`~Bloch_cont.make_stack` rendering frames pkls into stack[idx]"""
+    stack = bu.StackMmap(filename)
+    try:
+        for i,pkl in zip(idx,pkls):
+            im = ut.load_pkl(pkl)._make_img(**kwargs)
+            stack.data[i] = _stack_img(im,stack.data.dtype,T)
+    finally:
+        stack.close()
+
 def strong_beams(dfG,
         tol:float=1e-2,n:int=10,
         opt:str='F'):
@@ -13,23 +13,110 @@ def mrc2tiff(mrc_file,outpath):
     imwrite(os.path.join(outpath,tiff_file),im)
 
 #### writer
-def mrc_writer(filename,im0):
+def mrc_writer(filename,im0,template=None):
+    """write im0 into filename
+
+    With a template, the dtype and header of the template are used
+    (see :func:`~mrc_header`). Otherwise the dtype of filename is kept if it exists.
+    """
+    if template or not os.path.exists(filename):
+        h = mrc_header(template) if template else {}
+        with mrcfile.new(filename,overwrite=True) as mrc:
+            mrc.set_data(np.array(im0,dtype=h.get('dtype',np.float32)))
+            set_mrc_header(mrc,h)
+        return
     mrc = mrcfile.open(filename,'r+')
     mrc.set_data(np.array(im0,dtype=type(mrc.data[0,0])))
     mrc.flush()
     mrc.close()
 
-def tiff_writer(tiff_file,im):
+def tiff_writer(tiff_file,im,template=None):
     tifffile.imwrite(tiff_file,im)
 img_writers = {
     'mrc' : mrc_writer,
     'tiff': tiff_writer,
 }
-def imwrite(filename,im):
+def imwrite(filename,im,template=None):
     fmt=filename.split('.')[-1]
-    img_writers[fmt](filename,im)
+    img_writers[fmt](filename,im,template)
     print(colors.yellow+filename+colors.green+' saved'+colors.black)
 
+def mrc_header(template):
+    """dtype and header fields of an mrc template"""
+    with mrcfile.open(template,header_only=True) as mrc:
+        return {
+            'dtype'          :mrcfile.utils.data_dtype_from_header(mrc.header),
+            'voxel_size'     :mrc.voxel_size.copy(),
+            'origin'         :mrc.header.origin.copy(),
+            'extended_header':mrc.extended_header.copy(),
+        }
+
+def set_mrc_header(mrc,h):
+    """set the header fields h (see :func:`~mrc_header`) of an open mrc"""
+    if 'voxel_size' in h:mrc.voxel_size = h['voxel_size']
+    if 'origin' in h:mrc.header.origin = h['origin']
+    if h.get('extended_header') is not None and h['extended_header'].size:
+        mrc.set_extended_header(h['extended_header'])
+
+#### stacks
+stack_fmts = {'mrc':'mrc','tif':'tiff','tiff':'tiff'}
+def new_stack(filename,shape,dtype='uint16',template=None):
+    """create a 3D stack (nframes x ny x nx) on disk with its header written once
+
+    The frames are then written in place through :class:`~StackMmap`.
+
+    Parameters
+    ----------
+    filename
+        .mrc (image stack) or .tif/.tiff (multi-page ImageJ tiff)
+    shape
+        (nframes,ny,nx)
+    dtype
+        data type (the dtype of template is used for mrc with a template)
+    template
+        mrc file whose header (voxel size, origin, extended header) is copied
+    """
+    if stack_fmts[filename.split('.')[-1]]=='mrc':
+        h = mrc_header(template) if template else {}
+        dtype = h.get('dtype',dtype)
+        mode = mrcfile.utils.mode_from_dtype(np.dtype(dtype))
+        with mrcfile.new_mmap(filename,shape=shape,mrc_mode=mode,overwrite=True) as mrc:
+            mrc.set_image_stack()
+            set_mrc_header(mrc,h)
+    else:
+        im = tifffile.memmap(filename,shape=shape,dtype=dtype,imagej=True)
+        im.flush();del im
+    return filename
+
+class StackMmap:
+    """writable memory map of the frames of a stack created by :func:`~new_stack`
+
+    Example
+    -------
+    ::
+
+        with StackMmap(filename) as stack:
+            stack[i] = im
+    """
+    def __init__(self,filename):
+        self.mrc = None
+        if stack_fmts[filename.split('.')[-1]]=='mrc':
+            self.mrc  = mrcfile.mmap(filename,'r+')
+            self.data = self.mrc.data
+        else:
+            self.data = tifffile.memmap(filename,mode='r+')
+        #### single frame stacks are read as 2D
+        self.data = self.data.reshape((-1,)+self.data.shape[-2:])
+    def __enter__(self):return self.data
+    def __exit__(self,*args):self.close()
+    def close(self,stats:bool=False):
+        """flush the frames (and update the mrc header statistics if stats)"""
+        if self.mrc:
+            if stats:self.mrc.update_header_stats()
+            self.mrc.close()
+        else:
+            self.data.flush()
+        del self.data
 
 #### reader
 def tiff_reader(tiff_file)  :
@@ -234,3 +321,50 @@ logM = lambda F:-np.log10(np.maximum(F,1e-8))
 #     if not cutoff:cutoff = Fvals.max()
 #     # print(Fvals.max())
 #     fig,ax = dsp.stddisp(plts,lw=2,scat=scat,caxis=[0,cutoff],cmap=cmap,cs='S',title=tle,**kwargs)
+
+def perturb_eigh(gammaj,CjG,dH,c0=None,order=2,cmin=1e-8):
+    """Perturbative update of the eigen decomposition of H+diag(dH)
+
+    Only the Bloch waves excited by the incident beam (abs(c0)**2>cmin)
+    are updated to second order so the cost is that of a few matrix vector
+    products per excited Bloch wave.
+
+    Parameters
+    ----------
+    gammaj,CjG
+        eigen values and eigen vectors (columns) of H
+    dH
+        diagonal perturbation
+    c0
+        excitation of the Bloch waves (all Bloch waves are updated if None)
+    order
+        1(eigen values only) or 2(second order eigen values and first order eigen vectors)
+    cmin
+        minimum relative excitation of the Bloch waves to update
+
+    Returns
+    -------
+    gammaj,CjG
+        updated eigen values and eigen vectors
+    err
+        error estimate (excitation weighted size of the neglected terms)
+    """
+    w = np.ones(gammaj.shape) if c0 is None else abs(c0)**2
+    J = np.where(w>cmin*w.max())[0]
+    #### first order eigen values diag(C^H.dH.C)
+    gammaj = gammaj+(abs(CjG)**2).T.dot(dH)
+    #### excited columns of the perturbation in the eigen basis D=C^H.dH.C
+    D = np.conj(CjG.T).dot(dH[:,None]*CjG[:,J])
+    dg = gammaj[J]-gammaj[:,None]                     #dg[k,j]=g_j-g_k
+    dg[J,np.arange(J.size)] = np.inf
+    W = np.zeros(D.shape,dtype=D.dtype)
+    idx = abs(D)>1e-12*abs(dH).max()
+    W[idx] = D[idx]/dg[idx]                           #W[k,j]=D[k,j]/(g_j-g_k)
+
+    err = np.sqrt(w[J].dot(np.linalg.norm(W,axis=0)**2)/w[J].sum())**order
+    if order>1:
+        CjG = CjG.copy()
+        gammaj[J] += np.real((np.conj(D)*W).sum(axis=0))
+        CJ = CjG[:,J]+CjG.dot(W)
+        CjG[:,J] = CJ/np.linalg.norm(CJ,axis=0)
+    return gammaj,CjG,err
@@ -0,0 +1,174 @@
+"""FFT backends of the python multislice (:class:`~multislice.pymultislice.Multislice`)
+
+- fftpack : scipy.fftpack (single threaded, new arrays at each transform)
+- numpy   : numpy.fft
+- scipy   : scipy.fft multithreaded (`workers`) transforms in the preallocated buffers
+- pyfftw  : planned (wisdom) multithreaded pyFFTW transforms in place in aligned buffers (optional)
+
+Example
+-------
+::
+
+    fft = get_fft((512,512),backend='scipy',workers=4)
+    Psi_q = fft.fft_mul(T,Psi_x)    #fft2(T*Psi_x)
+    Psi_x = fft.ifft_mul(Pq,Psi_q)  #ifft2(Pq*Psi_q)
+"""
+import os,pickle,time
+import numpy as np
+import scipy.fft,scipy.fftpack
+from utils import glob_colors as colors
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+backends = ['fftpack','numpy','scipy','pyfftw']
+
+class FFT:
+    """FFT over axes of arrays of a fixed shape
+
+    The products T*Psi are written directly into the input buffers of the transforms
+    (:meth:`~FFT.fft_mul`, :meth:`~FFT.ifft_mul`).
+    The forward and backward transforms use different buffers so the result of a forward
+    transform remains valid during the next backward transform and vice versa.
+
+    Parameters
+    ----------
+    shape
+        shape of the arrays
+    axes
+        axes of the transform (default all axes)
+    workers
+        number of threads (-1 for all the cores)
+    """
+    name = 'fftpack'
+    def __init__(self,shape,axes=None,workers:int=-1):
+        self.shape   = tuple(shape)
+        self.axes    = tuple(range(len(self.shape))) if axes is None else tuple(axes)
+        self.workers = os.cpu_count() if workers<0 else max(1,workers)
+        self._a = np.zeros(self.shape,dtype=complex)
+        self._b = np.zeros(self.shape,dtype=complex)
+
+    def fft(self,x):
+        return scipy.fftpack.fftn(x,axes=self.axes)
+    def ifft(self,x):
+        return scipy.fftpack.ifftn(x,axes=self.axes)
+
+    def fft_mul(self,a,b):
+        """forward transform of a*b"""
+        np.multiply(a,b,out=self._a)
+        return self._fft_a()
+    def ifft_mul(self,a,b):
+        """backward transform of a*b"""
+        np.multiply(a,b,out=self._b)
+        return self._ifft_b()
+
+    def _fft_a(self):return self.fft(self._a)
+    def _ifft_b(self):return self.ifft(self._b)
+
+class FFT_numpy(FFT):
+    name = 'numpy'
+    def fft(self,x):
+        return np.fft.fftn(x,axes=self.axes)
+    def ifft(self,x):
+        return np.fft.ifftn(x,axes=self.axes)
+
+class FFT_scipy(FFT):
+    name = 'scipy'
+    def fft(self,x):
+        return scipy.fft.fftn(x,axes=self.axes,workers=self.workers)
+    def ifft(self,x):
+        return scipy.fft.ifftn(x,axes=self.axes,workers=self.workers)
+    def _fft_a(self):
+        return scipy.fft.fftn(self._a,axes=self.axes,workers=self.workers,overwrite_x=True)
+    def _ifft_b(self):
+        return scipy.fft.ifftn(self._b,axes=self.axes,workers=self.workers,overwrite_x=True)
+
+class FFT_pyfftw(FFT):
+    """pyFFTW in place planned transforms
+
+    Parameters
+    ----------
+    wisdom
+        file where the FFTW wisdom is loaded from and saved to
+    planner
+        FFTW planner effort (FFTW_ESTIMATE,FFTW_MEASURE,FFTW_PATIENT)
+    """
+    name = 'pyfftw'
+    def __init__(self,shape,axes=None,workers:int=-1,wisdom:str='',planner:str='FFTW_MEASURE'):
+        if pyfftw is None:
+            raise ImportError('pyfftw is required for the pyfftw FFT backend (pip install pyfftw)')
+        super().__init__(shape,axes,workers)
+        if wisdom and os.path.exists(wisdom):
+            with open(wisdom,'rb') as f:pyfftw.import_wisdom(pickle.load(f))
+        self._a = pyfftw.empty_aligned(self.shape,dtype=complex)
+        self._b = pyfftw.empty_aligned(self.shape,dtype=complex)
+        args = dict(axes=self.axes,threads=self.workers,flags=(planner,))
+        self._fwd = pyfftw.FFTW(self._a,self._a,direction='FFTW_FORWARD',**args)
+        self._bwd = pyfftw.FFTW(self._b,self._b,direction='FFTW_BACKWARD',**args)
+        if wisdom:
+            with open(wisdom,'wb') as f:pickle.dump(pyfftw.export_wisdom(),f)
+
+    def fft(self,x):
+        self._a[...] = x
+        return self._fwd().copy()
+    def ifft(self,x):
+        self._b[...] = x
+        return self._bwd().copy()
+    def _fft_a(self):return self._fwd()
+    def _ifft_b(self):return self._bwd()
+
+FFTs = dict(zip(backends,[FFT,FFT_numpy,FFT_scipy,FFT_pyfftw]))
+
+def get_fft(shape,backend:str='scipy',**kwargs):
+    """FFT of arrays of shape with backend (see :data:`~backends`)
+
+    Parameters
+    ----------
+    shape
+        shape of the arrays
+    backend
+        fftpack,numpy,scipy or pyfftw
+    kwargs
+        passed to the backend (axes,workers,wisdom,planner)
+    """
+    if not backend in FFTs:
+        raise Exception('unknown FFT backend %s, available : %s' %(backend,str(backends)))
+    return FFTs[backend](shape,**kwargs)
+
+def benchmark(shapes=[(512,512),(1024,1024),(2048,2048)],
+        fft_args={b:{} for b in backends},nit:int=10,v=True):
+    """Time one multislice step fft(T*Psi_x),ifft(Pq*Psi_q) for the backends
+
+    Parameters
+    ----------
+    shapes
+        shapes of the wave functions
+    fft_args
+        {backend:kwargs} of the backends to compare (those not installed are skipped)
+    nit
+        number of steps timed
+
+    Returns
+    -------
+    dict
+        {(backend,shape):time per step (s)}
+    """
+    times = {}
+    for shape in shapes:
+        T  = np.exp(1J*np.random.rand(*shape))
+        Pq = np.exp(1J*np.random.rand(*shape))
+        for backend,kwargs in fft_args.items():
+            if backend=='pyfftw' and pyfftw is None:continue
+            fft = get_fft(shape,backend,**kwargs)
+            Psi_x = np.ones(shape,dtype=complex)
+            for i in range(nit+1):
+                if i==1:t0 = time.perf_counter()   #first step is warm up
+                Psi_q = fft.fft_mul(T,Psi_x)
+                Psi_x = fft.ifft_mul(Pq,Psi_q)
+            times[(backend,shape)] = (time.perf_counter()-t0)/nit
+            if v:print(colors.green+'%-8s %-12s : %.2f ms/slice' %(backend,str(shape),times[(backend,shape)]*1e3)+colors.black)
+    return times
+
+if __name__=='__main__':
+    benchmark()
@@ -19,6 +19,15 @@ class Multi2D(pymultislice.Multislice):
     - pattern : list of 2d-arrays - [x0,z0,f] where x,z=np.meshgrid(x0,z0)
     - ax,bz : lattice constants
     - **kwargs : see pymultislice.Multislice.__init__
+    #### batch
+    - tilt : float or array - an array of tilts is propagated as a batch sharing the transmission functions
+    - TDS  : the configurations are propagated by batches sharing the propagator
+    psi_xz,psi_qz then have the leading axes of the tilts
+    #### TDS
+    - pattern : [x,z,i] atoms where i is the index of the wobble
+    - psi_xz,psi_qz : intensities averaged over the nTDS configurations
+    - psi_qz_c : averaged amplitude (if coherent)
+    - the propagation cannot be continued after the TDS average (propagate raises an Exception)
     '''
     def __init__(self,pattern,ax,bz,**kwargs):
         self.version = 2.0
@@ -29,31 +38,39 @@ class Multi2D(pymultislice.Multislice):
         super().__init__(pattern,**kwargs)
 
     def run(self,nz,iZs,iZv,opts,v):
+        self._set_batch(np.shape(self.tilt))
         if self.TDS:
             self._TDS(nz,iZs,iZv,opts,v)
         else:
             self._std_mutlislice(nz,iZs,iZv,opts,v)
 
     def _TDS(self,nz,iZs,iZv,opts,v):
-        pattern  = np.vstack([self.pattern + np.array([self.ax*i,0,0]) for i in range(self.Nx)])
-        wobbles  = self.wobble[np.array(pattern[:,-1],dtype=int)][:,None]
-        pattern0 = pattern
-        Na = pattern0.shape[0]
-        self.patterns=[]
-        for iTDS in range(self.nTDS):
-            print(colors.yellow+'configuration %d' %iTDS+ colors.black)
-            pattern[:,:2] = pattern0[:,:2]+(2*np.random.rand(Na,2)-1)*wobbles#*[self.ax,self.bz]
-            self.patterns+=[pattern.copy()]
-            p1 = pg.Wallpaper('p1',self.Nx*self.ax,self.bz,90,pattern,ndeg=self.nx,gen=True)
-            self.pattern = p1.get_potential_grid_p1()
+        self._TDS_average(nz,iZs,iZv,opts,v)
+
+    def _TDS_pattern(self,iTDS):
+        '''atoms of the Nx cells for configuration iTDS'''
+        pattern = np.vstack([self.pattern + np.array([self.ax*i,0,0]) for i in range(self.Nx)])
+        wobbles = self.wobble[np.array(pattern[:,-1],dtype=int)][:,None]
+        pattern[:,:2] += (2*self._TDS_rng(iTDS).random((pattern.shape[0],2))-1)*wobbles#*[self.ax,self.bz]
+        return pattern
 
-            if v:print(colors.blue+'...integrating projected potential...'+colors.black)
+    def _propagate_TDS(self,iTDSs,nz,iZs,iZv,opts,v):
+        '''propagate the configurations iTDSs as a batch, returns the sums of their intensities (and amplitudes)'''
+        atoms,Ts,Vzs = self.pattern,[],[]
+        if v:print(colors.blue+'...integrating projected potential of %d configurations...' %len(iTDSs)+colors.black)
+        for iTDS in iTDSs:
+            p1 = pg.Wallpaper('p1',self.Nx*self.ax,self.bz,90,self._TDS_pattern(iTDS),ndeg=self.nx,gen=True)
+            self.pattern = p1.get_potential_grid_p1()
             self._set_transmission_function()
-            self._set_propagator()
-            self.set_Psi0(iTDS)
-            self.propagate(nz,iZs,iZv,opts,iTDS,v)
-        self.psi_qz=np.abs(self.psi_qz)**2
-        self.pattern=pattern0
+            self.pattern = atoms
+            Ts+=[self.T];Vzs+=[self.Vz]
+        self.T,self.Vz = np.array(Ts),np.array(Vzs)
+        self.batch = self.batch[:-1]+(len(iTDSs),)
+        self._set_propagator()
+        self.set_Psi0()
+        self.propagate(nz,iZs,iZv,opts,0,v)
+        keys = ['psi_xz','psi_qz']+['psi_qz_c']*bool(self.coherent)
+        return {k:self.__dict__[k] for k in keys}
 
     def _std_mutlislice(self,nz,iZs,iZv,opts,v):
         self._set_transmission_function()
@@ -83,8 +100,9 @@ class Multi2D(pymultislice.Multislice):
         nms=len(markers)
         if self.TDS:
             scat = ()
-            for i,p in enumerate(self.patterns):
-                Za = atoms.iloc[p[:,2]]
+            for i in range(self.nTDS):
+                p  = self._TDS_pattern(i)
+                Za = atoms.iloc[np.array(p[:,2],dtype=int)]
                 # print(Za.size)
                 scat += ([p[:,0],p[:,1],Za.s,Za.c,markers[i%nms]] ,)
             dsp.stddisp(scat=scat,labs=['$x$','$z$'])
@@ -101,14 +119,16 @@ class Multi2D(pymultislice.Multislice):
         if isinstance(iSz,slice):iSz=list(np.arange(self.ns)[iSz])
         if isinstance(iSz,list):N=len(iSz)
         if isinstance(cmaps,str):cmaps=[cmaps]*3
+        Vz,T = self.Vz,self.T
+        if self.TDS:Vz,T = Vz[0],T[0] #first configuration
         cs1,cs2,cs3 = dsp.getCs(cmaps[0],N),dsp.getCs(cmaps[1],N),dsp.getCs(cmaps[2],N)
         plts,legElt=[],{}
         if 'V' in Vopt:
-            plts += [[self.x,self.Vz[iSz[i],:].T ,cs1[i]] for i in range(N)]
+            plts += [[self.x,Vz[iSz[i],:].T ,cs1[i]] for i in range(N)]
             legElt[r'$V_z(kV\AA)$']=[cs1[int(N/2)],'-']
         if 'T' in Vopt:
-            plts+= [[self.x,self.T.real[iSz[i],:].T,cs2[i]] for i in range(N)]
-            plts+= [[self.x,self.T.imag[iSz[i],:].T,cs3[i]] for i in range(N)]
+            plts+= [[self.x,T.real[iSz[i],:].T,cs2[i]] for i in range(N)]
+            plts+= [[self.x,T.imag[iSz[i],:].T,cs3[i]] for i in range(N)]
             legElt['$re(T)$']=[cs2[int(N/2)],'-']
             legElt['$im(T)$']=[cs3[int(N/2)],'-']
         return dsp.stddisp(plts,labs=[r'$x(\AA)$',''],#title='Projected potential $V_z$, Transmission function $T$',
@@ -236,13 +256,14 @@ class Multi2D(pymultislice.Multislice):
     ##########################################
     #### get methods
     def getQ(self):return self.q
-    def getI(self):return self.psi_qz[-1,:]
+    def getI(self):return self.psi_qz[...,-1,:]
     def getB(self,iBs='Oa',tol=0,v=0):
         ''' get beam as function of thickness
         - iBs :
             - str - 'O'(include origin) a(all)
             - list - the list of indices of the beams
         - tol : select only beams max(I)>tol*I_max
+        (for a batch of tilts the beams have the leading axes of the tilts)
         '''
         Ib = self.psi_qz/self.nx**2/self.dq
         if isinstance(iBs,list):np.array(iBs)
@@ -250,15 +271,15 @@ class Multi2D(pymultislice.Multislice):
             N   = int(self.nx/2)
             iHs = fft.fftshift(np.arange(-N,N))
             if not 'a' in iBs:
-                Im  = Ib[:,1:].max()    #;print(Im)
-                Imax = Ib.max(axis=0)   #;print(Imax)
+                Im  = Ib[...,1:].max()    #;print(Im)
+                Imax = Ib.reshape((-1,self.nx)).max(axis=0)   #;print(Imax)
                 iHs = iHs[Imax>Im*tol]
             iBs=iHs['O' not in iBs:]
         if isinstance(iBs,list):iBs=np.array(iBs)
         if v:
-            return iBs,Ib[:,iBs]
+            return iBs,Ib[...,iBs]
         else:
-            return Ib[:,iBs]
+            return Ib[...,iBs]
 
     ##################################################################
     ###### main computations
@@ -285,59 +306,63 @@ class Multi2D(pymultislice.Multislice):
         self.dx = self.x[1]-self.x[0]
         self.q  = fft.fftfreq(self.nx,self.dx)
         self.dq = self.q[1]-self.q[0]
-        if self.tilt: #isinstance(tilt,np.ndarray) or isinstance(tilt,list):
-            kx = self.k0*np.sin(self.tilt*np.pi/180)
-            self.Pq = np.exp(self.sg*1J*np.pi*self.dz*(self.q+kx)**2/self.k0)
-        else:
-            self.Pq = np.exp(self.sg*1J*np.pi*self.dz*self.q**2/self.k0)
+        #### one propagator per tilt of the batch
+        tilt = np.reshape(self.tilt,np.shape(self.tilt)+(1,)*bool(self.TDS)+(1,))
+        kx = self.k0*np.sin(tilt*np.pi/180)
+        self.Pq = np.exp(self.sg*1J*np.pi*self.dz*(self.q+kx)**2/self.k0)
         self.nq = int(1/3*self.nx) #prevent aliasing
 
-        if copt:self.Pq[self.nq:-self.nq] = 0
+        if copt:self.Pq[...,self.nq:-self.nq] = 0
 
     def set_Psi0(self,iTDS=0):
-        Psi  = np.ones(self.x.shape,dtype=complex)
-        self.Psi_x = Psi/np.sqrt(np.sum(np.abs(Psi)**2)*self.dx)
-        if self.TDS :
-            if not iTDS :
-                self.psi_xz = np.zeros((0,self.nx))
-                self.psi_qz = np.zeros((0,self.nx),dtype=complex)
-        else:
-            self.psi_xz = np.zeros((0,self.nx))
-            self.psi_qz = np.zeros((0,self.nx))
+        batch = self.__dict__.get('batch',())
+        Psi  = np.ones(batch+self.x.shape,dtype=complex)
+        self.Psi_x = Psi/np.sqrt(np.sum(np.abs(Psi)**2,axis=-1,keepdims=True)*self.dx)
+        if self.TDS :batch = batch[:-1] #configurations are summed
+        self.psi_xz = np.zeros(batch+(0,self.nx))
+        self.psi_qz = np.zeros(batch+(0,self.nx))
+        if self.TDS and self.__dict__.get('coherent'):
+            self.psi_qz_c = np.zeros(batch+(0,self.nx),dtype=complex)
         self.z  = np.array([])
         self.iz = 0
 
     def propagate(self,nz,iZs=1,iZv=1,opts='q',iTDS=0,v=1):
-        '''Propgate over nz slices and save every iZs slices'''
+        '''Propgate over nz slices and save every iZs slices
+        (the batch of wave functions is propagated at once, the intensities of the TDS configurations are summed)'''
+        self._check_TDS_averaged()
         self.nz+=nz
         nzq,z0 = int(nz/iZs),0
         if self.z.size : z0=self.z.max()
         self.z  = np.hstack([self.z,z0+self.dz+np.arange(nzq)*self.dz*iZs ])
-        if 'x' in opts and not iTDS:self.psi_xz = np.vstack([self.psi_xz,np.zeros((nzq,self.nx))])
-        if 'q' in opts and not iTDS:self.psi_qz = np.vstack([self.psi_qz,np.zeros((nzq,self.nx))])
+        batch = self.psi_qz.shape[:-2]
+        if 'x' in opts and not iTDS:self.psi_xz = np.concatenate([self.psi_xz,np.zeros(batch+(nzq,self.nx))],axis=-2)
+        if 'q' in opts and not iTDS:self.psi_qz = np.concatenate([self.psi_qz,np.zeros(batch+(nzq,self.nx))],axis=-2)
+        coh = self.TDS and self.__dict__.get('coherent')
+        if 'q' in opts and coh:self.psi_qz_c = np.concatenate([self.psi_qz_c,np.zeros(batch+(nzq,self.nx))],axis=-2)
         # self.T=fft.fftshfft(self.T)
+        fft_b = self._get_fft(self.Psi_x.shape,axes=(-1,))
         for i in range(nz):
             i_s=i%self.ns
             #print(self.T[i_s,:].shape,self.Psi_x.shape)
-            self.Psi_q = fft.fft(self.T[i_s,:]*self.Psi_x) #periodic assumption
-            if self.copt:self.Psi_q[self.nq:-self.nq] = 0  #prevent aliasing
-            self.Psi_x = fft.ifft(self.Pq*self.Psi_q)
+            self.Psi_q = fft_b.fft_mul(self.T[...,i_s,:],self.Psi_x) #periodic assumption
+            if self.copt:self.Psi_q[...,self.nq:-self.nq] = 0  #prevent aliasing
+            self.Psi_x = fft_b.ifft_mul(self.Pq,self.Psi_q)
             # self.Psi_x = fft.fftshift(fft.ifft(self.Pq*self.Psi_q))
             #save and print out
             msg=''
             if v and (not i%iZv or i==nz-1):
-                Ix2 = np.sum(np.abs(self.Psi_x)**2)*self.dx
-                Iq2 = np.sum(np.abs(self.Psi_q/self.nx)**2)/self.dq #parseval's theorem of the DFT
+                Ix2 = np.mean(np.sum(np.abs(self.Psi_x)**2,axis=-1))*self.dx
+                Iq2 = np.mean(np.sum(np.abs(self.Psi_q/self.nx)**2,axis=-1))/self.dq #parseval's theorem of the DFT
                 msg+='i=%-4d,islice=%-2d I=%.4f, Iq=%.4f ' %(i,i_s,Ix2,Iq2)
             if not i%iZs :
                 if msg and v: msg+='iz=%d, z=%.1f A' %(self.iz, self.z[self.iz])
                 if 'x' in opts:
-                    self.psi_xz[self.iz,:] = np.abs(self.Psi_x)**2
+                    Ix = np.abs(self.Psi_x)**2
+                    self.psi_xz[...,self.iz,:] = Ix.sum(axis=-2) if self.TDS else Ix
                 if 'q' in opts:
-                    if self.TDS:
-                        self.psi_qz[self.iz,:] += self.Psi_q
-                    else:
-                        self.psi_qz[self.iz,:] = np.abs(self.Psi_q)**2
+                    Iq = np.abs(self.Psi_q)**2
+                    self.psi_qz[...,self.iz,:] = Iq.sum(axis=-2) if self.TDS else Iq
+                    if coh:self.psi_qz_c[...,self.iz,:] = self.Psi_q.sum(axis=-2)
                     self.iz+=1
             if msg:print(colors.green+msg+colors.black)
 
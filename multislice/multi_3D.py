@@ -27,6 +27,52 @@ def fv(z,y,x,za,ya,xa,Za):
     z  = r2 - rx2[i];
     vz = y_vz[iz][i] + ( b_vz[iz][i] + ( c_vz[iz][i] + d_vz[iz][i] *z ) *z) *z;
     return vz
+def fv_r2(r2,Za):
+    """vectorized :func:`fv` : projected potential of atom Za at squared distances r2
+
+    The nearest knot of the spline table rx2 is found with searchsorted
+    (the lower one on ties as np.argmin in fv).
+    """
+    iz = Zs[Za]
+    i  = np.clip(np.searchsorted(rx2,r2),1,rx2.size-1)
+    i -= (r2-rx2[i-1])<=(rx2[i]-r2)
+    z  = r2 - rx2[i]
+    return y_vz[iz][i] + ( b_vz[iz][i] + ( c_vz[iz][i] + d_vz[iz][i] *z ) *z) *z
+
+def projected_potential(pattern,dx,dy,nx,ny,chunk=2**20):
+    """projected potential of the atoms pattern on the nx x ny periodic grid
+
+    The atoms of each element share a stencil of pixels within Ai[Za]
+    which is evaluated for all atoms at once (by chunks of `chunk` values)
+    and scatter added into the grid.
+
+    Parameters
+    ----------
+    pattern
+        atoms (natoms x [Z,x,y,...])
+    dx,dy
+        pixel size
+    nx,ny
+        grid size
+    """
+    Vz = np.zeros(nx*ny)
+    Za,xa,ya = pattern[:,:3].T
+    for Z in np.unique(Za):
+        Z = int(Z)
+        idx = Za==Z
+        x0,y0 = xa[idx],ya[idx]
+        #### stencil of the element
+        nax,nay = int(Ai[Z]/dx),int(Ai[Z]/dy)
+        sx,sy = [s.ravel() for s in np.meshgrid(np.arange(-nax,nax+1),np.arange(-nay,nay+1),indexing='ij')]
+        ixa,iya = np.array(x0/dx,dtype=int),np.array(y0/dy,dtype=int)
+        na = max(1,chunk//sx.size)
+        for i in range(0,x0.size,na):
+            ix = ixa[i:i+na,None]+sx
+            iy = iya[i:i+na,None]+sy
+            r2 = (dx*ix-x0[i:i+na,None])**2+(dy*iy-y0[i:i+na,None])**2
+            Vz += np.bincount(((ix%nx)*ny+iy%ny).ravel(),fv_r2(r2,Z).ravel(),minlength=nx*ny)
+    return Vz.reshape((nx,ny))
+
 # fv = lambda z,y,x,za,ya,xa,Za:np.exp(-((np.sqrt(x**2+y**2+z**2)-np.sqrt(xa**2+ya**2+za**2))/Ai[Za]) **2)
 
 
@@ -45,6 +91,17 @@ class Multi3D(pymultislice.Multislice):
     - **kwargs : see pymultislice.Multislice.__init__
     - s_opts : 's'(save object) 'x'(real space), 'q'(reciprocal space) 't'(transmission function)
     - temsim : bool - same implemetation as temsim if True
+    - T_mem : float - memory budget (bytes) of the transmission functions cache
+        (the transmission functions beyond it are spilled to a memory mapped file fullname_T.mmap)
+    #### batch
+    - tilt : 2-list or (ntilts x 2) array - the tilts of an array are propagated as a batch sharing the transmission functions
+    - TDS  : the configurations (atoms displaced by up to wobble A, float or {Z:wobble}) are
+        propagated by batches sharing the propagator (the displacements are the same in every unit cell of the supercell)
+    beams then has the leading axes of the tilts
+    #### TDS
+    - Ib    : beam intensities averaged over the nTDS configurations
+    - beams : averaged beam amplitudes (if coherent else None)
+    - the propagation cannot be continued after the TDS average (propagate raises an Exception)
     Example :
     Multi3D(pattern,ax,by,cz,
         keV=200,Nx=1,tilt=0,dz=1,nz=1,
@@ -54,7 +111,7 @@ class Multi3D(pymultislice.Multislice):
     '''
     def __init__(self,pattern,ax,by,cz,
         nxy=None,Nxy=None,
-        hk=None,hkopt='sr',temsim=True,
+        hk=None,hkopt='sr',temsim=True,T_mem=2**30,
         **kwargs):
         self.version = 1.0
         self.ax  = ax
@@ -65,6 +122,7 @@ class Multi3D(pymultislice.Multislice):
         self.Nxy = Nxy
         self.h,self.k = self._set_beams(hk,hkopt)
         self.temsim   = temsim
+        self.T_mem    = T_mem
         print(colors.red+'\t\t 3D multislice simulation '+colors.black)
         super().__init__(pattern,**kwargs)
 
@@ -72,6 +130,8 @@ class Multi3D(pymultislice.Multislice):
         self.nxy  = self._alias3D(self.nx,self.nxy)
         self.Nxy  = self._alias3D(self.Nx,self.Nxy)
         self.tilt = self._alias3D(self.tilt,None)
+        if not self.tilt.shape:self.tilt = np.array([self.tilt]*2)
+        self._set_batch(self.tilt.shape[:-1])
         self.nx,self.ny     = self.nxy
         self.Nx,self.Ny     = self.Nxy
         self.axby           = np.array([self.ax,self.by])
@@ -82,15 +142,17 @@ class Multi3D(pymultislice.Multislice):
         ## bandwidth limit
         self.q2max = (2/3*min(self.nxy/(2*self.axby)))**2 #prevent aliasing
 
-        self.Psi_x = np.ones(self.nxy)#/np.sqrt(self.nx*self.ny*self.dx*self.dy) #;print((self.Psi_x**2).sum()*self.dx*self.dy)
+        batch = self.batch[:-1] if self.TDS else self.batch #TDS batches allocated in _propagate_TDS
+        self.Psi_x = np.ones(batch+tuple(self.nxy))#/np.sqrt(self.nx*self.ny*self.dx*self.dy) #;print((self.Psi_x**2).sum()*self.dx*self.dy)
         self.iz = 0
         self.Nhk   = self.h.size
-        self.beams = np.zeros((self.Nhk,0),dtype=complex)
+        self.beams = np.zeros(batch+(self.Nhk,0),dtype=complex)
         self.hk = [(h0,k0) for h0,k0 in zip(self.h,self.k)]
         self.z = np.array([])
 
     def update(self,nz):
-        self.beams = np.hstack([ self.beams,np.zeros((self.Nhk,nz),dtype=complex) ])
+        batch = self.beams.shape[:-2]
+        self.beams = np.concatenate([ self.beams,np.zeros(batch+(self.Nhk,nz),dtype=complex) ],axis=-1)
     def _get_z(self,iz=None):
         if not isinstance(iz,int):
             z = self.z.copy()
@@ -105,6 +167,11 @@ class Multi3D(pymultislice.Multislice):
         if isinstance(param,int):param=[param]*2
         return np.array(param)
 
+    def _wobble(self,wobble):
+        '''wobble : float or dict {Z:wobble} - maximum displacement of the atoms in TDS configurations'''
+        if isinstance(wobble,dict):return wobble
+        return {Z:wobble for Z in Zs}
+
     def _set_beams(self,hk,hkopt):
         if isinstance(hk,int):hk=[hk]*2
         if isinstance(hk,list):
@@ -147,7 +214,8 @@ class Multi3D(pymultislice.Multislice):
         - iz : int - slice number
         - opts : str - 'i'(show im(T)) 'r'(show Re(T))
         '''
-        T = self._get_transmission_function(iz,1,self.copt,save,load).T
+        T = self._get_transmission_function(iz,1,self.copt,save,load)
+        T = T.reshape((-1,)+tuple(self.nxy))[0].T #first configuration
         nx,ny = np.array(self.nxy/self.Nxy,dtype=int)
         x,y   = np.meshgrid(np.arange(nx)*self.dx, np.arange(ny)*self.dy)  #;print(x.shape,y.shape,Vz.shape)
         if 'i' in opts:Tz = T.imag
@@ -176,16 +244,21 @@ class Multi3D(pymultislice.Multislice):
         if 'i' in opts:dsp.stddisp(im=[P.imag],pOpt='im',title='im P',**kwargs)
         return Px,Py
 
-    def Bz_show(self,iBs=slice(1,None,None),**kwargs):
+    def Bz_show(self,iBs=slice(1,None,None),ib=0,**kwargs):
+        '''- ib : int or tuple - index of the wave function in the batch (if any)'''
         if isinstance(iBs,list):
             if isinstance(iBs[0],tuple):
                 iBs = [i for i,hk0 in enumerate(self.hk) if hk0 in iBs]
 
-        beams = self.beams[iBs,:]
+        batch = self.__dict__.get('batch')
+        beams,Ib = self.beams,self.__dict__.get('Ib')
+        if batch:beams,Ib = [b[ib] if b is not None else None for b in [beams,Ib]]
+        if self.TDS and beams is None:beams = np.sqrt(Ib) #incoherent only
+        beams = beams[iBs,:]
         hk      = np.array(['(%d_%d,%d_%d)' %(int(h0/self.Nx),h0%self.Nx,int(k0/self.Ny),k0%self.Ny ) for h0,k0 in zip(self.h,self.k)])[iBs]
         t       = self._get_z()
         re,im   = np.real(beams),np.imag(beams)
-        Ib      = np.abs(beams)**2
+        Ib      = Ib[iBs,:] if self.TDS else np.abs(beams)**2
         beams   = [hk,t,re,im,Ib]
         return pp.plot_beam_thickness(beams,**kwargs)
 
@@ -198,69 +271,90 @@ class Multi3D(pymultislice.Multislice):
         self._init_3D_params()
         self._propagator(v)
         self._sort_atoms(v)
-        self.propagate(nz,iZs,iZv,s_opts,v)
+        if self.TDS:
+            self._TDS_average(nz,iZs,iZv,s_opts,v)
+        else:
+            self.propagate(nz,iZs,iZv,s_opts,v)
         if 's' in s_opts:self.save()
 
     def _propagator(self,v=1):
         if v:print(colors.blue+'...Setting propagator...'+colors.black)
         sg,copt = self.sg,self.copt
-        qx,qy = np.meshgrid(fft.fftfreq(self.nx,self.dx), fft.fftfreq(self.ny,self.dy))
+        qx,qy = np.meshgrid(fft.fftfreq(self.nx,self.dx), fft.fftfreq(self.ny,self.dy),indexing='ij')
         q2 = qx**2+qy**2
-        # if self.tilt: #isinstance(tilt,np.ndarray) or isinstance(tilt,list):
-        #     kx = self.k0*np.sin(self.tilt*np.pi/180)
-        #     self.Pq = np.exp(sg*1J*np.pi*self.dz*(self.q+kx)**2/self.k0)
-        # else:
-        self.Pq = np.exp(self.sg*1J*np.pi*self.dz*q2/self.k0)
+        #### one propagator per tilt of the batch
+        tilt = self.tilt.reshape(self.tilt.shape[:-1]+(1,)*bool(self.TDS)+(1,1,2))
+        kx,ky = self.k0*np.sin(np.moveaxis(tilt,-1,0)*np.pi/180)
+        self.Pq = np.exp(self.sg*1J*np.pi*self.dz*((qx+kx)**2+(qy+ky)**2)/self.k0)
         self.bw_mask = q2>self.q2max
-        if copt:self.Pq[self.bw_mask] = 0
+        if copt:self.Pq[...,self.bw_mask] = 0
 
     def _sort_atoms(self,v=1):
         if v:print(colors.blue+'...Sorting atoms per slice...'+colors.black)
-        self.pattern = self.pattern[np.argsort(self.pattern[:,3]),:]
+        self.pattern,self.Zas = self._slice_atoms(self.pattern,v)
+
+    def _TDS_pattern(self,iTDS):
+        '''atoms of the unit cell for configuration iTDS'''
+        pattern = self.pattern[:self.pattern.shape[0]//2,:4].copy() #pattern is replicated once along z
+        wobbles = np.array([self.wobble.get(int(Z),0) for Z in pattern[:,0]])[:,None]
+        pattern[:,1:] += (2*self._TDS_rng(iTDS).random((pattern.shape[0],3))-1)*wobbles
+        pattern[:,1:] %= [self.ax,self.by,self.ez]
+        return pattern
+
+    def _propagate_TDS(self,iTDSs,nz,iZs,iZv,s_opts,v):
+        '''propagate the configurations iTDSs as a batch, returns the sums of their beam intensities (and amplitudes)'''
+        if v:print(colors.blue+'...Displacing atoms for %d configurations...' %len(iTDSs)+colors.black)
+        self.patterns = [self._slice_atoms(self._TDS_pattern(iTDS),v) for iTDS in iTDSs]
+        self.batch = self.batch[:-1]+(len(iTDSs),)
+        self.Psi_x = np.ones(self.batch+tuple(self.nxy))
+        self.beams = np.zeros(self.batch+(self.Nhk,0),dtype=complex)
+        self.clear_T_cache()
+        self.propagate(nz,iZs,iZv,s_opts,v)
+        self.clear_T_cache()
+        self.Ib    = (np.abs(self.beams)**2).sum(axis=-3)
+        self.beams = self.beams.sum(axis=-3) if self.coherent else None
+        return {k:self.__dict__[k] for k in ['Ib','beams'][:1+bool(self.coherent)]}
+
+    def _slice_atoms(self,pattern,v=1):
+        '''sort the atoms of pattern by slice : returns the sorted pattern and the indices Zas of the slices'''
+        pattern = pattern[np.argsort(pattern[:,3]),:]
         #replicate one time along z
-        pattern2 = self.pattern.copy(); pattern2[:,3]   += self.ez
-        self.pattern = np.vstack([self.pattern,pattern2])
-        za  = self.pattern[:,3]
+        pattern2 = pattern.copy(); pattern2[:,3]   += self.ez
+        pattern = np.vstack([pattern,pattern2])
+        za  = pattern[:,3]
         dz  = self.dz
         if self.temsim:
             if v>1:print('TEMSIM sorting ')
             self.zis = np.arange(-0.25*dz,self.ez+dz,dz)
-            self.Zas = np.cumsum(np.histogram(za,self.zis)[0]) #;print(self.Zas)
-            self.Zas = np.hstack([0,self.Zas])
+            Zas = np.cumsum(np.histogram(za,self.zis)[0]) #;print(Zas)
+            Zas = np.hstack([0,Zas])
         else:
             self.zis = np.arange(-dz,self.ez+1.1*dz,dz)
-            self.Zas = np.cumsum(np.histogram(za,self.zis)[0]) #;print(self.Zas)
+            Zas = np.cumsum(np.histogram(za,self.zis)[0]) #;print(Zas)
+        return pattern,Zas
 
-    def _projected_potential(self,iz):
-        dx,dy,dz,Zas = self.dx,self.dy,self.dz,self.Zas
+    def _projected_potential(self,iz,iTDS=None):
+        '''projected potential of slice iz (of configuration iTDS if not None)'''
         nx,ny = np.array(self.nxy/self.Nxy,dtype=int) #unit cell nx,ny
-        zi = iz*self.dz
-        Vz = np.zeros((nx,ny))
-        # print(iz,Zas,Zas.shape)
-        for ia in range(Zas[iz],Zas[iz+1]):
-            # print(ia)
-            Za,xa,ya,za = self.pattern[ia,:4]
-            Za = int(Za)
-            nax,nay = int(Ai[Za]/dx),int(Ai[Za]/dy)               #;print('nax,nay',nax,nay)
-            ixa,iya = int(xa/dx),int(ya/dy)
-            for ix in ixa+np.arange(-nax,nax+1):
-                x = dx*ix
-                for iy in iya+np.arange(-nay,nay+1):
-                    y = dy*iy
-                    Vz[ix%nx,iy%ny] += fv(zi+dz/2,y,x,za,ya,xa,Za)
-        return Vz
+        pattern,Zas = (self.pattern,self.Zas) if iTDS is None else self.patterns[iTDS]
+        pattern = pattern[Zas[iz]:Zas[iz+1]]
+        return projected_potential(pattern,self.dx,self.dy,nx,ny)
 
     def _transmission_function(self,iz=None,v=0,copt=1,save=0,load=0):
+        '''transmission function of slice iz (nTDS x nx x ny for TDS)'''
         if v:print(colors.blue+'...Integrating projected potential...'+colors.black)
-        Vz = self._projected_potential(iz)
+        if self.TDS:
+            Vz = np.array([self._projected_potential(iz,iTDS) for iTDS in range(len(self.patterns))])
+        else:
+            Vz = self._projected_potential(iz)
         Tz = np.exp(1J*self.sig*self.eps*Vz*1e-3)
-        T  = np.zeros(self.nxy,dtype=complex)
-        nx,ny = Tz.shape*self.Nxy
-        T[:nx,:ny] = np.tile(Tz,self.Nxy)
+        T  = np.zeros(Vz.shape[:-2]+tuple(self.nxy),dtype=complex)
+        nx,ny = Tz.shape[-2:]*self.Nxy
+        T[...,:nx,:ny] = np.tile(Tz,self.Nxy)
         if copt:               #prevent aliasing
             if v>1:print(colors.blue+'...bandwidth limit transmission...'+colors.black)
             T = fft.fft2(T)
-            T[self.bw_mask] = 0
+            T[...,self.bw_mask] = 0
             T = fft.ifft2(T)
         if save:
             filename =self.fullname+'_T%s.npy' %str(iz).zfill(3)
@@ -269,37 +363,63 @@ class Multi3D(pymultislice.Multislice):
         return T
 
     def _get_transmission_function(self,iz=None,v=0,copt=1,save=0,load=0):
+        '''Transmission function of slice iz from the cache of the distinct slices
+        (computed or loaded from file (if load) the first time)'''
+        izl = iz
         if iz>self.ns or load:
             izl = iz%self.ns
             if not izl and iz>0:izl=self.ns
+        cache = self._get_T_cache()
+        if izl in cache:return cache[izl]
+        T = None
+        if load:
             filename =self.fullname+'_T%s.npy' %str(izl).zfill(3)
-            try:
-                if v>1:print(colors.green+'iz=%d,is=%d, loading ' %(iz,iz%self.ns)+colors.yellow+filename+colors.black)
+            if os.path.exists(filename):
+                if v>1:print(colors.green+'iz=%d,is=%d, loading ' %(iz,izl)+colors.yellow+filename+colors.black)
                 T = np.load(filename)
-            except:
-                T = self._transmission_function(iz,v,copt,save,load)
-        else:
-            T = self._transmission_function(iz,v,copt,save,load)
+        if T is None:
+            T = self._transmission_function(izl,v,copt,save,load)
+        cache[izl] = T
         return T
 
+    def _get_T_cache(self):
+        if not isinstance(self.__dict__.get('_T_cache'),pymultislice.TCache):
+            shape = ((len(self.patterns),) if self.TDS else ())+tuple(self.nxy)
+            spill = self.fullname+'_T%s.mmap' %['','%d' %os.getpid()][bool(self.TDS)]
+            self._T_cache = pymultislice.TCache(shape,self.ns+1,
+                mem=self.__dict__.get('T_mem',2**30),spill_file=spill)
+        return self._T_cache
+
+    def clear_T_cache(self):
+        """empty the cache of transmission functions (and remove its spill file)"""
+        if self.__dict__.get('_T_cache'):self._T_cache.clear()
+        self.__dict__.pop('_T_cache',None)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop('_T_cache',None)
+        return state
+
     def propagate(self,nz,iZs,iZv,s_opts,v):
+        self._check_TDS_averaged()
         self.update_z(nz)
         if v:print(colors.green+'...Starting propagation loop...'+colors.black)
         save = 't' in s_opts
+        fft_b = self._get_fft(self.Psi_x.shape,axes=(-2,-1))
         for i in range(nz):
             T = self._get_transmission_function(self.iz,v,self.copt,save,'l' in s_opts)
             if v>1:print(colors.blue+'...FFT...'+colors.black)
-            self.Psi_q = fft.fft2(T*self.Psi_x) #periodic assumption
-            self.Psi_x = fft.ifft2(self.Pq*self.Psi_q)
+            self.Psi_q = fft_b.fft_mul(T,self.Psi_x) #periodic assumption
+            self.Psi_x = fft_b.ifft_mul(self.Pq,self.Psi_q)
 
             msg=''
             if v and (not i%iZv or i==nz-1):
-                Ix2 = np.sum(np.abs(self.Psi_x)**2)/(self.nx*self.ny) #*self.dx*self.dy
-                Iq2 = np.sum(np.abs(self.Psi_q/(self.nx*self.ny))**2)#/(self.dqx*self.dqy) #parseval's theorem of the DFT
+                Ix2 = np.mean(np.abs(self.Psi_x)**2) #*self.dx*self.dy
+                Iq2 = np.mean(np.abs(self.Psi_q)**2)/(self.nx*self.ny)#/(self.dqx*self.dqy) #parseval's theorem of the DFT
                 msg+='i=%-4d,z=%-7.3f A, I=%.4f, Iq=%.4f ' %(i,self._get_z(self.iz),Ix2,Iq2)
 
             # if not i%iZs and s_opts :
-            self.beams[:,self.iz] = self.Psi_q[self.h,self.k]/(self.nx*self.ny)
+            self.beams[...,self.iz] = self.Psi_q[...,self.h,self.k]/(self.nx*self.ny)
                 # if 'T' in s_opts:
                 #     np.save('Tz%d.npy' %i,T)
                 # if 'x' in s_opts:
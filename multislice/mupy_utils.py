@@ -7,7 +7,9 @@ from crystals import Crystal
 from scipy.spatial import ConvexHull, convex_hull_plot_2d
 from utils import glob_colors as colors,handler3D as h3d
 from utils import physicsConstants as cst
-from scattering.structure_factor import structure_factor3D
+from scattering.structure_factor import structure_factor3D,structure_factor_hkl
+from EDutils import sf_cache                #; imp.reload(sf_cache)
+from EDutils import utilities as ut         #; imp.reload(ut)
 from utils import displayStandards as dsp   ; imp.reload(dsp)
 from . import rotating_crystal as rcc       #; imp.reload(rcc)
 from . import postprocess as pp             #; imp.reload(pp)
@@ -124,7 +126,10 @@ def get_excitation_errors(K,lat_vec,Nmax=5,Smax=0.02):
     K0 = np.linalg.norm(K)
     Kx,Ky,Kz = K
 
-    (h,k,l),(qx,qy,qz) = get_lattice(lat_vec,Nmax)
+    if Smax:
+        (h,k,l),(qx,qy,qz) = ut.get_shell_lattice(-np.array(K),lat_vec,Smax,Nmax)
+    else:
+        (h,k,l),(qx,qy,qz) = get_lattice(lat_vec,Nmax)
 
     Sw = np.abs(np.sqrt((Kx-qx)**2+(Ky-qy)**2+(Kz-qz)**2) - K0)
     if Smax:
@@ -140,10 +145,10 @@ def get_structure_factor(cif_file,dfout=0,**sf_args):
     returns :
     - (qx,qy,qz),Fhkl
     '''
-    crys = import_crys(cif_file)
+    crys = sf_cache.import_crys(cif_file)
     pattern = np.array([np.hstack([a.coords_fractional,a.atomic_number]) for a in crys.atoms] )
     lat_vec = np.array(crys.reciprocal_vectors)
-    (h,k,l),Fhkl = structure_factor3D(pattern, lat_vec, **sf_args)
+    (h,k,l),Fhkl = sf_cache.structure_factor3D(cif_file,pattern, lat_vec, **sf_args)
     qx = h/crys.lattice_parameters[0]
     qy = k/crys.lattice_parameters[1]
     qz = l/crys.lattice_parameters[2]
@@ -156,22 +161,14 @@ def get_structure_factor(cif_file,dfout=0,**sf_args):
 
 def get_excited_beams(cif_file,K,lat_vec,Nmax,Smax):
     df_Sw   = get_excitation_errors(K,lat_vec,Nmax,Smax)
-    df_Fhkl = get_structure_factor(cif_file,dfout=1,hklMax=Nmax+1)
-
-    hkl0 = df_Sw[['h','k','l']].values
-    hklF = df_Fhkl[['h','k','l']].values
-    ridx = []
-    for r in hkl0:
-        idx = np.where(np.linalg.norm(r-hklF,axis=1)==0)[0]
-        if idx.size:
-            ridx+=[idx[0]]
-
-    Fhkl_0 = df_Fhkl.iloc[ridx]['Fhkl'].values #;print(df_Fhkl.iloc[ridx]);#print(ridx);print(df_Fhkl.shape)
-    df_Sw['Fhkl'] = Fhkl_0
+    crys    = sf_cache.import_crys(cif_file)
+    pattern = np.array([np.hstack([a.coords_fractional,a.atomic_number]) for a in crys.atoms] )
+    df_Sw['Fhkl'] = structure_factor_hkl(pattern,np.array(crys.reciprocal_vectors),
+        df_Sw[['h','k','l']].values)
     return df_Sw
 
 def get_kinematic_intensities(cif_file,K,thick,Nmax=5,Smax=None):
-    crys    = import_crys(cif_file)
+    crys    = sf_cache.import_crys(cif_file)
     lat_vec = np.array(crys.reciprocal_vectors)/(2*np.pi)
     df_Sw   = get_excited_beams(cif_file,K,lat_vec,Nmax,Smax)
 
@@ -1,11 +1,12 @@
 import importlib as imp
-import pickle,matplotlib,os
+import pickle,matplotlib,os,copy,itertools,concurrent.futures
 import numpy as np, pandas as pd
 import scipy.fftpack as fft
 from scipy.integrate import nquad,trapz,quad
 import utils.displayStandards as dsp
 import utils.physicsConstants as cst
 import utils.glob_colors as colors
+from . import fft_backend
 
 class Multislice:
     '''python multislice
@@ -14,6 +15,7 @@ class Multislice:
     #### Parameters
     - keV   : float - electron wavelength (keV)
     - tilt  : float 2-tuple : beam tilt (degrees)
+        (an array of tilts is propagated as a batch of wave functions, see Multi2D,Multi3D)
     - dz    : float - slice thickness
     - nz    : int - number of slices along propagation axis
     - Nz    : int - number of unit cells along propagation axis (Nz takes preference over nz if set)
@@ -23,6 +25,11 @@ class Multislice:
     - TDS    : Use thermal diffuse scattering
     - nTDS   : nb configurations
     - wobble : wobble parameters (see Multislice._wobble for more info  )
+    - TDS_batch : int - number of configurations propagated at once as a batch of wave functions
+    - nproc  : int - number of processes over which the batches are distributed
+    - seed   : int - seed of the independent random streams of the configurations
+        (from the OS if None, stored in self.seed)
+    - coherent : bool - also average the amplitudes of the configurations (coherent part)
     #### aliases
     - ndeg         : alias for nx
     - slice_thick  : alias for dz
@@ -37,13 +44,15 @@ class Multislice:
     - copt : limit bandwidth on propagator option
     - sg   : change the sign of the propagator
     - eps  : scale the strength of the potential
+    - fft_args : dict - FFT backend of the propagation passed to fft_backend.get_fft
+        (ex : {'backend':'pyfftw','workers':4,'wisdom':'fftw.pkl'}, default scipy.fft with all cores)
 
     '''
     def __init__(self,
         pattern,
         keV=200,tilt=0,dz=1,slice_thick=None,nz=0,Nz=None,nx=2**10,Nx=1,
-        TDS=False,nTDS=8,ndeg=None,wobble=0.05,
-        copt=1,eps=1,sg=-1,
+        TDS=False,nTDS=8,ndeg=None,wobble=0.05,TDS_batch=8,nproc=1,seed=None,coherent=False,
+        copt=1,eps=1,sg=-1,fft_args=None,
         iZs=1,s_opts='q',opts=None,iZv=1,v=1,
         ppopt='',name='./unknown',**kwargs):
         self.Mversion = 1.1
@@ -62,10 +71,15 @@ class Multislice:
         self.eps  = eps
         self.copt = copt
         self.sg   = sg
+        self.fft_args = dict(fft_args or {})
         #TDS
         self.TDS    = TDS
         self.nTDS   = nTDS
         self.wobble = self._wobble(wobble)
+        self.TDS_batch = TDS_batch
+        self.nproc    = nproc
+        self.seed     = np.random.SeedSequence(seed).entropy
+        self.coherent = coherent
         #Misc
 
         self._set_name(name)
@@ -116,6 +130,73 @@ class Multislice:
         self.z = np.hstack([self.z,np.arange(self.nz)*self.dz])
         self.update(nz)
 
+    def _set_batch(self,tilts):
+        '''batch of wave functions propagated at once :
+        tilts (shape of the array of tilts) x nTDS configurations (if TDS)'''
+        self.batch = tuple(tilts)+(self.nTDS,)*bool(self.TDS)
+
+    ############################################################################
+    #### TDS
+    def _TDS_rng(self,iTDS):
+        '''independent random stream of configuration iTDS'''
+        return np.random.default_rng(np.random.SeedSequence(self.seed,spawn_key=(iTDS,)))
+
+    def _TDS_average(self,nz,iZs,iZv,opts,v):
+        '''frozen phonon averaging
+
+        The nTDS configurations are propagated by batches of TDS_batch configurations
+        (see _propagate_TDS), the first one in this process and the others in nproc processes.
+        The sums of the batches are reduced as they come (at most 2*nproc batches pending)
+        so the memory does not depend on nTDS.
+        '''
+        blocks = np.array_split(np.arange(self.nTDS),int(np.ceil(self.nTDS/self.TDS_batch)))
+        mp,nproc = copy.copy(self),self.__dict__.get('nproc',1)
+        #### the batches allocate their own wave functions and transmission functions
+        for k in ['Psi_x','Psi_q','beams','Ib','patterns','_T_cache','T','Vz','psi_xz','psi_qz','psi_qz_c']:
+            mp.__dict__.pop(k,None)
+        args = (nz,iZs,iZv,opts,0)
+        if v:print(colors.blue+'...TDS : %d configurations in %d batches...' %(self.nTDS,len(blocks))+colors.black)
+        add  = lambda s:[np.add(sums[k],s[k],out=sums[k]) for k in sums]
+        if nproc<=1:
+            sums = self._propagate_TDS(blocks[0],nz,iZs,iZv,opts,v)
+            for b in blocks[1:]:add(_TDS_block(mp,b,*args))
+        else:
+            todo = iter(blocks[1:])
+            with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as pool:
+                pending = {pool.submit(_TDS_block,mp,b,*args) for b in itertools.islice(todo,2*nproc)}
+                sums = self._propagate_TDS(blocks[0],nz,iZs,iZv,opts,v)
+                while pending:
+                    done,pending = concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:add(future.result())
+                    pending |= {pool.submit(_TDS_block,mp,b,*args) for b in itertools.islice(todo,len(done))}
+        for k,s in sums.items():setattr(self,k,s/self.nTDS)
+        self.batch = self.batch[:-1]
+        self.TDS_averaged = True
+        if v:print(colors.green+'TDS : %d configurations averaged' %self.nTDS+colors.black)
+
+    def _check_TDS_averaged(self):
+        if self.__dict__.get('TDS_averaged'):
+            raise Exception('the propagation cannot be continued after a TDS average (the wave functions of the configurations are not kept)')
+
+    ############################################################################
+    #### FFT
+    def _get_fft(self,shape,**kwargs):
+        '''FFT backend for wave functions of shape (see multislice.fft_backend)
+        rebuilt when shape, fft_args or kwargs (axes) change'''
+        fft_args = dict(self.__dict__.get('fft_args') or {})
+        fft_args.update(kwargs)
+        key = (tuple(shape),repr(sorted(fft_args.items())))
+        if not self.__dict__.get('_fft_key')==key:
+            self._fft     = fft_backend.get_fft(shape,**fft_args)
+            self._fft_key = key
+        return self._fft
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_fft',None)
+        state.pop('_fft_key',None)
+        return state
+
     def save(self,file):
         with open(file,'wb') as out :
             pickle.dump(self, out, pickle.HIGHEST_PROTOCOL)
@@ -137,9 +218,66 @@ class Multislice:
         if 'Y' in ppopt:self.Qxz_show(name=name+'Xxz.png',**kwargs)
 
 
+class TCache:
+    """Cache of the transmission functions of the distinct slices
+
+    The transmission functions are kept in memory up to a memory budget,
+    the next ones are spilled to a memory mapped file.
+
+    Parameters
+    ----------
+    shape
+        shape of the transmission functions
+    nslots
+        maximum number of distinct slices
+    mem
+        memory budget (bytes)
+    spill_file
+        memory mapped file used beyond the memory budget
+    """
+    def __init__(self,shape,nslots,mem=2**30,spill_file=''):
+        self.shape,self.nslots = tuple(shape),nslots
+        self.mem,self.spill_file = mem,spill_file
+        self.T,self.slots,self.nbytes = {},{},0
+        self.mmap = None
+
+    def __contains__(self,key):
+        return key in self.T or key in self.slots
+
+    def __getitem__(self,key):
+        if key in self.T:return self.T[key]
+        return self.mmap[self.slots[key]]
+
+    def __setitem__(self,key,T):
+        if self.nbytes+T.nbytes<=self.mem:
+            self.T[key] = T
+            self.nbytes += T.nbytes
+            return
+        if self.mmap is None:
+            self.mmap = np.memmap(self.spill_file,dtype=complex,mode='w+',
+                shape=(self.nslots,)+self.shape)
+        self.slots[key] = len(self.slots)
+        self.mmap[self.slots[key]] = T
+
+    def __len__(self):
+        return len(self.T)+len(self.slots)
+
+    def clear(self):
+        """empty the cache and remove the spill file"""
+        self.T,self.slots,self.nbytes = {},{},0
+        if self.mmap is not None:
+            del self.mmap
+            self.mmap = None
+            if os.path.exists(self.spill_file):os.remove(self.spill_file)
+
+
 ##################################################################
 #### misc functions
 ##################################################################
+def _TDS_block(mp,iTDSs,*args):
+    '''worker of Multislice._TDS_average : sums over the configurations iTDSs'''
+    return copy.copy(mp)._propagate_TDS(iTDSs,*args)
+
 def load(filename):
     '''load a saved object'''
     with open(filename,'rb') as f : multi = pickle.load(f)
@@ -1,10 +1,11 @@
 import utils.displayStandards as dsp
+from utils import glob_colors as colors
 from . import scattering_factors as scatf
 import numpy as np
 from math import pi
 
 __all__=['structure_factor3D','plot_structure3D','get_miller3D',
-        'get_pendulossung']
+        'get_pendulossung','phase_sum','structure_factor_hkl','Fhkl_store']
 
 #2D for factors
 ai = 1/np.array([0.1,0.25,0.26,0.27,1.5])**2
@@ -19,7 +20,8 @@ def structure_factor3D(pattern,lat_vec,hkl=None,hklMax=10,sym=1,v=''):
     - `hklMax`  : int - max miller index in each direction from -hklMax to hklMax
     '''
     #unpack
-    if not hkl : hkl = get_miller3D(hklMax,sym)
+    grid = not hkl
+    if grid : hkl = get_miller3D(hklMax,sym)
     hx,ky,lz = hkl
     # print('rearranging h,k,l so h[(hi,k,l)]=hi')
     hx,ky,lz = np.transpose(hx,[1,0,2]),np.transpose(ky,[1,0,2]),np.transpose(lz,[1,0,2])
@@ -34,13 +36,15 @@ def structure_factor3D(pattern,lat_vec,hkl=None,hklMax=10,sym=1,v=''):
     if 'q' in v:qmax=q.max();print('qmax=%.4f A^-1\nmax_res=%.4f A' %(qmax,1/qmax))
     #structure factor
     Fhkl,n_atoms = np.zeros(hx.shape,dtype=complex),len(atoms)
+    Nhkl = hx[:,0,0],ky[0,:,0],lz[0,0,:]
     for i,atom in zip(range(n_atoms),atoms):
-        F_i = np.zeros(hx.shape,dtype=complex)
         idx = fa==atom
-        for ri in ra[idx,:]:
-            # print(ri)
-            # print(ri,np.exp(-2*pi*1J*(ri[0]*hx+ri[1]*ky+ri[2]*lz)))
-            F_i += np.exp(-2*pi*1J*(ri[0]*hx+ri[1]*ky+ri[2]*lz))
+        if grid:
+            F_i = phase_sum(ra[idx,:],Nhkl,sign=-1)
+        else:
+            F_i = np.zeros(hx.shape,dtype=complex)
+            for ri in ra[idx,:]:
+                F_i += np.exp(-2*pi*1J*(ri[0]*hx+ri[1]*ky+ri[2]*lz))
         Fhkl += F_i*fq[i]
 
     # cs=dsp.getCs('Spectral',n_atoms)
@@ -68,14 +72,112 @@ def structure_factor2D(pattern,lat_vec,hk=None,hkMax=10,sym=1,v=0,eps=1):
     if v : qmax=q.max();print('qmax=%.4f A^-1\nmax_res=%.4f A' %(qmax,1/qmax))
     #compute structure factor
     Fhl,n_atoms = np.zeros(hx.shape,dtype=complex),len(atoms)
+    Nhk = hx[:,0],ky[0,:]
     for i,atom in zip(range(n_atoms),atoms):
-        F_i = np.zeros(hx.shape,dtype=complex)
         idx = fa==atom
-        for ri in ra[idx,:]:
-            F_i += np.exp(2*pi*1J*(ri[0]*hx+ri[1]*ky))
-        Fhl += F_i*fq[i]
+        Fhl += phase_sum(ra[idx,:],Nhk,sign=1)*fq[i]
     return hl,Fhl
 
+def phase_sum(r,Nhkl,sign=-1,nmax=2**24):
+    '''Sum over atoms of the phase factors exp(sign*2i*pi*r.hkl) on a Miller grid
+    - `r`    : natoms x ndim fractional coordinates
+    - `Nhkl` : ndim 1D arrays of Miller indices along each direction
+    - `sign` : sign of the phase
+    - `nmax` : max number of elements of the intermediate arrays (atoms are processed by chunks)
+
+    The phase factor is separable (outer product of 1D phase vectors along each direction)
+    so the sum over atoms is a matrix product.
+    '''
+    Ei = [np.exp(sign*2J*pi*np.outer(r[:,i],N)) for i,N in enumerate(Nhkl)]
+    shape = tuple(N.size for N in Nhkl)
+    if len(Nhkl)==2:
+        return Ei[0].T.dot(Ei[1])
+    Ex,Ey,Ez = Ei
+    F = np.zeros(shape,dtype=complex)
+    na = max(1,nmax//(shape[0]*shape[1]))
+    for i in range(0,r.shape[0],na):
+        Exy = (Ex[i:i+na,:,None]*Ey[i:i+na,None,:]).reshape(Ex[i:i+na].shape[0],-1)
+        F += Exy.T.dot(Ez[i:i+na]).reshape(shape)
+    return F
+
+def structure_factor_hkl(pattern,lat_vec,hkl,nmax=2**24):
+    '''Computes structure factor at a list of Miller indices :
+    - `pattern` : Nx4 array - N atoms with each row : fractional coordinates and Za
+    - `lat_vec` : 3x3 array - reciprocal lattice vectors (2*pi/a convention)
+    - `hkl`     : nx3 array of Miller indices
+    - `nmax`    : max number of elements of the intermediate arrays (reflections are processed by chunks)
+    '''
+    hkl = np.array(hkl,dtype=int).reshape(-1,3)
+    ra,fa = pattern[:,:3],pattern[:,3]
+    atoms = list(np.array(np.unique(fa),dtype=int))
+    q = np.linalg.norm(hkl.dot(lat_vec),axis=1)/(2*pi)
+    q,fq = scatf.get_elec_atomic_factors(atoms,q)
+    Fhkl = np.zeros(hkl.shape[0],dtype=complex)
+    nh = max(1,nmax//max(1,ra.shape[0]))
+    for i,atom in enumerate(atoms):
+        r = ra[fa==atom,:].T
+        for j in range(0,hkl.shape[0],nh):
+            Fhkl[j:j+nh] += fq[i][j:j+nh]*np.exp(-2J*pi*hkl[j:j+nh].dot(r)).sum(axis=1)
+    return Fhkl
+
+class Fhkl_store:
+    '''Sparse structure factor computed on demand and memoized
+    - `pattern` : Nx4 array - N atoms with each row : fractional coordinates and Za
+    - `lat_vec` : 3x3 array - reciprocal lattice vectors (2*pi/a convention)
+    - `hklMax`  : int - max miller index in each direction from -hklMax to hklMax
+
+    Reflections are identified by their flat index in the virtual (2*hklMax+1)^3 grid
+    (see `shape`) so that `store.take(idx)` is equivalent to `Fhkl.ravel()[idx]`
+    for the dense grid returned by structure_factor3D while only the requested
+    reflections are ever computed.
+    '''
+    def __init__(self,pattern,lat_vec,hklMax=10):
+        self.pattern = pattern
+        self.lat_vec = np.array(lat_vec)
+        self.hklMax  = hklMax
+        self.shape   = (2*hklMax+1,)*3
+        self.keys    = np.array([],dtype=int)
+        self.Fhkl    = np.array([],dtype=complex)
+
+    def __len__(self):
+        return self.keys.size
+
+    def get_idx(self,hkl):
+        '''flat indices of the Miller indices hkl (...x3 array)'''
+        hkl = np.array(hkl,dtype=int)
+        return np.ravel_multi_index(np.moveaxis(hkl+self.hklMax,-1,0),self.shape)
+
+    def take(self,idx):
+        '''structure factor at flat indices idx (any shape)'''
+        idx = np.asarray(idx)
+        pos = self._find(idx)
+        if isinstance(pos,type(None)):
+            new = np.setdiff1d(idx,self.keys)
+            hkl = np.array(np.unravel_index(new,self.shape)).T-self.hklMax
+            F   = structure_factor_hkl(self.pattern,self.lat_vec,hkl)
+            keys,Fhkl = np.hstack([self.keys,new]),np.hstack([self.Fhkl,F])
+            order = np.argsort(keys)
+            self.keys,self.Fhkl = keys[order],Fhkl[order]
+            pos = self._find(idx)
+        return self.Fhkl[pos]
+
+    def __getitem__(self,hkl):
+        '''structure factor at Miller indices hkl (...x3 array)'''
+        return self.take(self.get_idx(hkl))
+
+    def dense(self):
+        '''hkl,Fhkl over the full grid as returned by structure_factor3D'''
+        hkl = [np.transpose(i,[1,0,2]) for i in get_miller3D(self.hklMax,sym=1)]
+        idx = self.get_idx(np.stack(hkl,axis=-1))
+        return hkl,self.take(idx)
+
+    def _find(self,idx):
+        '''positions of idx in the store (None if some are missing)'''
+        if not self.keys.size:return
+        pos = np.minimum(np.searchsorted(self.keys,idx),self.keys.size-1)
+        if np.array_equal(self.keys[pos],idx):
+            return pos
+
 ###
 def get_pendulossung(name='Si',miller=[0,0,0],keV=200,opt='p'):
     ''' give the theorertical 2-beam approximation Pendullosung thickness
@@ -90,15 +192,15 @@ def get_pendulossung(name='Si',miller=[0,0,0],keV=200,opt='p'):
     crys = Crystal.from_database(name)
     lat_vec  = crys.reciprocal_vectors
     pattern  = np.array([list(a.coords_fractional)+[a.atomic_number] for a in crys.atoms])
-    hkl,Fhkl = structure_factor3D(pattern,lat_vec,hklMax=max(miller),sym=0,v='')
+    Fhkl     = structure_factor_hkl(pattern,lat_vec,[miller])
     ax,by,cz = crys.lattice_parameters[:3]
     Vcell    = crys.volume
     # compute Pendullosung
     h,k,l = miller
-    Ug,K  = np.abs(Fhkl[h,k,l])/Vcell,1/scatf.wavelength(keV)
+    Ug,K  = np.abs(Fhkl[0])/Vcell,1/scatf.wavelength(keV)
     xi  = K/Ug
     if 'p' in opt:
-        print(green+"\tPendullosung thickness "+name+'[%d%d%d]' %(h,k,l)+black)
+        print(colors.green+"\tPendullosung thickness "+name+'[%d%d%d]' %(h,k,l)+colors.black)
         print('%-5s= %.2f\n%-5s= %.2f\n%-5s= %.2f'%('K',K,'Ug',Ug,'xi',xi))
     return xi
 
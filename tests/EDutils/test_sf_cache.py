@@ -0,0 +1,29 @@
+from utils import*
+from EDutils import sf_cache        ;imp.reload(sf_cache)
+from utils import pytest_util       ;imp.reload(pytest_util)
+from scattering import structure_factor as sf
+plt.close('all')
+
+out,ref,dir = pytest_util.get_path(__file__)
+sf_cache.cache_dir = os.path.join(out,'cache')
+
+def test_structure_factor3D():
+    sf_cache.clear(disk=True)
+    crys = sf_cache.import_crys('diamond')
+    pattern = np.array([np.hstack([a.coords_fractional,a.atomic_number]) for a in crys.atoms])
+    lat_vec = np.array(crys.reciprocal_vectors)
+    hkl,Fhkl = sf_cache.structure_factor3D('diamond',pattern,lat_vec,hklMax=3)
+    assert len(os.listdir(sf_cache.cache_dir))==2
+    #from memory
+    assert sf_cache.structure_factor3D('diamond',pattern,lat_vec,hklMax=3)[1] is Fhkl
+    #from disk
+    sf_cache.clear()
+    hkl1,Fhkl1 = sf_cache.structure_factor3D('diamond',pattern,lat_vec,hklMax=3)
+    assert np.allclose(Fhkl1,sf.structure_factor3D(pattern,lat_vec,hklMax=3)[1])
+    #different parameters
+    assert sf_cache.structure_factor3D('diamond',pattern,lat_vec,hklMax=2)[1].shape==(5,)*3
+    #modified pattern
+    pattern[0,:3] += 0.1
+    Fhkl2 = sf_cache.structure_factor3D('diamond',pattern,lat_vec,hklMax=3)[1]
+    assert np.allclose(Fhkl2,sf.structure_factor3D(pattern,lat_vec,hklMax=3)[1])
+    assert not np.allclose(Fhkl2,Fhkl)
@@ -32,6 +32,19 @@ def test_sweep():
     print('df2[1 ] : ',ut.load_pkl(df2.iloc[1].pkl))
     print('df3[-1] : ',ut.load_pkl(df3.iloc[-1].pkl))
 
+def test_sweep_resume():
+    vals = np.arange(4)
+    df1 = ut.sweep_var(C,path='dat/sweep',params='a',vals=vals,tag='par',nproc=2)
+    manifest = 'dat/sweep/df_par.manifest'
+    lines = open(manifest).read().split('\n')
+    with open(manifest,'w') as f:f.write('\n'.join(lines[:3])+'\n')
+    done = []
+    df2 = ut.sweep_var(C,path='dat/sweep',params='a',vals=vals,tag='par',resume=True,
+        callback=lambda i,obj:done.append(i))
+    assert (df1==df2).all().all()
+    assert sorted(done)==list(range(4))
+    assert [ut.load_pkl(pkl).a for pkl in df2.pkl]==list(vals)
+
 
 @pytest_util.cmp_ref(__file__)
 def test_get_uvw_cont():
@@ -74,6 +87,16 @@ def test_convert2tiff():
 
 
 
+def test_sliding_sum():
+    ims = np.random.rand(11,4,4)
+    for n in [1,2,3,4]:
+        out = list(ut.sliding_sum(enumerate(ims),n,11))
+        assert [i for i,im in out]==list(range((10+n//2)//n+1))
+        for i,im in out:
+            assert np.allclose(im,ims[max(0,i*n-n//2):i*n+n//2+1].sum(axis=0)/n)
+    out = list(ut.sliding_sum(enumerate(ims),3,11,frames=(1,2)))
+    assert [i for i,im in out]==[1,2]
+
 def test_import_crys():
     ut.import_crys('diamond')
     ut.import_crys('pets/alpha_glycine.cif')
@@ -89,6 +112,15 @@ def test_remove_friedel_pairs():
     refl = [str(tuple(h)) for h in hkl]
     print(ut.remove_friedel_pairs(refl))
 
+def test_ewald_shell():
+    lat_vec = np.array([[0.3,0,0],[0.05,0.25,0],[0,0.02,0.2]])
+    K,Smax,Nmax = 40*np.array([0.1,0.2,1])/np.linalg.norm([0.1,0.2,1]),0.05,8
+    (h,k,l),(qx,qy,qz) = ut.get_lattice(lat_vec,Nmax)
+    idx = abs(np.sqrt((K[0]+qx)**2+(K[1]+qy)**2+(K[2]+qz)**2)-40)<Smax
+    df = ut.get_excitation_errors(K,lat_vec,Nmax=Nmax,Smax=Smax)
+    assert np.array_equal(df[['h','k','l']].values,np.array([h[idx],k[idx],l[idx]]).T)
+    chunks = list(ut.get_ewald_shell(K,lat_vec,Smax,Nmax,chunk=10))
+    assert sum([c[0][0].size for c in chunks])>=idx.sum()
 
 
 ################################################################################
@@ -67,6 +67,14 @@ def test_beam_thickness():
     # b0.__dict__.pop('Iz')
     b0.get_beams_vs_thickness(dict_opt=True)
 
+def test_beam_thickness_subset():
+    b = copy.copy(b0)
+    b._set_beams_vs_thickness(thicks=(0,200,50))
+    Iz = b.Iz.copy()
+    idx = b.get_beam()
+    b._set_beams_vs_thickness(thicks=(0,200,50),idx=idx,nz=7)
+    assert np.allclose(b.Iz[idx],Iz[idx])
+
 def test_gets():
     b0.get_Xig()
     b0.get_Sw()
@@ -89,6 +97,83 @@ def test_bloch_convergence():
     b.convergence_test(Smax=Smax,Nmax=Nmax)#,hkl=refl)
     return b.show_convergence(hkl=refl,xlab='Nmax',opt='')
 
+def test_solve_sweep():
+    uvw = np.array([[0,0.01*i,1] for i in range(3)])
+    b = bloch.Bloch('diamond',path=out,keV=200,u=uvw[0],Nmax=6,Smax=0.05,solve=False)
+    pkls = b.solve_sweep(uvw,names=['sweep%d' %i for i in range(3)],thick=100,opts='s')
+    for u,pkl in zip(uvw,pkls):
+        b1 = bloch.Bloch('diamond',path=out,keV=200,u=u,Nmax=6,Smax=0.05,thick=100,opts='t')
+        b2 = bloch_util.load_bloch(file=pkl)
+        assert np.allclose(b1.df_G.I.values,b2.df_G.I.values)
+
+def test_solve_perturbative():
+    u0 = np.array([0.1,0.2,1])
+    b = bloch.Bloch('diamond',path=out,keV=200,u=u0,Nmax=6,Smax=0.05,save=False,opts='')
+    hkl = b.get_hkl()
+    assert b.solve_perturbative(u0)==0 #reference
+    errs = []
+    for du in [1e-4,2e-4]:
+        u = u0+[du,0,0]
+        err = b.solve_perturbative(u,order=2,tol=1,thick=200)
+        b1 = bloch.Bloch('diamond',path=out,keV=200,u=u,Nmax=6,solve=False,save=False)
+        b1.solve(hkl=hkl,thick=200,opts='')
+        assert err>0 and abs(b.df_G.I.values-b1.df_G.I.values).max()<5*err
+        errs += [err]
+    assert 3<errs[1]/errs[0]<5
+    #### error estimate too large : full solve
+    assert b.solve_perturbative(u0+[1e-2,0,0],tol=1e-3,thick=200)==0
+    assert np.allclose(b.gammaj,b._pert['gammaj'])
+
+    uvw = np.array([[0,1e-4*i,1] for i in range(5)])
+    pkls = b.solve_sweep(uvw,names=['pert%d' %i for i in range(5)],thick=100,opts='s',order=2,tol=1e-3)
+    for u,pkl in zip(uvw,pkls):
+        b1 = bloch.Bloch('diamond',path=out,keV=200,u=u,Nmax=6,solve=False,save=False)
+        b1.solve(hkl=b.get_hkl(),thick=100,opts='')
+        b2 = bloch_util.load_bloch(file=pkl)
+        assert abs(b1.df_G.I.values-b2.df_G.I.values).max()<1e-2
+
+def test_solve_batch():
+    uvw = np.array([[0,0.01*i,1] for i in range(3)])
+    b = bloch.Bloch('diamond',path=out,keV=200,u=uvw[0],Nmax=6,Smax=0.05,solve=False)
+    hkl,gammaj,CjG = b.solve_batch(uvw)
+    assert gammaj.shape==(3,hkl.shape[0]) and CjG.shape==(3,)+(hkl.shape[0],)*2
+    b.set_beam(u=uvw[-1])
+    b.solve(hkl=hkl,Smax=0,opts='')
+    assert np.allclose(gammaj[-1],b.gammaj)
+
+def test_bethe():
+    b = bloch.Bloch('diamond',path=out,keV=200,u=[1,3,17],Nmax=8,Smax=0.1,
+        thicks=(0,300,30),opts='z')
+    Iz = pd.DataFrame(b.Iz,index=b.df_G.index)
+    b.solve(thicks=(0,300,30),opts='z',bethe={'strong':3e-3})
+    assert b.nbeams<Iz.shape[0]
+    assert abs(b.Iz-Iz.loc[b.df_G.index].values).max()<1e-2
+
+def test_Fhkl_store():
+    from scattering import structure_factor as sf
+    lat_vec  = 2*np.pi*b0.lat_vec
+    hkl,Fhkl = sf.structure_factor3D(b0.pattern,lat_vec,hklMax=2*b0.Nmax)
+    store = sf.Fhkl_store(b0.pattern,lat_vec,hklMax=2*b0.Nmax)
+    hkl_G = b0.df_G[['h','k','l']].values
+    assert np.allclose(store[hkl_G],b0.get_Fhkl(hkl_G))
+    assert len(store)==hkl_G.shape[0]
+    assert np.allclose(store.dense()[1],Fhkl)
+
+def test_store():
+    b = bloch.Bloch('diamond',path=out,name='store',keV=200,u=[1,3,17],Nmax=6,Smax=0.05,
+        thicks=(0,300,30),opts='sz',store=dict(dtype='float32',compress=True))
+    assert os.path.exists(os.path.join(out,'store.npz'))
+    b1 = bloch_util.load_bloch(file=b._get_pkl())
+    assert b1.df_G.shape==b.df_G.shape and not 'CjG' in b1.__dict__
+    assert b1.Iz.dtype==np.float32 and not 'CjG' in b1.__dict__
+    assert np.allclose(b1.Iz,b.Iz,atol=1e-6)
+    b.set_thickness(200)
+    b1.set_thickness(200)
+    assert np.allclose(b1.df_G.I,b.df_G.I)
+
+    b2 = bloch.Bloch('diamond',path=out,name='nosave',keV=200,u=[0,0,1],Nmax=6,Smax=0.05,save=False)
+    assert not os.path.exists(b2._get_pkl())
+
 def test_load_bloch():
     b = bloch_util.load_bloch(file=out+'/diamond001_200keV_bloch.pkl')
     bloch_util.load_bloch(path='.')
@@ -2,7 +2,7 @@ from utils import*                  ;imp.reload(dsp)
 from EDutils import utilities as ut ;imp.reload(ut)
 from blochwave import bloch_pp as bl;imp.reload(bl)
 from utils import pytest_util
-import pytest,os
+import pytest,os,glob
 plt.close('all')
 
 tag='big' #do not change as it messes up with the cmp_ref
@@ -27,6 +27,24 @@ except Exception as e:
 def test_load():
     rock.load(0)
 
+def test_cache():
+    rock.clear_cache()
+    b0 = rock.load(0)
+    assert rock.load(0) is b0
+    rock.set_cache(1)
+    rock.load(0);rock.load(1)
+    assert list(rock._cache.keys())==[1]
+    rock.set_cache()
+    rock.do('set_thickness',thick=100,v=0)
+    assert rock.load(0).thick==100
+
+def test_do_parallel():
+    rock.do('set_thickness',thick=150,v=0,nproc=2)
+    assert rock.load(1).thick==150
+    I  = rock.map('get_intensities',frames=[0,1],nproc=2)[1]
+    Sz = rock.map('_get_Sz',frames=[1],z=np.array([150]))[0]
+    assert np.allclose(I,np.abs(Sz[:,0])**2)
+
 @pytest.mark.lvl1
 @pytest_util.add_link(__file__)
 def test_show_tiff():
@@ -35,6 +53,40 @@ def test_show_tiff():
         h=False)
     return vw.fig,vw.ax
 
+def test_sum_images():
+    import tifffile
+    n,nmax = 4,10
+    rock.convert2tiff(thick=200,Imax=1e6,aperpixel=0.01,n=n,nmax=nmax,render=True)
+    sum_path=os.path.join(rock.figpath,'sum')
+    ims = np.array([tifffile.imread(rock.figpath+'/%s.tiff' %name) for name in rock.df.index[:11]],dtype=float)
+    sum_files = np.sort(glob.glob(sum_path+'/*.tiff'))
+    sums = [tifffile.imread(f) for f in sum_files]
+    assert len(sums)==3
+    for i,im in enumerate(sums):
+        assert np.allclose(im,ims[max(0,i*n-n//2):i*n+n//2+1].sum(axis=0)/n)
+    #### summing the tiff files gives the same
+    rock.convert2tiff(n=n,nmax=nmax)
+    assert all([np.allclose(tifffile.imread(f),im) for f,im in zip(sum_files,sums)])
+
+def test_make_stack():
+    import tifffile,mrcfile
+    kwargs = dict(thick=200,Imax=1e6,aperpixel=0.01,Nmax=128)
+    tiff_file = rock.make_stack(out+'/stack.tiff',frames=range(5),**kwargs)
+    ims = tifffile.imread(tiff_file)
+    assert ims.shape==(5,128,128) and len(tifffile.TiffFile(tiff_file).pages)==5
+    for i in [0,4]:
+        assert np.array_equal(ims[i],rock.load(i)._make_tiff_img(**kwargs))
+    mrc_file = rock.make_stack(out+'/stack.mrc',frames=range(5),nproc=2,dtype='float32',**kwargs)
+    with mrcfile.open(mrc_file) as mrc:
+        assert mrc.is_image_stack() and np.allclose(mrc.data.transpose(0,2,1),ims,atol=1)
+    #### header and dtype of the template
+    b0 = rock.load(0)
+    b0.convert2img(out+'/template.mrc',template=mrc_file,**kwargs)
+    with mrcfile.mmap(out+'/template.mrc','r+') as mrc:mrc.voxel_size=0.5
+    rock.make_stack(out+'/stack_t.mrc',frames=[1],template=out+'/template.mrc',**kwargs)
+    with mrcfile.open(out+'/stack_t.mrc') as mrc:
+        assert mrc.voxel_size.x==0.5 and mrc.data.dtype==np.float32
+
 @pytest.mark.lvl1
 @pytest_util.add_link(__file__)
 def test_plot_rocking_cond():
@@ -47,6 +99,63 @@ def test_plot_rocking_cond():
 def test_plot_rocking_quick():
     return rock.plot_rocking(refl=[str((2,2,0))],zs=[50,100],opts='',opt='')
 
+def test_index():
+    h  = rock.beams.index[rock.beams.n.argmax()]
+    df = rock.get_frames(h)
+    for f,Sw in df[['frame','Sw']].values[:3]:
+        assert np.isclose(rock.load(int(f)).df_G.loc[h,'Sw'].real,Sw)
+    refl,nbs = rock.get_beams(cond='(Sw<1e-2) & (I>1e-3)',opts='F')
+    assert all([(rock._get_beam_frames(h).eval('(Sw<1e-2) & (I>1e-3)')).any() for h in refl])
+
+def test_store():
+    store = rock._get_store()
+    rows  = store.get_rows()
+    assert rows.size==rock.df_frames.shape[0]
+    b0 = rock.load(2)
+    idx = store.get_offsets()[2]+np.arange(b0.df_G.shape[0])
+    assert np.allclose(store.get_Iz(idx),b0.Iz)
+    assert (rows['h'][idx]==b0.df_G.h.values).all()
+
+def test_store_duplicates():
+    from EDutils import rotate_exp as exp
+    store = exp.RockStore(out,'dup')
+    store.reset()
+    z,hkl = np.arange(3),np.zeros((2,3),dtype=int)
+    frame = lambda i,I:store.append_frame(i,hkl,np.zeros(2),np.full((2,3),I),np.zeros((2,3)),z)
+    for i,I in [(0,1),(1,2),(1,3),(0,4),(2,5),(2,6)]:frame(i,I)
+    I = lambda:store.get_Iz(store.get_offsets()[:,None]+np.arange(2))[:,:,0]
+    assert (I()==[[4]*2,[3]*2,[6]*2]).all()
+    store.renumber([2,0,1])
+    assert store.get_rows().size==6
+    assert (I()==[[3]*2,[6]*2,[4]*2]).all()
+    assert (store.get_offsets([2,0])==[4,0]).all()
+    with pytest.raises(KeyError):store.get_offsets([1,3])
+    store.reset()
+
+def test_integrate_kernel():
+    from EDutils import rotate_exp as exp
+    n    = np.array([5,1,3])
+    beam = np.repeat(np.arange(3),n)
+    Sw   = np.hstack([np.linspace(0.01,-0.01,5),[0.002],np.linspace(-0.01,0.01,3)])
+    I    = np.random.rand(beam.size,4)
+    Iint = exp.integrate_rocking(I,Sw,beam)
+    assert np.allclose(Iint[0],-np.trapz(I[:5],Sw[:5],axis=0))
+    assert np.allclose(Iint[1],I[5])
+    assert np.allclose(Iint[2],np.trapz(I[6:],Sw[6:],axis=0))
+    I_r,refl = rock.integrate_rocking(rock.beams.index[:3])
+    assert I_r.shape==(3,rock._get_z()[1]) and (refl==rock.beams.index[:3]).all()
+
+def test_refine():
+    uvw  = ut.get_uvw_rock(e0=[0,0,1],e1=[2,1],deg=1,npts=9,show=0)
+    args = dict(bloch_args,Nmax=5,thicks=(0,200,5))
+    r = bl.Bloch_cont(path=out+'/refine',tag='ref',uvw=uvw,Sargs=args)
+    r.refine(tol=1e-2,nmax=40)
+    assert 9<r.n_simus<=40
+    theta = np.arccos(np.clip(r.uvw.dot(r.uvw[0]),-1,1))
+    assert (np.diff(theta)>0).all()
+    rows = r.df_frames[r.df_frames.frame==3].sort_values('iG')
+    assert np.allclose(r._get_Iz(rows),r.load(3).Iz)
+
 # @pytest.mark.lvl1
 @pytest_util.cmp_ref(__file__)
 def test_integrate_rocking():
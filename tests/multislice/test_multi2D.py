@@ -0,0 +1,35 @@
+from utils import*
+import multislice.multi_2D as MS2D  ;imp.reload(MS2D)
+import wallpp.plane_group as pg
+from utils import pytest_util
+import pytest
+plt.close('all')
+
+out,ref,dir = pytest_util.get_path(__file__)
+ax,bz   = 8,10
+pattern = np.array([[2,3,2],[4,6,4],[1.5,2.0,1]])
+nx      = 2**8
+args    = dict(keV=200,dz=2,nz=10,eps=0.25,opts='qx',v=0)
+potential = pg.Wallpaper('p1',ax,bz,90,pattern,ndeg=nx,gen=True).get_potential_grid_p1()
+
+def test_batch():
+    tilts = [0,0.05,0.1]
+    mp = MS2D.Multi2D(potential,ax,bz,Nx=2,tilt=tilts,**args)
+    assert mp.psi_qz.shape==(3,10,2*nx)
+    for i,t in enumerate(tilts):
+        mp1 = MS2D.Multi2D(potential,ax,bz,Nx=2,tilt=t,**args)
+        assert np.allclose(mp1.psi_qz,mp.psi_qz[i])
+        assert np.allclose(mp1.psi_xz,mp.psi_xz[i])
+    #### TDS configurations without displacements
+    mp0 = MS2D.Multi2D(potential,ax,bz,**args)
+    mp  = MS2D.Multi2D(pattern,ax,bz,nx=nx,TDS=True,nTDS=2,wobble=0,coherent=True,**args)
+    assert np.allclose(mp.psi_qz,mp0.psi_qz)
+    assert np.allclose(np.abs(mp.psi_qz_c)**2,mp0.psi_qz)
+
+def test_TDS_average():
+    TDS = dict(Nx=2,nx=nx,TDS=True,nTDS=5,wobble=0.1,seed=1,coherent=True)
+    mp  = MS2D.Multi2D(pattern,ax,bz,TDS_batch=5,**TDS,**args)
+    mp1 = MS2D.Multi2D(pattern,ax,bz,TDS_batch=2,nproc=2,**TDS,**args)
+    for k in ['psi_qz','psi_xz','psi_qz_c']:
+        assert np.allclose(mp1.__dict__[k],mp.__dict__[k])
+    assert np.all(np.abs(mp.psi_qz_c)**2<=mp.psi_qz*(1+1e-10))
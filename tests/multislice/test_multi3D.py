@@ -0,0 +1,108 @@
+from utils import*
+import multislice.multi_3D as MS3D  ;imp.reload(MS3D)
+from utils import pytest_util
+import pytest,os,glob
+plt.close('all')
+
+out,ref,dir = pytest_util.get_path(__file__)
+np.random.seed(0)
+ax,by,cz = 6,8,4
+natoms   = 20
+pattern  = np.array([np.random.choice(list(MS3D.Zs.keys()),natoms),
+    np.random.rand(natoms)*ax,np.random.rand(natoms)*by,np.random.rand(natoms)*cz]).T
+
+def multi3D(**kwargs):
+    args = dict(keV=200,Nxy=[1,1],nxy=2**7,nz=2,dz=cz/2,opts='',v=0,
+        hk=2,hkopt='r',copt=1,name=out+'/test')
+    args.update(kwargs)
+    return MS3D.Multi3D(pattern.copy(),ax,by,cz,**args)
+
+def test_projected_potential():
+    mp = multi3D()
+    dx,dy = mp.dx,mp.dy
+    nx,ny = np.array(mp.nxy/mp.Nxy,dtype=int)
+    for iz in range(2):
+        #### pixel by pixel reference
+        Vz = np.zeros((nx,ny))
+        for Za,xa,ya,za in mp.pattern[mp.Zas[iz]:mp.Zas[iz+1],:4]:
+            Za = int(Za)
+            nax,nay = int(MS3D.Ai[Za]/dx),int(MS3D.Ai[Za]/dy)
+            ixa,iya = int(xa/dx),int(ya/dy)
+            for ix in ixa+np.arange(-nax,nax+1):
+                for iy in iya+np.arange(-nay,nay+1):
+                    Vz[ix%nx,iy%ny] += MS3D.fv(0,dy*iy,dx*ix,za,ya,xa,Za)
+        assert np.allclose(mp._projected_potential(iz),Vz,rtol=1e-12)
+
+def test_T_cache():
+    mp0 = multi3D(nz=0,dz=cz/4)
+    ncalls = [0]
+    f = mp0._transmission_function
+    def count(*args,**kwargs):
+        ncalls[0]+=1
+        return f(*args,**kwargs)
+    mp0._transmission_function = count
+    mp0.propagate(5*mp0.ns,1,1,'',0)
+    assert ncalls[0]==mp0.ns+1 and len(mp0._T_cache)==mp0.ns+1
+    #### spilled to disk
+    mp = multi3D(Nz=5,dz=cz/4,T_mem=0)
+    assert os.path.exists(mp._T_cache.spill_file)
+    assert np.allclose(mp.beams,mp0.beams)
+    mp.clear_T_cache()
+    assert not os.path.exists(out+'/test_T.mmap')
+
+def test_fft_backends():
+    from multislice import fft_backend
+    mp = multi3D(Nz=2,fft_args={'backend':'fftpack'})
+    for backend in ['numpy','scipy']:
+        mp1 = multi3D(Nz=2,fft_args={'backend':backend,'workers':2})
+        assert mp1._fft.name==backend
+        assert np.allclose(mp1.beams,mp.beams)
+    #### rebuilt when the backend or the axes change
+    mp.fft_args = {'backend':'numpy'}
+    assert mp._get_fft(mp.nxy).name=='numpy'
+    assert not mp._get_fft(mp.nxy,axes=(-1,)).axes==mp._get_fft(mp.nxy).axes
+    x = np.random.rand(3,16,16)+0J
+    fft = fft_backend.get_fft(x.shape,axes=(-2,-1))
+    assert np.allclose(fft.fft_mul(x,1),np.fft.fft2(x))
+    assert np.allclose(fft.ifft_mul(fft.fft(x),1),x)
+    with pytest.raises(Exception):fft_backend.get_fft(x.shape,backend='fftx')
+
+def test_pyfftw():
+    pytest.importorskip('pyfftw')
+    mp  = multi3D(Nz=2,fft_args={'backend':'fftpack'})
+    mp1 = multi3D(Nz=2,fft_args={'backend':'pyfftw','wisdom':out+'/wisdom.pkl'})
+    assert np.allclose(mp1.beams,mp.beams)
+
+def test_batch():
+    tilts = np.array([[0,0],[0.1,0],[0.05,0.2]])
+    mp = multi3D(Nz=2,tilt=tilts)
+    assert mp.beams.shape[:2]==(3,mp.Nhk)
+    for i,t in enumerate(tilts):
+        assert np.allclose(multi3D(Nz=2,tilt=list(t)).beams,mp.beams[i])
+    #### TDS configurations without displacements
+    mp0 = multi3D(Nz=2)
+    mp  = multi3D(Nz=2,TDS=True,nTDS=2,wobble=0,coherent=True)
+    assert np.allclose(mp.beams,mp0.beams)
+    assert np.allclose(mp.Ib,np.abs(mp0.beams)**2)
+    mp  = multi3D(Nz=2,TDS=True,nTDS=2,tilt=tilts)
+    assert mp.Ib.shape[:2]==(3,mp.Nhk)
+
+def test_TDS_average():
+    TDS = dict(Nz=2,TDS=True,nTDS=5,wobble=0.1,seed=1,coherent=True)
+    mp  = multi3D(TDS_batch=5,**TDS)
+    mp1 = multi3D(TDS_batch=2,nproc=2,**TDS)
+    assert np.allclose(mp1.Ib,mp.Ib) and np.allclose(mp1.beams,mp.beams)
+    assert np.all(np.abs(mp.beams)**2<=mp.Ib*(1+1e-10))
+    assert not glob.glob(out+'/*.mmap')
+    with pytest.raises(Exception):mp.propagate(1,1,1,'',0)
+
+def test_TDS_memory(monkeypatch):
+    import pickle
+    sizes,f = {},MS3D.pymultislice._TDS_block
+    def block(mp,*args):
+        sizes[mp.nTDS] = len(pickle.dumps(mp))
+        return f(mp,*args)
+    monkeypatch.setattr(MS3D.pymultislice,'_TDS_block',block)
+    for nTDS in [4,40]:
+        mp = multi3D(Nz=1,TDS=True,nTDS=nTDS,TDS_batch=2)
+    assert sizes[40]<1.1*sizes[4]